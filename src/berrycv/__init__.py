@@ -1,5 +1,80 @@
 ## -- read_qr --
-from .read_qr import readQR, unpackQR, getQRStruct
+from .read_qr import readQR, readQRs, unpackQR, getQRStruct
 
 ## -- utils --
-from .utils import create_sub, generate_thresh_mask, read_image, show_image, readJSONconfig
+from .utils import create_sub, generate_thresh_mask, read_image, show_image, readJSONconfig, \
+    read_exif_datetime, list_images, is_image_list, read_image_list, touch
+
+## -- imcache --
+from .imcache import ImageCache, set_image_cache, image_cache
+
+## -- pipeline --
+from .pipeline import prefetch_images, ImageWriter
+
+## -- qc --
+from .qc import preflight_check
+
+## -- buffers --
+from .buffers import BufferPool, worker_pool
+
+## -- masks --
+from .masks import generate_mask, apply_mask, logical_and, logical_or, invert, fill, median_blur, \
+    find_objects, roi_rectangle, roi_objects, auto_crop
+
+## -- shape --
+from .shape import analyze_shapes, within_frame
+
+## -- color --
+from .color import analyze_color, color_histograms, hue_stats
+
+## -- approx --
+from .approx import sample_size, sample_indices, proportion_ci, histogram_mean_ci
+
+## -- analysis --
+from .analysis import run_steps, Intermediates, naive_bayes_masks
+
+## -- sweep --
+from .sweep import read_sweep, parameter_sets, run_sweep
+
+## -- popstats --
+from .popstats import PopulationStats, merge_stats_files
+
+## -- results --
+from .results import Results
+
+## -- markers --
+from .markers import report_size_marker_area
+
+## -- objfilter --
+from .objfilter import ObjectFilter
+
+## -- segment --
+from .segment import SegmentationEngine, PhotoboothLayout, LeafLayout, SingleLayout, MultiTrayLayout, SizeMarkers, \
+    NoMarkers, ObjectSplitter, WholeImage, assign_objects
+
+## -- manifest --
+from .manifest import ManifestWriter, read_manifest, manifest_metadata
+
+## -- dedup --
+from .dedup import DuplicateFinder
+
+## -- video --
+from .video import VideoIngest, ObjectTracker, read_frames
+
+## -- metrics --
+from .metrics import RunMetrics, MetricsReporter, run_metrics
+
+## -- calibration --
+from .calibration import MarkerCalibration, session_key
+
+## -- colorcorr --
+from .colorcorr import ColorCorrection
+
+## -- shards --
+from .shards import parse_shard, select_shard, merge_shards
+
+## -- threads --
+from .threads import ThreadBudget, limit_threads
+
+## -- scheduler --
+from .scheduler import run_jobs, run_workflow, run_sampling_jobs
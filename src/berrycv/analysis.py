@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+"""
+analysis.py -- analysis steps as nodes over lazily computed, shared per-sample intermediates
+
+Each step (shape, color, bloom, disease) names the intermediates it needs -- mask, contours, HSV,
+blurred image, masked pixel arrays -- instead of computing them itself. An Intermediates object
+computes each one the first time it is asked for and keeps it for the other selected steps, so the
+HSV conversion of the disease step, the masked pixels of the color step and the contours of the
+shape step are each computed once per sample at most, and never when no selected step needs them.
+
+    img -> mask -> objects                       (shape)
+        -> mask -> pixels -> pixels_lab          (color)
+                           -> pixels_hsv <- hsv  (color; from hsv when a selected step converts the frame)
+        -> hsv                                   (disease)
+        -> blurred -> blurred_hsv -> bloom_areas (bloom -- both classifiers share one conversion)
+
+In the approximate mode (approximate= a sample rate or pixel count, see approx.py) the color step
+bins a stratified sample of the masked pixels and the disease step classifies a stratified sample of
+the frame (frame_hsv) instead of converting the whole frame; both also record their estimates with
+95% confidence half-widths (*_ci95). The disease step writes no disease/healthy images in this mode.
+
+Tunable settings (PARAMS -- mask fill size, bloom blur kernel, disease hue and saturation bounds) are
+read from the Intermediates' params. Each intermediate is stored under the values of the params it
+depends on (directly or through its dependencies), so Intermediates of several parameter sets
+sharing one store compute e.g. the HSV image once and the mask once per distinct fill size (sweep.py).
+"""
+import os.path
+import functools
+
+import cv2
+import numpy as np
+
+from .masks import generate_mask, find_objects, logical_and, invert
+from .color import masked_pixels, channel_counts, record_color, COLOR_CHANNELS
+from .approx import sample_size, sample_indices, proportion_ci, histogram_mean_ci
+from .shape import analyze_shapes
+
+
+## naive Bayes models of the bloom step -- relative to the working directory
+BLOOM_MODEL = 'models/BL-NBL_nbmc.txt'
+SCAR_MODEL = 'models/SK-BL-SC_nbmc.txt'
+
+## tunable settings of the analysis and their defaults -- the values the steps were written with
+PARAMS = {
+    'mask_fill': 1000,          ## fill size of generate_mask
+    'bloom_blur': 17,           ## gaussian blur kernel of the bloom step
+    'disease_hue_min': 0,       ## disease pixels -- hue_min < H < hue_max and sat_min < S < sat_max
+    'disease_hue_max': 25,
+    'disease_sat_min': 30,
+    'disease_sat_max': 255,
+}
+
+## producers of the named intermediates -- name: (names it depends on, function of the Intermediates)
+INTERMEDIATES = {}
+
+## params read by the producers -- name: param names
+INTERMEDIATE_PARAMS = {}
+
+## analysis steps in the order they record -- name: (intermediates used, function)
+STEPS = {}
+
+## intermediates used by the steps which run differently in the approximate mode -- name: intermediates
+APPROXIMATE_STEPS = {}
+
+## method recorded with the estimates of the approximate mode
+APPROX_METHOD = 'stratified pixel sample'
+
+
+## params -- names of PARAMS the producer reads
+def intermediate(name, *deps, params=()):
+    def register(fn):
+        INTERMEDIATES[name] = (deps, fn)
+        INTERMEDIATE_PARAMS[name] = tuple(params)
+        return fn
+    return register
+
+
+## approximate -- intermediates the step uses instead in the approximate mode, None when they are the same
+def step(name, *needs, approximate=None):
+    def register(fn):
+        STEPS[name] = (needs, fn)
+        if approximate is not None:
+            APPROXIMATE_STEPS[name] = approximate
+        return fn
+    return register
+
+
+## names reachable from the given intermediates through their dependencies
+def closure(names):
+    needed = set()
+    todo = list(names)
+    while todo:
+        name = todo.pop()
+        if name in needed:
+            continue
+        needed.add(name)
+        if name in INTERMEDIATES:
+            todo.extend(INTERMEDIATES[name][0])
+    return needed
+
+
+## params an intermediate depends on, directly or through its dependencies
+@functools.lru_cache(maxsize=None)
+def param_deps(name):
+    if name not in INTERMEDIATES:
+        return ()
+    names = set(INTERMEDIATE_PARAMS[name])
+    for d in INTERMEDIATES[name][0]:
+        names.update(param_deps(d))
+    return tuple(sorted(names))
+
+
+## intermediates of one sample -- computed on first access and kept
+## needed -- intermediates the selected steps will use, so producers can take the cheapest shared route
+## approximate -- sample rate (< 1) or pixel count (>= 1) of the approximate mode, None for all pixels
+## params -- values overriding PARAMS
+## store -- dict of computed intermediates shared with the Intermediates of other parameter sets of the same image
+class Intermediates:
+
+    def __init__(self, img, needed=(), pool=None, approximate=None, params=None, store=None, **values):
+        self.params = dict(PARAMS, **(params or {}))
+        self._values = store if store is not None else {}
+        for name, value in values.items():
+            self._values.setdefault(self._key(name), value)
+        self._values[self._key('img')] = img
+        self.needed = closure(needed)
+        self.pool = pool
+        self.approximate = approximate
+
+    ## key of an intermediate in the store -- its name and the values of the params it depends on
+    def _key(self, name):
+        return (name,) + tuple(self.params[p] for p in param_deps(name))
+
+    def __getitem__(self, name):
+        key = self._key(name)
+        if key not in self._values:
+            deps, fn = INTERMEDIATES[name]
+            for d in deps:
+                self[d]
+            self._values[key] = fn(self)
+        return self._values[key]
+
+    ## whether an intermediate has been computed (or given)
+    def computed(self, name):
+        return self._key(name) in self._values
+
+
+@intermediate('mask', 'img', params=('mask_fill',))
+def _mask(ix):
+    return generate_mask(ix['img'], fill_size=ix.params['mask_fill'], pool=ix.pool)
+
+
+@intermediate('objects', 'mask')
+def _objects(ix):
+    return find_objects(ix['mask'])
+
+
+@intermediate('hsv', 'img')
+def _hsv(ix):
+    return cv2.cvtColor(ix['img'], cv2.COLOR_BGR2HSV)
+
+
+## flat frame indices of the masked pixels (a stratified sample of them in the approximate mode)
+## and the number of masked pixels
+@intermediate('pixel_index', 'mask')
+def _pixel_index(ix):
+    index = np.flatnonzero(ix['mask'])
+    if ix.approximate is None:
+        return index, index.size
+    return index[sample_indices(index.size, sample_size(index.size, ix.approximate))], index.size
+
+
+## masked BGR pixels as an N x 3 array
+@intermediate('pixels', 'img', 'mask')
+def _pixels(ix):
+    if ix.approximate is None:
+        return masked_pixels(ix['img'], ix['mask'])
+    return ix['img'].reshape(-1, 3)[ix['pixel_index'][0]]
+
+
+@intermediate('pixels_lab', 'pixels')
+def _pixels_lab(ix):
+    return _convert_pixels(ix['pixels'], cv2.COLOR_BGR2LAB)
+
+
+## taken from the full-frame HSV when a selected step needs it anyway -- the conversion is per pixel
+@intermediate('pixels_hsv', 'pixels')
+def _pixels_hsv(ix):
+    if 'hsv' in ix.needed or ix.computed('hsv'):
+        if ix.approximate is None:
+            return ix['hsv'][ix['mask'] > 0]
+        return ix['hsv'].reshape(-1, 3)[ix['pixel_index'][0]]
+    return _convert_pixels(ix['pixels'], cv2.COLOR_BGR2HSV)
+
+
+## HSV of a stratified sample of the whole frame as an N x 3 array (all pixels without approximate)
+## and the number of pixels in the frame
+@intermediate('frame_hsv', 'img')
+def _frame_hsv(ix):
+    pixels = ix['img'].reshape(-1, 3)
+    total = pixels.shape[0]
+    if ix.approximate is not None:
+        pixels = pixels[sample_indices(total, sample_size(total, ix.approximate))]
+    return _convert_pixels(pixels, cv2.COLOR_BGR2HSV), total
+
+
+## same blur as pcv.gaussian_blur(img, ksize=(17, 17), sigma_x=0, sigma_y=None) with the default bloom_blur
+@intermediate('blurred', 'img', params=('bloom_blur',))
+def _blurred(ix):
+    k = int(ix.params['bloom_blur'])
+    return cv2.GaussianBlur(ix['img'], (k, k), 0, None)
+
+
+@intermediate('blurred_hsv', 'blurred')
+def _blurred_hsv(ix):
+    return cv2.cvtColor(ix['blurred'], cv2.COLOR_BGR2HSV)
+
+
+## (nobloom, bloom, scar) pixel areas of the bloom step -- shared by parameter sets with the same blur and mask
+@intermediate('bloom_areas', 'mask', 'blurred_hsv')
+def _bloom_areas(ix):
+    mask = ix['mask']
+    sc_masks = naive_bayes_masks(ix['blurred_hsv'], SCAR_MODEL)
+    masks = naive_bayes_masks(ix['blurred_hsv'], BLOOM_MODEL)
+
+    ## normalize masks and calculate the observation values
+    scar = logical_and(sc_masks['scar'], mask, dst=sc_masks['scar'])
+    not_scar = invert(scar)
+    bloom = logical_and(logical_and(masks['bloom'], mask, dst=masks['bloom']), not_scar, dst=masks['bloom'])
+    nobloom = logical_and(logical_and(masks['nobloom'], mask, dst=masks['nobloom']), not_scar, dst=masks['nobloom'])
+    return np.count_nonzero(nobloom), np.count_nonzero(bloom), np.count_nonzero(scar)
+
+
+def _convert_pixels(pixels, code):
+    if pixels.shape[0] == 0:
+        return pixels
+    return cv2.cvtColor(pixels.reshape(-1, 1, 3), code)[:, 0, :]
+
+
+## class PDFs of a naive Bayes model file written by plantcv-train.py -- class: channel: 256 probabilities
+@functools.lru_cache(maxsize=None)
+def read_naive_bayes(pdf_file):
+    pdfs = {}
+    with open(pdf_file, 'r') as pf:
+        pf.readline()
+        for row in pf:
+            cols = row.rstrip('\n').split('\t')
+            if len(cols) != 258:
+                raise ValueError('Naive Bayes PDF file is not formatted correctly. Error on line:\n' + row)
+            pdfs.setdefault(cols[0], {})[cols[1]] = np.array([float(i) for i in cols[2:]], dtype=np.float64)
+    return pdfs
+
+
+## class masks of an HSV image -- same masks as pcv.naive_bayes_classifier, as table lookups
+## instead of a loop over the pixels
+def naive_bayes_masks(hsv, pdf_file):
+    pdfs = read_naive_bayes(pdf_file)
+    h, s, v = hsv[:, :, 0], hsv[:, :, 1], hsv[:, :, 2]
+    px_p = dict((c, p['hue'][h] * p['saturation'][s] * p['value'][v]) for c, p in pdfs.items())
+    masks = {}
+    for class_name in pdfs:
+        background_class = np.maximum.reduce([px_p[c] for c in pdfs if c != class_name])
+        masks[class_name] = np.where(px_p[class_name] > background_class, 255, 0).astype(np.uint8)
+    return masks
+
+
+## records an estimate of the approximate mode and its 95% confidence half-width as <variable>_ci95
+def _record_estimate(results, label, variable, trait, scale, value, ci):
+    results.add_observation(sample=label, variable=variable, trait=trait + ' (estimate)',
+                            method=APPROX_METHOD, scale=scale, datatype=float,
+                            value=float(value), label=scale)
+    results.add_observation(sample=label, variable=variable + '_ci95',
+                            trait=trait + ' (95% confidence half-width)',
+                            method=APPROX_METHOD, scale=scale, datatype=float,
+                            value=float(ci), label=scale)
+
+
+## the disease and healthy pixels of an HSV image or N x 3 array of HSV pixels
+def _disease_masks(img_hsv, params=PARAMS):
+    msk_hue = np.logical_and((img_hsv[..., 0] > params['disease_hue_min']), (img_hsv[..., 0] < params['disease_hue_max']))
+    msk_sat = np.logical_and((img_hsv[..., 1] > params['disease_sat_min']), (img_hsv[..., 1] < params['disease_sat_max']))
+    return np.logical_and(msk_hue, msk_sat), np.logical_and(~msk_hue, msk_sat)
+
+
+## -- steps -- each records the observations of one analysis into results
+
+@step('shape', 'mask', 'objects')
+def shape_step(ix, results, label, filename=None, writer=None):
+    ## shape traits of every object in one pass -- though there should be one per sample photo
+    id_objects, _h = ix['objects']
+    analyze_shapes(ix['mask'], id_objects, results, label=label)
+
+
+@step('color', 'pixels', 'pixels_lab', 'pixels_hsv')
+def color_step(ix, results, label, filename=None, writer=None):
+    ## histograms of the masked pixels only -- same observations as pcv.analyze_color
+    counts = record_color(channel_counts(ix['pixels'], ix['pixels_lab'], ix['pixels_hsv']), results, label=label)
+    if ix.approximate is None or counts[0].sum() == 0:
+        return
+
+    ## channel means on the label scale of the histograms (as mv_means.py computes them)
+    sampled, total = ix['pixel_index'][0].size, ix['pixel_index'][1]
+    for (variable, trait, values, nbins), channel in zip(COLOR_CHANNELS, counts):
+        mean, ci = histogram_mean_ci(channel[:nbins], values, total)
+        _record_estimate(results, label, variable.replace('_frequencies', '_mean'),
+                         trait.replace(' frequencies', ' mean'), 'channel value', mean, ci)
+    results.add_observation(sample=label, variable='color_sampled_pixels',
+                            trait='masked pixels sampled for the color estimates',
+                            method=APPROX_METHOD, scale='pixels', datatype=int,
+                            value=int(sampled), label=label)
+    results.add_observation(sample=label, variable='color_total_pixels',
+                            trait='masked pixels of the sample',
+                            method=APPROX_METHOD, scale='pixels', datatype=int,
+                            value=int(total), label=label)
+
+
+@step('bloom', 'bloom_areas')
+def bloom_step(ix, results, label, filename=None, writer=None):
+    nobloom_area, bloom_area, scar_area = ix['bloom_areas']
+    bloom_fac = bloom_area / (bloom_area + nobloom_area - scar_area)
+
+    results.add_observation(sample=label, variable='nobloom_area',
+                            trait='area of nobloom pixels',
+                            method='pixels', scale='pixels', datatype=int,
+                            value=nobloom_area, label=label)
+    results.add_observation(sample=label, variable='bloom_area',
+                            trait='area of bloom pixels',
+                            method='pixels', scale='pixels', datatype=int,
+                            value=bloom_area, label=label)
+    results.add_observation(sample=label, variable='scar_area',
+                            trait='area of scar pixels',
+                            method='pixels', scale='pixels', datatype=int,
+                            value=scar_area, label=label)
+    results.add_observation(sample=label, variable='bloom_factor',
+                            trait='ratio of bloom pixels to all skin pixels',
+                            method='ratio of pixels', scale='percent', datatype=float,
+                            value=bloom_fac, label=label)
+
+
+## writes disease.jpg and healthy.jpg next to the sample image -- the approximate mode writes neither
+@step('disease', 'hsv', approximate=('frame_hsv',))
+def disease_step(ix, results, label, filename=None, writer=None):
+    if ix.approximate is not None:
+        return _approximate_disease(ix, results, label)
+    total_disease, total_ok = _disease_masks(ix['hsv'], ix.params)
+
+    ## original image with only the disease or only the healthy parts
+    disease = ix['img'].copy()
+    healthy = ix['img'].copy()
+    disease[~total_disease] = 255
+    healthy[~total_ok] = 255
+    if filename is not None:
+        for name, img in (('disease.jpg', disease), ('healthy.jpg', healthy)):
+            path = os.path.dirname(filename) + '/' + name
+            if writer is None:
+                cv2.imwrite(path, img)
+            else:
+                writer.write(path, img)
+
+    disease_fac = np.sum(total_disease) / (np.sum(total_disease) + np.sum(total_ok))
+    results.add_observation(sample=label, variable='disease_factor',
+                            trait='ratio of disease pixels to all leaf pixels',
+                            method='ratio of pixels', scale='percent', datatype=float,
+                            value=disease_fac, label=label)
+
+
+## disease factor of a stratified sample of the frame -- a ratio of two sampled counts, with the
+## confidence interval of a proportion of the sampled disease and healthy pixels
+def _approximate_disease(ix, results, label):
+    pixels_hsv, total = ix['frame_hsv']
+    total_disease, total_ok = _disease_masks(pixels_hsv, ix.params)
+    n_disease, n_ok = np.sum(total_disease), np.sum(total_ok)
+    classified = n_disease + n_ok
+    disease_fac = n_disease / classified if classified else float('nan')
+    ## the classified pixels of the frame, estimated from their share of the sample
+    population = classified * total / float(pixels_hsv.shape[0]) if pixels_hsv.shape[0] else 0
+    results.add_observation(sample=label, variable='disease_factor',
+                            trait='ratio of disease pixels to all leaf pixels',
+                            method='ratio of pixels', scale='percent', datatype=float,
+                            value=disease_fac, label=label)
+    results.add_observation(sample=label, variable='disease_factor_ci95',
+                            trait='ratio of disease pixels to all leaf pixels (95% confidence half-width)',
+                            method=APPROX_METHOD, scale='percent', datatype=float,
+                            value=float(proportion_ci(disease_fac, classified, population)), label=label)
+    results.add_observation(sample=label, variable='disease_sampled_pixels',
+                            trait='frame pixels sampled for the disease estimate',
+                            method=APPROX_METHOD, scale='pixels', datatype=int,
+                            value=int(pixels_hsv.shape[0]), label=label)
+
+
+## runs the selected steps (names of STEPS, in STEPS order) on one sample image
+## -- intermediates are computed once and shared; returns the Intermediates for inspection
+## approximate -- sample rate (< 1) or pixel count (>= 1) for the approximate color and disease
+## estimates, None for the exact steps
+## params, store -- settings overriding PARAMS and a store shared between runs of one image (see Intermediates)
+def run_steps(img, steps, results, label, filename=None, writer=None, pool=None, approximate=None,
+              params=None, store=None, **values):
+    selected = [name for name in STEPS if name in steps]
+    needs = [APPROXIMATE_STEPS.get(name, STEPS[name][0]) if approximate is not None else STEPS[name][0]
+             for name in selected]
+    ix = Intermediates(img, needed=[n for names in needs for n in names], pool=pool,
+                       approximate=approximate, params=params, store=store, **values)
+    for name in selected:
+        STEPS[name][1](ix, results, label, filename=filename, writer=writer)
+    return ix
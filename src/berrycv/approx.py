@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+approx.py -- pixel subsampling and confidence intervals for the approximate analysis mode
+
+Instead of every pixel, n pixels are drawn by stratified random sampling: the N pixels (in raster
+order) are cut into n equal strata and one random pixel is taken from each, which covers the whole
+object evenly and has at most the variance of simple random sampling. Estimates are reported with
+95% confidence intervals from the simple random sampling variance with the finite population
+correction, which is conservative for the stratified draw.
+
+Error bound at the 95% level, for n sampled pixels:
+    proportions (disease_factor, histogram bins)   |error| <= 1.96 * sqrt(0.25 / n)  -- 0.0098 at n = 10000
+    channel means (label scale of mv_means)        |error| <= 1.96 * sd / sqrt(n)  <= 1.96 * range / (2 * sqrt(n))
+"""
+import numpy as np
+
+
+## default number of pixels sampled per image
+APPROX_PIXELS = 10000
+
+## z value of the reported 95% confidence intervals
+Z95 = 1.959964
+
+## seed of the within-stratum draws -- results are reproducible run to run
+APPROX_SEED = 0
+
+
+## number of pixels to sample out of total -- approximate is a sample rate (< 1) or a pixel count (>= 1)
+def sample_size(total, approximate=APPROX_PIXELS):
+    if approximate is None:
+        return total
+    approximate = float(approximate)
+    if approximate <= 0:
+        raise ValueError('Approximate sample rate or pixel count must be positive -- got %g' % approximate)
+    n = int(round(total * approximate)) if approximate < 1 else int(approximate)
+    return max(1, min(total, n)) if total else 0
+
+
+## indices of n of total items, one drawn at random from each of n equal strata -- all of them when n >= total
+def sample_indices(total, n, seed=APPROX_SEED):
+    if n >= total:
+        return np.arange(total)
+    step = total / float(n)
+    offsets = np.random.default_rng(seed).random(n)
+    return np.minimum((np.arange(n) * step + offsets * step).astype(np.intp), total - 1)
+
+
+## finite population correction of a sample of n out of total
+def _fpc(n, total):
+    return max(0.0, 1.0 - n / float(total)) if total else 0.0
+
+
+## 95% confidence half-width of a proportion p estimated from n of total items
+def proportion_ci(p, n, total):
+    if n <= 0:
+        return float('nan')
+    return Z95 * np.sqrt(p * (1.0 - p) / n * _fpc(n, total))
+
+
+## mean and 95% confidence half-width of the values of a histogram (counts per value) of n of total items
+def histogram_mean_ci(counts, values, total):
+    counts = np.asarray(counts, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    n = counts.sum()
+    if n <= 0:
+        return float('nan'), float('nan')
+    mean = np.dot(counts, values) / n
+    if n < 2:
+        return float(mean), float('nan')
+    var = np.dot(counts, (values - mean) ** 2) / (n - 1)
+    return float(mean), float(Z95 * np.sqrt(var / n * _fpc(n, total)))
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+buffers.py -- reusable buffer pool for full-frame intermediates
+
+Masks, colorspace conversions and label images are the size of the whole photo. Routines in
+berrycv.masks take a pool and write into its buffers instead of allocating new arrays, so a
+long-lived worker reaches a steady state where no full-frame memory is allocated per image.
+"""
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+
+
+## pool of arrays keyed by (shape, dtype) -- not thread-safe, use one pool per thread (see worker_pool)
+class BufferPool:
+
+    def __init__(self):
+        self._free = defaultdict(list)
+        self._out = {}
+        self._scopes = []
+        self.allocations = 0
+        self.reuses = 0
+        self.bytes_allocated = 0
+        self.bytes_in_use = 0
+        self.high_water_bytes = 0
+
+    ## checks out an uninitialized array of the given shape and dtype
+    def get(self, shape, dtype=np.uint8):
+        key = (tuple(int(s) for s in shape), np.dtype(dtype).str)
+        free = self._free[key]
+        if free:
+            arr = free.pop()
+            self.reuses += 1
+        else:
+            arr = np.empty(key[0], dtype=key[1])
+            self.allocations += 1
+            self.bytes_allocated += arr.nbytes
+
+        self._out[id(arr)] = (key, arr)
+        self.bytes_in_use += arr.nbytes
+        self.high_water_bytes = max(self.high_water_bytes, self.bytes_in_use)
+        if self._scopes:
+            self._scopes[-1].append(arr)
+        return arr
+
+    ## returns arrays to the pool -- arrays which did not come from the pool are ignored
+    def release(self, *arrays):
+        for arr in arrays:
+            entry = self._out.pop(id(arr), None)
+            if entry is None:
+                continue
+            key, arr = entry
+            self.bytes_in_use -= arr.nbytes
+            self._free[key].append(arr)
+
+    ## every array checked out inside the block is released when the block exits
+    ## -- results which must outlive the block have to be copied out of the pool
+    @contextmanager
+    def scope(self):
+        self._scopes.append([])
+        try:
+            yield self
+        finally:
+            self.release(*self._scopes.pop())
+
+    ## drops the free arrays so their memory can be returned to the system
+    def trim(self):
+        for key, free in self._free.items():
+            for arr in free:
+                self.bytes_allocated -= arr.nbytes
+        self._free.clear()
+
+    ## pool usage statistics, sizes in bytes
+    def stats(self):
+        return {
+            'allocations': self.allocations,
+            'reuses': self.reuses,
+            'bytes_allocated': self.bytes_allocated,
+            'bytes_in_use': self.bytes_in_use,
+            'high_water_bytes': self.high_water_bytes,
+            'buffers': sum(len(f) for f in self._free.values()) + len(self._out)
+        }
+
+
+_local = threading.local()
+
+## returns the buffer pool of the calling thread, created on first use and kept for the life of the worker
+def worker_pool():
+    pool = getattr(_local, 'pool', None)
+    if pool is None:
+        pool = BufferPool()
+        _local.pool = pool
+    return pool
+
+
+## returns dst if given, otherwise an array from the pool, otherwise a new array
+def out_buffer(shape, dtype=np.uint8, dst=None, pool=None):
+    if dst is not None:
+        return dst
+    if pool is not None:
+        return pool.get(shape, dtype)
+    return np.empty(shape, dtype=dtype)
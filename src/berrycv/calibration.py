@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+calibration.py -- size marker calibration cached per camera and session
+
+On the fixed photobooth camera the size markers do not move within a session, so their area only
+has to be measured once. The first photo of a session goes through the full detection (marker
+bands grown until report_size_marker_area succeeds); the band size, marker pixel count and the
+marker observations are then kept under the camera (EXIF make, model and serial) and session
+(capture date). Later photos only check that the marker mask in the known bands has the same number
+of markers and, within CHECK_TOLERANCE, the same number of pixels -- a failed check falls back to
+the full detection, which recalibrates the session.
+"""
+import os.path
+import json
+import threading
+
+from PIL import Image, ExifTags
+
+from .results import Results
+
+
+## relative difference of the marker pixel count accepted as the calibrated markers
+CHECK_TOLERANCE = 0.02
+
+_EXIF_IDS = dict((name, i) for i, name in ExifTags.TAGS.items())
+
+
+## camera of a photo from its EXIF make, model and body serial number -- '' when there is no EXIF data
+def read_exif_camera(filepath):
+    try:
+        with Image.open(filepath) as exif_img:
+            exif = exif_img._getexif() or {}
+    except Exception:
+        return ''
+    return ' '.join(str(exif[_EXIF_IDS[t]]).strip('\x00 ') for t in ('Make', 'Model', 'BodySerialNumber')
+                    if _EXIF_IDS.get(t) in exif)
+
+
+## calibration key of a photo -- camera and session (capture date of the EXIF datetime)
+def session_key(filepath, dt_og):
+    return '%s|%s' % (read_exif_camera(filepath), str(dt_og)[:10].replace(':', '-'))
+
+
+class MarkerCalibration:
+
+    ## path -- JSON file the calibrations are loaded from and saved to, None to keep them in memory only
+    def __init__(self, path=None, tolerance=CHECK_TOLERANCE):
+        self.path = path
+        self.tolerance = tolerance
+        self._entries = {}
+        self._lock = threading.Lock()
+        if path is not None and os.path.isfile(path):
+            with open(path, 'r') as f:
+                self._entries = json.load(f)
+
+    def get(self, key):
+        with self._lock:
+            return self._entries.get(key)
+
+    ## stores the calibration of a session from a successful full detection
+    def put(self, key, shape, divisions, marker_pixels, num_markers, results):
+        observations = results.observations.get('default', {})
+        entry = {'shape': list(shape[:2]), 'divisions': divisions, 'marker_pixels': int(marker_pixels),
+                 'num_markers': num_markers, 'observations': dict((v, dict(obs)) for v, obs in observations.items())}
+        with self._lock:
+            self._entries[key] = entry
+            if self.path is not None:
+                ## sampling processes share the file -- keep the sessions the others calibrated, replace it whole
+                if os.path.isfile(self.path):
+                    with open(self.path, 'r') as f:
+                        self._entries = dict(json.load(f), **self._entries)
+                tmp = '%s.%d.tmp' % (self.path, os.getpid())
+                with open(tmp, 'w') as f:
+                    json.dump(self._entries, f, indent=4)
+                os.replace(tmp, self.path)
+        return entry
+
+    ## True when the markers found in the calibrated bands are the calibrated markers
+    def check(self, entry, marker_pixels, num_markers):
+        if num_markers != entry['num_markers'] or entry['marker_pixels'] <= 0:
+            return False
+        return abs(marker_pixels - entry['marker_pixels']) <= self.tolerance * entry['marker_pixels']
+
+    ## the marker observations of a calibration as a Results to update a photo's results from
+    def observations(self, entry):
+        results = Results()
+        results.observations['default'] = dict((v, dict(obs)) for v, obs in entry['observations'].items())
+        return results
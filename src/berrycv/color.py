@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+color.py -- masked multi-colorspace histograms without the plotting of pcv.analyze_color
+
+The pixels under the mask are gathered once into an N x 3 array and only those pixels are
+converted to LAB and HSV, so the white background of a crop is never touched. The nine channel
+histograms are binned together in a single np.bincount and recorded with the same
+*_frequencies observations (values, labels and scales) as pcv.analyze_color.
+"""
+import cv2
+import numpy as np
+
+
+## method recorded with every color observation
+COLOR_METHOD = 'berrycv.analyze_color'
+
+## channel order of the stacked histograms -- (variable, trait, label values, bins kept)
+_RGB_VALUES = [i for i in range(0, 256)]
+_HUE_VALUES = [i * 2 + 1 for i in range(0, 180)]
+_PERCENT_VALUES = [round((i / 255) * 100, 2) for i in range(0, 256)]
+_DIVERGING_VALUES = [i for i in range(-128, 128)]
+
+COLOR_CHANNELS = [
+    ('blue_frequencies', 'blue frequencies', _RGB_VALUES, 256),
+    ('green_frequencies', 'green frequencies', _RGB_VALUES, 256),
+    ('red_frequencies', 'red frequencies', _RGB_VALUES, 256),
+    ('lightness_frequencies', 'lightness frequencies', _PERCENT_VALUES, 256),
+    ('green-magenta_frequencies', 'green-magenta frequencies', _DIVERGING_VALUES, 256),
+    ('blue-yellow_frequencies', 'blue-yellow frequencies', _DIVERGING_VALUES, 256),
+    ('hue_frequencies', 'hue frequencies', _HUE_VALUES, 180),
+    ('saturation_frequencies', 'saturation frequencies', _PERCENT_VALUES, 256),
+    ('value_frequencies', 'value frequencies', _PERCENT_VALUES, 256)
+]
+
+
+## returns the masked pixels of a BGR image as an N x 3 array
+def masked_pixels(img, mask):
+    return img[mask > 0]
+
+
+## counts of the nine channels (b, g, r, l, a, b*, h, s, v) of the masked pixels -- 9 x 256 array
+def color_histograms(img, mask):
+    bgr = masked_pixels(img, mask).reshape(-1, 1, 3)
+    if bgr.shape[0] == 0:
+        return np.zeros((9, 256), dtype=np.int64)
+
+    ## convert only the object pixels -- the conversions are per pixel, so the layout does not matter
+    return channel_counts(bgr[:, 0, :], cv2.cvtColor(bgr, cv2.COLOR_BGR2LAB)[:, 0, :],
+                          cv2.cvtColor(bgr, cv2.COLOR_BGR2HSV)[:, 0, :])
+
+
+## counts of the nine channels from the same N masked pixels in BGR, LAB and HSV (N x 3 arrays each)
+def channel_counts(bgr, lab, hsv):
+    n = bgr.shape[0]
+    if n == 0:
+        return np.zeros((9, 256), dtype=np.int64)
+    stacked = np.empty((n, 9), dtype=np.uint8)
+    stacked[:, 0:3] = bgr
+    stacked[:, 3:6] = lab
+    stacked[:, 6:9] = hsv
+
+    ## one bincount for all channels -- channel c is offset into bins c*256..c*256+255
+    offsets = np.arange(9, dtype=np.intp) * 256
+    return np.bincount((stacked + offsets).ravel(), minlength=9 * 256).reshape(9, 256)
+
+
+## median, circular mean and circular std of the nonzero hues from their histogram -- in degrees
+## -- same results as np.median and scipy.stats.circmean/circstd(high=179, low=0) on the pixels
+def hue_stats(hue_counts):
+    counts = np.asarray(hue_counts[1:180], dtype=np.float64)
+    hues = np.arange(1, 180, dtype=np.float64)
+    n = counts.sum()
+    if n == 0:
+        return np.nan, np.nan, np.nan
+
+    ## median -- the middle value, or the mean of the two middle values
+    cum = np.cumsum(counts)
+    lo = hues[np.searchsorted(cum, (n - 1) // 2 + 1)]
+    hi = hues[np.searchsorted(cum, n // 2 + 1)]
+    median = (lo + hi) / 2.0
+
+    ## circular statistics over the 0..179 period
+    period = 179.0
+    ang = hues * 2.0 * np.pi / period
+    s = np.dot(counts, np.sin(ang))
+    c = np.dot(counts, np.cos(ang))
+    mean_ang = np.arctan2(s, c) % (2.0 * np.pi)
+    circ_mean = mean_ang * period / (2.0 * np.pi)
+    r = min(1.0, np.hypot(s / n, c / n))
+    circ_std = (period / (2.0 * np.pi)) * np.sqrt(-2.0 * np.log(r))
+
+    return median * 2, circ_mean * 2, circ_std * 2
+
+
+## records the color histograms and hue statistics of the masked pixels into outputs
+## outputs -- plantcv Outputs-like object with add_observation()
+## returns the 9 x 256 histogram counts (nothing is recorded when the mask is empty)
+def analyze_color(img, mask, outputs, label='default'):
+    return record_color(color_histograms(img, mask), outputs, label)
+
+
+## records the observations of 9 x 256 channel counts into outputs -- returns the counts
+def record_color(counts, outputs, label='default'):
+    pixels = float(counts[0].sum())
+    if pixels == 0:
+        return counts
+
+    ## percent of the masked pixels in each bin
+    percent = (counts / pixels) * 100
+    for (variable, trait, values, nbins), hist in zip(COLOR_CHANNELS, percent):
+        outputs.add_observation(sample=label, variable=variable, trait=trait,
+                                method=COLOR_METHOD, scale='frequency', datatype=list,
+                                value=hist[:nbins].tolist(), label=values)
+
+    hue_median, hue_circular_mean, hue_circular_std = hue_stats(counts[6])
+    outputs.add_observation(sample=label, variable='hue_circular_mean', trait='hue circular mean',
+                            method=COLOR_METHOD, scale='degrees', datatype=float,
+                            value=hue_circular_mean, label='degrees')
+    outputs.add_observation(sample=label, variable='hue_circular_std', trait='hue circular standard deviation',
+                            method=COLOR_METHOD, scale='degrees', datatype=float,
+                            value=hue_circular_std, label='degrees')
+    outputs.add_observation(sample=label, variable='hue_median', trait='hue median',
+                            method=COLOR_METHOD, scale='degrees', datatype=float,
+                            value=hue_median, label='degrees')
+    return counts
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+colorcorr.py -- color correction of the raw photos fitted once per session and applied as a 3D lookup table
+
+The photobooth lighting drifts between sessions, so each session (camera and capture date, as
+berrycv.calibration.session_key) gets a photo of the color card. Its chips are matched to those of
+a target card photo with plantcv's transform (get_matrix_m, calc_transformation_matrix) -- a
+polynomial of R, G and B per channel. Instead of evaluating the polynomial on every pixel of every
+photo, it is evaluated once with plantcv's apply_transformation_matrix on a lattice of 2^bits + 1
+nodes per channel (0, 256 / 2^bits, ... 255), and the lattice is kept as a table of BGR colors, packed
+into one uint32 each, in the LUT directory (<sha1 of card, target, bits and format>.npy). A photo is
+then corrected before it is masked: the top bits of B, G and R pick the lattice cell of a color, and
+the color is interpolated trilinearly between the cell's 8 corners by the low bits -- so the colors
+keep all 256 levels and the histograms are not posterized. Each distinct color of a photo is
+interpolated once, and every pixel is then one lookup in a table of those colors. At 8 bits the table is plantcv's
+correction exactly; at the default 6 bits (1.1 MiB) the polynomial is followed within a level or two.
+"""
+import os
+import hashlib
+import threading
+
+import cv2
+import numpy as np
+
+from .calibration import session_key
+from .imcache import file_hash
+from .metrics import run_metrics
+from .utils import read_exif_datetime
+
+
+## bits of each channel indexing the table
+LUT_BITS = 6
+
+## layout of the stored tables -- part of their key, so tables of an older layout are compiled again
+LUT_FORMAT = 'trilinear-1'
+
+## rows and columns of chips of the card (an X-Rite ColorChecker)
+CARD_ROWS = 4
+CARD_COLS = 6
+
+
+## (chip number, r, g, b) matrix of the chips of a color card photo -- plantcv's find_color_card and get_color_matrix
+def card_matrix(path):
+    from plantcv import plantcv as pcv
+
+    img = cv2.imread(path)
+    if img is None:
+        raise ValueError('Unable to read the color card photo \'%s\'' % path)
+    _df, start_coord, spacing = pcv.transform.find_color_card(rgb_img=img, background='dark',
+                                                              record_chip_size=None)
+    radius = max(2, int(min(spacing) / 6))
+    mask = pcv.transform.create_color_card_mask(img, radius=radius, start_coord=start_coord, spacing=spacing,
+                                                nrows=CARD_ROWS, ncols=CARD_COLS)
+    _headers, matrix = pcv.transform.get_color_matrix(img, mask)
+    return matrix
+
+
+## 9x9 transformation matrix from the chips of a session's card to those of the target card
+def fit_transformation(card, target):
+    from plantcv import plantcv as pcv
+
+    _a, matrix_m, matrix_b = pcv.transform.get_matrix_m(target_matrix=target, source_matrix=card)
+    _deviance, transformation = pcv.transform.calc_transformation_matrix(matrix_m, matrix_b)
+    return transformation
+
+
+## table of the (2^bits + 1)^3 corrected lattice nodes as uint32 (B, G, R, 0 bytes), B major
+def compile_lut(transformation, bits=LUT_BITS):
+    from plantcv import plantcv as pcv
+
+    n = (1 << bits) + 1
+    nodes = np.minimum(np.arange(n) * (256 >> bits), 255).astype(np.uint8)
+    b, g, r = np.meshgrid(nodes, nodes, nodes, indexing='ij')
+    lattice = np.stack([b, g, r], axis=-1).reshape(n * n, n, 3)
+    corrected = pcv.transform.apply_transformation_matrix(lattice, lattice, transformation)
+    packed = np.zeros((n * n * n, 4), dtype=np.uint8)
+    packed[:, :3] = corrected.reshape(n * n * n, 3)
+    return packed.view(np.uint32).ravel()
+
+
+## corrected packed colors (uint32, B, G, R, 0 bytes) of a (k, 3) array of BGR colors -- trilinear between the
+## 8 lattice nodes around each color, in integers
+def _interpolate(bgr, lut, bits):
+    shift = 8 - bits
+    step = 1 << shift
+    n = (1 << bits) + 1
+    q = np.right_shift(bgr, shift).astype(np.int32)
+    base = (q[:, 0] * n + q[:, 1]) * n + q[:, 2]
+    low = np.bitwise_and(bgr, step - 1).astype(np.uint32)
+    acc = np.zeros((len(bgr), 4), dtype=np.uint32)
+    for db in (0, 1):
+        wb = low[:, 0] if db else step - low[:, 0]
+        for dg in (0, 1):
+            wbg = wb * (low[:, 1] if dg else step - low[:, 1])
+            for dr in (0, 1):
+                w = wbg * (low[:, 2] if dr else step - low[:, 2])
+                acc += np.take(lut, base + ((db * n + dg) * n + dr)).view(np.uint8).reshape(-1, 4) * w[:, None]
+    if shift:
+        acc += 1 << (3 * shift - 1)
+        acc >>= 3 * shift
+    return acc.astype(np.uint8).view(np.uint32).ravel()
+
+
+## corrected copy of a BGR image -- each distinct color of the image is interpolated once, then one lookup per pixel
+def apply_lut(img, lut, bits=LUT_BITS):
+    flat = img.reshape(-1, 3)
+    index = flat[:, 0].astype(np.uint32)
+    index <<= 8
+    index |= flat[:, 1]
+    index <<= 8
+    index |= flat[:, 2]
+    present = np.zeros(1 << 24, dtype=bool)
+    present[index] = True
+    colors = np.flatnonzero(present).astype(np.uint32)
+    bgr = np.stack([colors >> 16, (colors >> 8) & 255, colors & 255], axis=1).astype(np.uint8)
+    table = np.empty(1 << 24, dtype=np.uint32)
+    table[colors] = _interpolate(bgr, lut, bits)
+    bgr0 = np.take(table, index).view(np.uint8).reshape(img.shape[0], img.shape[1], 4)
+    return cv2.cvtColor(bgr0, cv2.COLOR_BGRA2BGR)
+
+
+class ColorCorrection:
+
+    ## target -- photo of the card in the reference colors; cards -- card photos of the sessions to correct
+    ## lut_dir -- directory the compiled tables are kept in between runs, None to compile them every run
+    def __init__(self, target, cards, lut_dir=None, bits=LUT_BITS, metrics=None):
+        if not 1 <= bits <= 8:
+            raise ValueError('LUT bits must be 1-8, not %d' % bits)
+        self.target = str(target)
+        self.lut_dir = lut_dir
+        self.bits = bits
+        self.metrics = metrics if metrics is not None else run_metrics()
+        self._target_hash = file_hash(self.target)
+        self._target_matrix = None
+
+        ## session: card photo -- a later card of a session replaces an earlier one
+        self.cards = {}
+        for card in cards:
+            self.cards[session_key(card, read_exif_datetime(card))] = str(card)
+        self._luts = {}
+        self._lock = threading.Lock()
+        if lut_dir is not None:
+            os.makedirs(lut_dir, exist_ok=True)
+
+    def _lut_path(self, card):
+        key = hashlib.sha1(('%s|%s|%d|%s' % (file_hash(card), self._target_hash, self.bits,
+                                             LUT_FORMAT)).encode()).hexdigest()
+        return os.path.join(self.lut_dir, key + '.npy')
+
+    ## the table of a card photo -- read from the LUT directory, or fitted, compiled and stored there
+    def _compile(self, card):
+        path = self._lut_path(card) if self.lut_dir is not None else None
+        if path is not None and os.path.isfile(path):
+            return np.load(path, mmap_mode='r')
+        if self._target_matrix is None:
+            self._target_matrix = card_matrix(self.target)
+        lut = compile_lut(fit_transformation(card_matrix(card), self._target_matrix), self.bits)
+        self.metrics.inc('color_luts_compiled_total')
+        if path is not None:
+            tmp = '%s.%d.tmp' % (path, os.getpid())
+            with open(tmp, 'wb') as f:
+                np.save(f, lut)
+            os.replace(tmp, path)
+        return lut
+
+    ## the table of a session, None when the session has no card photo
+    def lut(self, session):
+        card = self.cards.get(session)
+        if card is None:
+            return None
+        with self._lock:
+            if card not in self._luts:
+                self._luts[card] = self._compile(card)
+            return self._luts[card]
+
+    ## the corrected photo -- the photo itself when its session has no card
+    def correct(self, raw_img, filepath, dt_og):
+        lut = self.lut(session_key(filepath, dt_og))
+        if lut is None:
+            self.metrics.inc('color_corrections_total', result='no_card')
+            return raw_img
+        self.metrics.inc('color_corrections_total', result='corrected')
+        return apply_lut(raw_img, lut, self.bits)
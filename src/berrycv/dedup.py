@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+dedup.py -- finding repeated and near-duplicate raw photos before they are sampled
+
+A reshot tray or a photo copied into several session folders would otherwise be sampled and
+analyzed once per copy, and its samples counted several times in the population means. Every raw
+photo gets a 64-bit perceptual hash of its grayscale thumbnail (JPEG decoded at 1/8 scale): dHash,
+the signs of the horizontal gradients of a 9x8 thumbnail, or pHash, the signs of the low
+frequencies of the DCT of a 32x32 thumbnail against their median. Photos whose hashes differ in at
+most max_distance bits are near-duplicates when their QR labels (read from the full photos, only
+for these candidates) also agree -- so two trays photographed alike on the photobooth stay apart.
+
+Candidate pairs are found without comparing every pair: the 64 bits are cut into max_distance + 1
+bands, and two hashes within max_distance bits agree on at least one band, so only photos sharing
+a band value are compared. A policy keeps one photo per group of duplicates; the others are
+recorded in the sample manifest with the photo they duplicate and are not sampled.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from pyzbar.pyzbar import decode as decodeQR
+
+from .metrics import run_metrics
+
+
+## bits of a hash that may differ between near-duplicates (reshoots measure 0-8, other trays 16-20)
+MAX_DISTANCE = 6
+
+## photo kept of a group -- the first or last in listing order, or the sharpest (laplacian variance)
+POLICIES = ('first', 'last', 'sharpest')
+
+_HASH_BITS = 64
+
+
+## grayscale thumbnail of a photo, decoded at 1/8 scale -- None when unreadable
+def thumbnail_gray(path):
+    return cv2.imread(path, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+
+
+def _bits(bools):
+    return int(''.join('1' if b else '0' for b in bools), 2)
+
+
+## difference hash -- signs of the horizontal gradients of a 9x8 thumbnail
+def dhash(gray):
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    return _bits((small[:, 1:] > small[:, :-1]).ravel())
+
+
+## perceptual hash -- the 8x8 lowest DCT frequencies of a 32x32 thumbnail against their median (without DC)
+def phash(gray):
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:8, :8].ravel()
+    return _bits(low > np.median(low[1:]))
+
+
+HASHES = {'dhash': dhash, 'phash': phash}
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+_POPCOUNT8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+## pairs (i, j), i < j, of hashes within max_distance bits -- None hashes are left out
+## -- per band the hashes are sorted by the band's value and each is compared to the next ones of the same value
+def near_pairs(hashes, max_distance=MAX_DISTANCE):
+    valid = np.array([i for i, h in enumerate(hashes) if h is not None], dtype=np.int64)
+    if len(valid) < 2:
+        return []
+    values = np.array([hashes[i] for i in valid], dtype=np.uint64)
+    n_bands = max_distance + 1
+    edges = [round(k * _HASH_BITS / float(n_bands)) for k in range(n_bands + 1)]
+    found = []
+    for lo, hi in zip(edges[:-1], edges[1:]):
+        band = (values >> np.uint64(lo)) & np.uint64((1 << (hi - lo)) - 1)
+        order = np.argsort(band, kind='stable')
+        band = band[order]
+        sorted_values = values[order]
+        d = 1
+        while d < len(order):
+            same = np.flatnonzero(band[d:] == band[:-d])
+            if len(same) == 0:
+                break
+            xor = (sorted_values[same] ^ sorted_values[same + d]).view(np.uint8)
+            near = same[_POPCOUNT8[xor].reshape(-1, 8).sum(axis=1) <= max_distance]
+            found.append(np.stack([order[near], order[near + d]], axis=1))
+            d += 1
+    if not found:
+        return []
+    pairs = np.unique(np.sort(np.concatenate(found), axis=1), axis=0)
+    return [(int(valid[i]), int(valid[j])) for i, j in pairs]
+
+
+## QR texts found in the full photo
+def qr_labels(path):
+    img = cv2.imread(path)
+    if img is None:
+        return frozenset()
+    return frozenset(symbol.data for symbol in decodeQR(img))
+
+
+class DuplicateFinder:
+
+    ## max_distance -- hash bits near-duplicates may differ in; method -- 'dhash' or 'phash'
+    ## policy -- photo kept of a group (POLICIES); check_qr -- near-duplicates must also carry the same QR labels
+    def __init__(self, max_distance=MAX_DISTANCE, method='dhash', policy='first', check_qr=True, threads=2,
+                 metrics=None):
+        if method not in HASHES:
+            raise ValueError("Hash '%s' is not one of %s" % (method, ', '.join(sorted(HASHES))))
+        if policy not in POLICIES:
+            raise ValueError("Duplicate policy '%s' is not one of %s" % (policy, ', '.join(POLICIES)))
+        self.max_distance = max_distance
+        self.method = method
+        self.policy = policy
+        self.check_qr = check_qr
+        self.threads = max(1, threads)
+        self.metrics = metrics if metrics is not None else run_metrics()
+
+    ## (hash, sharpness) of a photo, (None, 0) when unreadable
+    def _fingerprint(self, path):
+        gray = thumbnail_gray(path)
+        if gray is None:
+            return None, 0.0
+        return HASHES[self.method](gray), float(cv2.Laplacian(gray, cv2.CV_64F).var())
+
+    ## groups of duplicate photos -- lists of indices into paths, in listing order, each with more than one photo
+    def groups(self, paths, fingerprints):
+        hashes = [f[0] for f in fingerprints]
+        parent = list(range(len(paths)))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        labels = {}
+        for i, j in near_pairs(hashes, self.max_distance):
+            if self.check_qr:
+                for k in (i, j):
+                    if k not in labels:
+                        labels[k] = qr_labels(paths[k])
+                if labels[i] != labels[j]:
+                    continue
+            parent[find(j)] = find(i)
+
+        members = {}
+        for i in range(len(paths)):
+            members.setdefault(find(i), []).append(i)
+        return [m for m in members.values() if len(m) > 1]
+
+    ## (photos to sample in listing order, [(duplicate, kept photo, hash distance)])
+    def select(self, paths):
+        paths = list(paths)
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            fingerprints = list(pool.map(self._fingerprint, paths))
+
+        dropped = {}
+        for group in self.groups(paths, fingerprints):
+            if self.policy == 'first':
+                keep = group[0]
+            elif self.policy == 'last':
+                keep = group[-1]
+            else:
+                keep = max(group, key=lambda i: fingerprints[i][1])
+            for i in group:
+                if i != keep:
+                    dropped[i] = (paths[i], paths[keep], hamming(fingerprints[i][0], fingerprints[keep][0]))
+
+        self.metrics.inc('duplicate_images_total', len(dropped))
+        kept = [p for i, p in enumerate(paths) if i not in dropped]
+        return kept, [dropped[i] for i in sorted(dropped)]
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+imcache.py -- on-disk cache of decoded images for re-running the workflow over the same photos
+
+A decoded image is stored as <sha1 of the file>.npy in the cache directory and read back memory-mapped
+(copy-on-write), so a rerun skips the JPEG decode and worker processes reading the same image share
+its pages through the OS page cache. Entries are written through a temporary file and a rename, so
+processes sharing a cache directory never read half an entry. A hit touches the entry's modification
+time; once the cache grows past its size limit the least recently used entries are removed.
+
+read_image() reads through the cache set with set_image_cache() for the process.
+"""
+import os
+import hashlib
+
+import cv2
+import numpy as np
+
+from .metrics import run_metrics
+
+
+## default size limit of a cache directory in bytes
+CACHE_SIZE = 20 * 1024 ** 3
+
+## bytes read at a time when hashing a file
+_HASH_CHUNK = 1024 * 1024
+
+## extension of the cache entries
+_ENTRY_EXT = '.npy'
+
+
+## sha1 of a file's contents
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ImageCache:
+
+    ## directory -- cache directory, shared by the processes of a run (and by later runs)
+    ## max_bytes -- size limit of the entries, least recently used entries are removed past it
+    def __init__(self, directory, max_bytes=CACHE_SIZE, metrics=None):
+        self.directory = str(directory)
+        self.max_bytes = max_bytes
+        self.metrics = metrics if metrics is not None else run_metrics()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _entry(self, key):
+        return os.path.join(self.directory, key + _ENTRY_EXT)
+
+    ## the decoded BGR image of a file, None when it cannot be decoded -- a copy-on-write memory map on a hit
+    def read(self, path, flip_red_blue=False):
+        try:
+            key = file_hash(path)
+        except OSError:
+            return None
+        entry = self._entry(key)
+        img = None
+        try:
+            img = np.load(entry, mmap_mode='c')
+            os.utime(entry)
+            self.metrics.inc('image_cache_hits_total')
+        except (OSError, ValueError):
+            img = None
+        if img is None:
+            img = cv2.imread(path)
+            if img is None:
+                return None
+            self.metrics.inc('image_cache_misses_total')
+            self.put(key, img)
+        if flip_red_blue:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        return img
+
+    ## stores a decoded image under a key and keeps the cache within its size limit
+    def put(self, key, img):
+        tmp = '%s.%d.tmp' % (self._entry(key), os.getpid())
+        try:
+            with open(tmp, 'wb') as f:
+                np.save(f, np.ascontiguousarray(img))
+            os.replace(tmp, self._entry(key))
+        except OSError as e:
+            print('Unable to cache a decoded image in \'%s\': %s' % (self.directory, e))
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+        self.evict()
+
+    ## (modification time, size, path) of the entries, least recently used first
+    def entries(self):
+        found = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(_ENTRY_EXT):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                found.append((st.st_mtime, st.st_size, entry.path))
+        return sorted(found)
+
+    ## removes the least recently used entries until the cache is within max_bytes -- returns the bytes removed
+    ## -- an entry another process has mapped stays readable to it until unmapped (removal may fail on Windows)
+    def evict(self):
+        if self.max_bytes is None:
+            return 0
+        found = self.entries()
+        total = sum(e[1] for e in found)
+        removed = 0
+        for _mtime, size, path in found:
+            if total - removed <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            removed += size
+            self.metrics.inc('image_cache_evictions_total')
+        return removed
+
+
+_image_cache = None
+
+
+## sets the image cache read_image() reads through in this process -- None to decode every image
+def set_image_cache(cache):
+    global _image_cache
+    _image_cache = cache
+    return cache
+
+
+def image_cache():
+    return _image_cache
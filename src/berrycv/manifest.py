@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+manifest.py -- the sample manifest written by sampling and read by the analysis stage
+
+Sampling appends one JSON line per sample image to <sample dir>/manifest.jsonl: the image path, the
+raw photo, the QR text as read, the object id, the size marker area and the capture timestamp,
+together with the plantcv metadata fields the file name encodes (timestamp, plantbarcode, id,
+imgtype, measurementlabel). The analysis stage builds its job list and metadata from the manifest
+instead of walking the sample directory and splitting every file name on the delimiter -- QR text
+with '_' in it no longer loses the sample, and no directory is listed. Raw photos left out as
+duplicates of another photo (berrycv.dedup) are recorded with the photo they duplicate.
+
+A directory run starts the manifest over; a run on one photo (the per-image plantcv-workflow.py
+path) appends to it, each line written whole under an exclusive lock of the file, so parallel jobs
+neither truncate nor interleave each other's records.
+"""
+import os.path
+import json
+import datetime
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    ## no advisory locks (Windows) -- lines appended with one write are still whole on local disks
+    fcntl = None
+
+
+## name of the manifest in the sample directory
+MANIFEST_NAME = 'manifest.jsonl'
+
+
+## manifest record of one sample image
+## -- the metadata fields hold the same values plantcv's metadata_parser reads from the file name
+def sample_record(path, source, dt_original, qr, plantbarcode, sample_id, img_type, mean_area):
+    return {'path': path, 'source': source, 'qr': str(qr), 'object_id': sample_id,
+            'marker_area': mean_area, 'timestamp': str(dt_original).replace(':', '-'),
+            'plantbarcode': plantbarcode, 'id': str(sample_id), 'imgtype': str(img_type),
+            'measurementlabel': str(mean_area)}
+
+
+## manifest record of a raw photo not sampled as a duplicate of another -- not an analysis job
+def duplicate_record(path, duplicate_of, distance):
+    return {'path': path, 'source': path, 'duplicate_of': duplicate_of, 'hash_distance': distance}
+
+
+## appends records to a manifest from any thread or process -- each line is flushed, so a crashed run keeps its records
+class ManifestWriter:
+
+    ## append -- keep the records of an earlier run (or of other processes), False to start the manifest over
+    def __init__(self, path, append=False):
+        self.path = path
+        self._lock = threading.Lock()
+        self._f = open(path, 'a' if append else 'w')
+        self.records = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def add(self, record):
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            if fcntl is not None:
+                fcntl.flock(self._f.fileno(), fcntl.LOCK_EX)
+            try:
+                self._f.write(line)
+                self._f.flush()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._f.fileno(), fcntl.LOCK_UN)
+            self.records += 1
+
+    def close(self):
+        with self._lock:
+            if not self._f.closed:
+                self._f.close()
+
+
+## records of a manifest in file order -- later records of the same path replace earlier ones
+def read_manifest(path):
+    records = {}
+    with open(path, 'r') as f:
+        for n, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                print('Skipping unreadable line %d of \'%s\'' % (n, path))
+                continue
+            records.pop(record['path'], None)
+            records[record['path']] = record
+    return list(records.values())
+
+
+## path of the manifest of a sample directory, None when sampling wrote none
+def find_manifest(input_dir):
+    path = os.path.join(str(input_dir), MANIFEST_NAME)
+    return path if os.path.isfile(path) else None
+
+
+def _matches(value, filters):
+    if isinstance(filters, list):
+        return value in filters
+    return value == filters
+
+
+def _unixtime(timestamp, date_format):
+    return (datetime.datetime.strptime(timestamp, date_format) - datetime.datetime(1970, 1, 1)).total_seconds()
+
+
+## job metadata of a plantcv workflow configuration from a manifest, in the format of
+## plantcv.parallel.metadata_parser (file name: {'path': ..., <metadata term>: value}) -- applies the
+## metadata filters and date range of the configuration the same way; images no longer on disk are left out
+def manifest_metadata(config, path):
+    start = _unixtime(config.start_date, config.timestampformat) if config.start_date else None
+    end = _unixtime(config.end_date, config.timestampformat) if config.end_date else None
+    ext = '.' + str(config.imgformat).lower()
+
+    meta = {}
+    for record in read_manifest(path):
+        img_path = record['path']
+        if 'duplicate_of' in record:
+            continue
+        if not img_path.lower().endswith(ext) or not os.path.isfile(img_path):
+            continue
+        img_meta = {'path': img_path}
+        for term in config.metadata_terms:
+            img_meta[term] = record.get(term, config.metadata_terms[term]['value'])
+        if any(not _matches(img_meta.get(term), f) for term, f in config.metadata_filters.items()):
+            continue
+        if img_meta.get('timestamp') is not None and (start is not None or end is not None):
+            t = _unixtime(img_meta['timestamp'], config.timestampformat)
+            if (start is not None and t < start) or (end is not None and t > end):
+                continue
+        meta[os.path.basename(img_path)] = img_meta
+    return meta
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+markers.py -- size marker area measurement recorded into a per-sample Results
+
+Replaces pcv.report_size_marker_area(marker='detect', objcolor='dark', thresh_channel='v') over a
+whole-image ROI, which records into the global pcv.outputs.
+"""
+import cv2
+import numpy as np
+
+from .masks import find_objects
+
+
+## method recorded with the marker observations
+MARKER_METHOD = 'berrycv.report_size_marker_area'
+
+
+## measures the dark size markers of a marker-only image (everything else white) and records
+## marker_area and the marker ellipse into results -- returns the marker area in pixels
+## -- raises ValueError when no marker with an ellipse can be found, as the plantcv call fails
+def report_size_marker_area(marker_img, results, thresh=120, label='default'):
+    v = cv2.cvtColor(marker_img, cv2.COLOR_BGR2HSV)[:, :, 2]
+    _ret, marker_bin = cv2.threshold(v, thresh, 255, cv2.THRESH_BINARY_INV)
+
+    ## the whole-image ROI keeps every object, so the markers are the objects of the threshold
+    contours, hierarchy = find_objects(marker_bin)
+    if not contours:
+        raise ValueError('no size marker found')
+    marker_mask = np.zeros(marker_bin.shape, dtype=np.uint8)
+    cv2.drawContours(marker_mask, contours, -1, (255), -1, lineType=8, hierarchy=hierarchy)
+    contours, hierarchy = find_objects(marker_mask)
+
+    ## compose the markers into one object -- holes (childless inner contours) are left out
+    group = [cnt for c, cnt in enumerate(contours)
+             if not (hierarchy[0][c][2] == -1 and hierarchy[0][c][3] > -1)]
+    if not group:
+        raise ValueError('no size marker found')
+    marker_contour = np.vstack(group)
+    if len(marker_contour) < 5:
+        raise ValueError('size marker too small to fit an ellipse')
+
+    marker_area = cv2.moments(marker_mask, binaryImage=True)['m00']
+    _center, axes, _angle = cv2.fitEllipse(marker_contour)
+    major_axis = np.argmax(axes)
+    minor_axis = 1 - major_axis
+    eccentricity = np.sqrt(1 - (axes[minor_axis] / axes[major_axis]) ** 2)
+
+    results.add_observation(sample=label, variable='marker_area', trait='marker area',
+                            method=MARKER_METHOD, scale='pixels', datatype=int,
+                            value=marker_area, label='pixels')
+    results.add_observation(sample=label, variable='marker_ellipse_major_axis',
+                            trait='marker ellipse major axis length',
+                            method=MARKER_METHOD, scale='pixels', datatype=int,
+                            value=float(axes[major_axis]), label='pixels')
+    results.add_observation(sample=label, variable='marker_ellipse_minor_axis',
+                            trait='marker ellipse minor axis length',
+                            method=MARKER_METHOD, scale='pixels', datatype=int,
+                            value=float(axes[minor_axis]), label='pixels')
+    results.add_observation(sample=label, variable='marker_ellipse_eccentricity', trait='marker ellipse eccentricity',
+                            method=MARKER_METHOD, scale='none', datatype=float,
+                            value=float(eccentricity), label='none')
+    return marker_area
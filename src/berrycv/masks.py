@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+masks.py -- mask, object and ROI routines writing into reusable buffers
+
+Drop-in equivalents of the plantcv calls used by the workflows (same results), which take a
+dst= array or a BufferPool instead of allocating full-frame copies for every call.
+"""
+import cv2
+import numpy as np
+
+from .buffers import out_buffer
+
+
+## median filter with a reflected border -- matches pcv.median_blur (scipy median_filter, mode 'reflect')
+def median_blur(gray_img, ksize, dst=None, pool=None):
+    h, w = gray_img.shape[:2]
+    r = ksize // 2
+    padded = out_buffer((h + 2 * r, w + 2 * r), gray_img.dtype, pool=pool)
+    blurred = out_buffer((h + 2 * r, w + 2 * r), gray_img.dtype, pool=pool)
+    cv2.copyMakeBorder(gray_img, r, r, r, r, cv2.BORDER_REFLECT, dst=padded)
+    cv2.medianBlur(padded, ksize, dst=blurred)
+    dst = out_buffer((h, w), gray_img.dtype, dst=dst, pool=pool)
+    np.copyto(dst, blurred[r:r + h, r:r + w])
+    if pool is not None:
+        pool.release(padded, blurred)
+    return dst
+
+
+## removes objects smaller than size pixels (4-connected) -- matches pcv.fill
+def fill(bin_img, size, dst=None, pool=None):
+    labels = out_buffer(bin_img.shape[:2], np.int32, pool=pool)
+    n, labels, stats, _c = cv2.connectedComponentsWithStats(bin_img, labels=labels, connectivity=4, ltype=cv2.CV_32S)
+    lut = np.where(stats[:, cv2.CC_STAT_AREA] >= size, 255, 0).astype(np.uint8)
+    lut[0] = 0
+    dst = out_buffer(bin_img.shape[:2], np.uint8, dst=dst, pool=pool)
+    np.take(lut, labels, out=dst, mode='clip')
+    if pool is not None:
+        pool.release(labels)
+    return dst
+
+
+## bitwise helpers -- dst may be one of the inputs
+def logical_and(bin_img1, bin_img2, dst=None, pool=None):
+    dst = out_buffer(bin_img1.shape, bin_img1.dtype, dst=dst, pool=pool)
+    return cv2.bitwise_and(bin_img1, bin_img2, dst=dst)
+
+def logical_or(bin_img1, bin_img2, dst=None, pool=None):
+    dst = out_buffer(bin_img1.shape, bin_img1.dtype, dst=dst, pool=pool)
+    return cv2.bitwise_or(bin_img1, bin_img2, dst=dst)
+
+def invert(gray_img, dst=None, pool=None):
+    dst = out_buffer(gray_img.shape, gray_img.dtype, dst=dst, pool=pool)
+    return cv2.bitwise_not(gray_img, dst=dst)
+
+
+## sets the pixels outside of the mask to white or black -- matches pcv.apply_mask
+def apply_mask(img, mask, mask_color='white', dst=None, pool=None):
+    color_val = 255 if mask_color.upper() == 'WHITE' else 0
+    dst = out_buffer(img.shape, img.dtype, dst=dst, pool=pool)
+    dst.fill(color_val)
+    cv2.bitwise_and(img, img, dst=dst, mask=mask)
+    return dst
+
+
+## returns a binary mask of the image for use in object detection
+## -- the same steps as the workflows' generate_mask, computed in pooled buffers
+def generate_mask(img, fill_size=1000, pool=None):
+    h, w = img.shape[:2]
+    cspace = out_buffer((h, w, 3), np.uint8, pool=pool)
+    s = out_buffer((h, w), np.uint8, pool=pool)
+    l = out_buffer((h, w), np.uint8, pool=pool)
+
+    ## first isolate the saturation channel, threshold it
+    ## -- pcv.threshold.triangle passes THRESH_OTSU to opencv, so its result is the otsu threshold
+    cv2.cvtColor(img, cv2.COLOR_BGR2HSV, dst=cspace)
+    cv2.extractChannel(cspace, 1, dst=s)
+    cv2.threshold(s, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU, dst=s)
+
+    ## then isolate the lightness channel, threshold it
+    cv2.cvtColor(img, cv2.COLOR_BGR2LAB, dst=cspace)
+    cv2.extractChannel(cspace, 0, dst=l)
+    cv2.threshold(l, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU, dst=l)
+
+    ## blur the saturation and lightness image to soften small features
+    median_blur(s, 5, dst=s, pool=pool)
+    median_blur(l, 5, dst=l, pool=pool)
+
+    ## 'logical or' the images to create a joined binary image
+    ls = logical_or(s, l, dst=s)
+
+    ## pass a filled image back after logical-or joining the inverted fill
+    ls_fill = fill(ls, fill_size, pool=pool)
+    ls_fill_inv = fill(invert(ls_fill, dst=l), fill_size, dst=l, pool=pool)
+    ls_or_final = logical_or(invert(ls_fill_inv, dst=l), ls_fill, dst=ls_fill)
+
+    if pool is not None:
+        pool.release(cspace, s, l)
+    return ls_or_final
+
+
+## identifies objects in a mask -- matches pcv.find_objects without the full-frame copies
+def find_objects(mask):
+    objects, hierarchy = cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)[-2:]
+    return list(objects), hierarchy
+
+
+## rectangle ROI contour and hierarchy -- matches pcv.roi.rectangle without drawing the debug copy of the image
+def roi_rectangle(x, y, h, w):
+    roi_contour = [np.array([[[x, y]], [[x, y + h - 1]], [[x + w - 1, y + h - 1]], [[x + w - 1, y]]], dtype=np.int32)]
+    roi_hierarchy = np.array([[[-1, -1, -1, -1]]], dtype=np.int32)
+    return roi_contour, roi_hierarchy
+
+
+## keeps the objects partially inside a rectangle ROI -- matches pcv.roi.rectangle + pcv.roi_objects(roi_type='partial')
+## -- each object is rasterized only over its bounding box to test the overlap
+def roi_objects(img_shape, x, y, h, w, object_contour, obj_hierarchy, pool=None):
+    mask = out_buffer(img_shape[:2], np.uint8, pool=pool)
+    mask.fill(0)
+    cv2.drawContours(mask, object_contour, -1, (255), -1, lineType=8, hierarchy=obj_hierarchy)
+
+    ## the rectangle ROI covers pixels x..x+w-1, y..y+h-1
+    rx1, ry1 = x + w - 1, y + h - 1
+    for c, cnt in enumerate(object_contour):
+        bx, by, bw, bh = cv2.boundingRect(cnt)
+        ix0, iy0 = max(bx, x), max(by, y)
+        ix1, iy1 = min(bx + bw - 1, rx1), min(by + bh - 1, ry1)
+        overlap = False
+        if ix0 <= ix1 and iy0 <= iy1:
+            filtering_mask = np.zeros((bh, bw), dtype=np.uint8)
+            cv2.fillPoly(filtering_mask, [np.vstack(cnt)], (255), offset=(-bx, -by))
+            overlap = cv2.countNonZero(filtering_mask[iy0 - by:iy1 - by + 1, ix0 - bx:ix1 - bx + 1]) > 0
+        if not overlap:
+            cv2.drawContours(mask, object_contour, c, (0), -1, lineType=8, hierarchy=obj_hierarchy)
+
+    kept_cnt, kept_hierarchy = cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)[-2:]
+    obj_area = cv2.countNonZero(mask)
+    return kept_cnt, kept_hierarchy, mask, obj_area
+
+
+## crops an image around an object -- matches pcv.auto_crop, copying only the cropped region
+def auto_crop(img, obj, padding_x=0, padding_y=0, color='black'):
+    height, width = np.shape(img)[:2]
+    x, y, w, h = cv2.boundingRect(obj)
+
+    if color.upper() == 'IMAGE':
+        if x - padding_x < 0 or y - padding_y < 0 or x + w + padding_x > width or y + h + padding_y > height:
+            return img[y:y + h, x:x + w].copy()
+        return img[y - padding_y:y + h + padding_y, x - padding_x:x + w + padding_x].copy()
+
+    colorval = (255, 255, 255) if color.upper() == 'WHITE' else (0, 0, 0)
+    return cv2.copyMakeBorder(img[y:y + h, x:x + w], padding_y, padding_y, padding_x, padding_x,
+                              cv2.BORDER_CONSTANT, value=colorval)
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+"""
+metrics.py -- run-level counters, stage latencies and progress of a workflow run
+
+The sampling engine and the analysis scheduler record into the process-wide run_metrics(); the
+sampling jobs save theirs for the process which ran them to merge (scheduler.py). A
+MetricsReporter thread renders them every few seconds into a Prometheus textfile-collector file
+(written atomically, so node_exporter never reads half a file) and a progress line on the terminal.
+
+    berrycv_images_total, berrycv_samples_total            -- raw photos sampled, sample images written
+    berrycv_images_per_second, berrycv_samples_per_second  -- over the last RATE_WINDOW seconds
+    berrycv_queue_depth{queue}                             -- pending sample writes / analysis jobs
+    berrycv_stage_latency_seconds{stage}                   -- summary: p50, p95, _sum and _count (mean = _sum / _count)
+    berrycv_qr_reads_total, berrycv_qr_failures_total, berrycv_qr_failure_ratio
+    berrycv_marker_retries_total                           -- marker bands re-tried with a larger band
+    berrycv_marker_calibration_hits_total, _misses_total   -- photos checked against their session calibration
+    berrycv_image_cache_hits_total, _misses_total, _evictions_total  -- decoded-image cache (imcache.py)
+    berrycv_objects_rejected_total{reason}                 -- objects dropped before cropping (objfilter.py)
+    berrycv_duplicate_images_total                         -- raw photos skipped as duplicates of another (dedup.py)
+    berrycv_color_corrections_total{result}                -- photos corrected, or left without a session card (colorcorr.py)
+    berrycv_color_luts_compiled_total                      -- color correction tables fitted and compiled
+    berrycv_video_frames_total{result}                     -- conveyor video frames tracked, empty or skipped as still (video.py)
+    berrycv_tracks_total{result}                           -- berries tracked through a video: sampled, label card, empty
+    berrycv_error_images_total{reason}                     -- images sent to the error directory (qc, markers, unassigned, sampling, analysis)
+    berrycv_sampling_jobs_total{status}, berrycv_analysis_jobs_total{status}  -- succeeded, retried, failed
+    berrycv_analysis_workers, berrycv_analysis_threads_per_worker  -- the split of the thread budget (threads.py)
+    berrycv_progress_done, berrycv_progress_total, berrycv_eta_seconds  -- of the current phase
+"""
+import os.path
+import sys
+import json
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+
+## seconds over which the images/s and samples/s gauges are computed
+RATE_WINDOW = 60.0
+
+## latencies kept per stage for the quantiles
+LATENCY_WINDOW = 1000
+
+## seconds between textfile writes and progress line updates
+REPORT_INTERVAL = 2.0
+
+## metric name prefix
+PREFIX = 'berrycv_'
+
+## type and help text of the counters and gauges
+_METRICS = {
+    'images_total': ('counter', 'Raw photos taken through sampling.'),
+    'samples_total': ('counter', 'Sample images written by sampling.'),
+    'qr_reads_total': ('counter', 'Raw photos whose QR label was looked for.'),
+    'qr_failures_total': ('counter', 'Raw photos without a readable QR label (named from the file instead).'),
+    'marker_retries_total': ('counter', 'Size marker detections re-tried with a larger marker band.'),
+    'marker_calibration_hits_total': ('counter', 'Photos whose size markers passed the check of their session calibration.'),
+    'marker_calibration_misses_total': ('counter', 'Photos whose size markers failed the check and were measured again.'),
+    'image_cache_hits_total': ('counter', 'Images read from the decoded-image cache.'),
+    'image_cache_misses_total': ('counter', 'Images decoded and added to the decoded-image cache.'),
+    'image_cache_evictions_total': ('counter', 'Least recently used entries removed from the decoded-image cache.'),
+    'objects_rejected_total': ('counter', 'Objects dropped by the object filter before cropping, by reason.'),
+    'duplicate_images_total': ('counter', 'Raw photos not sampled as repeats or near-duplicates of another photo.'),
+    'color_corrections_total': ('counter', 'Raw photos color corrected, or left without a card of their session.'),
+    'color_luts_compiled_total': ('counter', 'Color correction tables fitted from a session card and compiled.'),
+    'video_frames_total': ('counter', 'Conveyor video frames tracked, found empty, or skipped as repeats of the last one.'),
+    'tracks_total': ('counter', 'Objects tracked through a conveyor video, by what was written of them.'),
+    'error_images_total': ('counter', 'Images sent to the error directory.'),
+    'sampling_jobs_total': ('counter', 'Finished sampling job attempts by outcome.'),
+    'analysis_jobs_total': ('counter', 'Finished analysis job attempts by outcome.'),
+    'queue_depth': ('gauge', 'Items waiting in a queue of the run.'),
+    'analysis_workers': ('gauge', 'Analysis worker processes run at a time.'),
+    'analysis_threads_per_worker': ('gauge', 'Threads of the native libraries in each analysis worker.'),
+}
+
+
+## quantile q of a sorted list
+def _quantile(values, q):
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in sorted(labels.items()))
+
+
+class RunMetrics:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.start = time.time()
+        self._counters = {}
+        self._gauges = {}
+        self._stages = {}
+        self._events = {'images_total': deque(), 'samples_total': deque()}
+        self.phase = None
+        self.phase_start = self.start
+        self.done = 0
+        self.total = None
+
+    ## adds n to a counter
+    def inc(self, name, n=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        now = time.time()
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + n
+            if name in self._events:
+                self._events[name].append((now, n))
+
+    ## sets a gauge
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def counter(self, name, **labels):
+        return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    ## records one latency of a stage in seconds
+    def observe(self, stage, seconds):
+        with self._lock:
+            stats = self._stages.setdefault(stage, [0, 0.0, deque(maxlen=LATENCY_WINDOW)])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2].append(seconds)
+
+    ## writes the counters and stage latencies to a JSON file, for the process which ran this one as a job to merge
+    def save(self, path):
+        with self._lock:
+            state = {'counters': [[name, dict(labels), n] for (name, labels), n in self._counters.items()],
+                     'stages': dict((stage, [count, total, list(recent)])
+                                    for stage, (count, total, recent) in self._stages.items())}
+        with open(path, 'w') as f:
+            json.dump(state, f)
+
+    ## adds the counters and stage latencies saved by a job
+    def merge(self, path):
+        with open(path, 'r') as f:
+            state = json.load(f)
+        for name, labels, n in state['counters']:
+            self.inc(name, n, **labels)
+        with self._lock:
+            for stage, (count, total, recent) in state['stages'].items():
+                stats = self._stages.setdefault(stage, [0, 0.0, deque(maxlen=LATENCY_WINDOW)])
+                stats[0] += count
+                stats[1] += total
+                stats[2].extend(recent)
+
+    ## times the enclosed block as one latency of a stage
+    @contextmanager
+    def time(self, stage):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - t)
+
+    ## starts a phase of the run (sampling, analysis) of total items
+    def begin(self, phase, total=None):
+        with self._lock:
+            self.phase = phase
+            self.phase_start = time.time()
+            self.done = 0
+            self.total = total
+
+    ## marks n items of the current phase as done
+    def advance(self, n=1):
+        with self._lock:
+            self.done += n
+
+    ## events per second of a counter over the last RATE_WINDOW seconds (or the run so far, if shorter)
+    def rate(self, name, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            events = self._events[name]
+            while events and events[0][0] < now - RATE_WINDOW:
+                events.popleft()
+            n = sum(e[1] for e in events)
+        span = min(RATE_WINDOW, now - self.start)
+        return n / span if span > 0 else 0.0
+
+    ## (mean, p95, count) latency of a stage
+    def stage_stats(self, stage):
+        with self._lock:
+            count, total, recent = self._stages[stage]
+            values = sorted(recent)
+        return total / count, _quantile(values, 0.95), count
+
+    ## seconds until the current phase is done at its rate so far, None when unknown
+    def eta(self, now=None):
+        now = time.time() if now is None else now
+        if not self.total or not self.done:
+            return None
+        return (now - self.phase_start) / self.done * (self.total - self.done)
+
+    ## the metrics in the Prometheus text exposition format
+    def render(self):
+        now = time.time()
+        lines = []
+
+        def family(name, kind, text):
+            lines.append('# HELP %s%s %s' % (PREFIX, name, text))
+            lines.append('# TYPE %s%s %s' % (PREFIX, name, kind))
+
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            stages = dict((stage, (count, total, sorted(recent)))
+                          for stage, (count, total, recent) in self._stages.items())
+        for name, (kind, text) in _METRICS.items():
+            series = [(dict(k[1]), v) for k, v in (counters if kind == 'counter' else gauges).items() if k[0] == name]
+            if not series and kind == 'counter' and name in ('images_total', 'samples_total'):
+                series = [({}, 0)]
+            if not series:
+                continue
+            family(name, kind, text)
+            for labels, value in series:
+                lines.append('%s%s%s %s' % (PREFIX, name, _labels(labels), value))
+
+        family('images_per_second', 'gauge', 'Raw photos sampled per second over the last %g s.' % RATE_WINDOW)
+        lines.append('%simages_per_second %.6g' % (PREFIX, self.rate('images_total', now)))
+        family('samples_per_second', 'gauge', 'Sample images written per second over the last %g s.' % RATE_WINDOW)
+        lines.append('%ssamples_per_second %.6g' % (PREFIX, self.rate('samples_total', now)))
+
+        reads = self.counter('qr_reads_total')
+        family('qr_failure_ratio', 'gauge', 'Share of raw photos without a readable QR label.')
+        lines.append('%sqr_failure_ratio %.6g' % (PREFIX, self.counter('qr_failures_total') / reads if reads else 0.0))
+
+        if stages:
+            family('stage_latency_seconds', 'summary', 'Latency of the workflow stages.')
+            for stage in sorted(stages):
+                count, total, values = stages[stage]
+                for q in (0.5, 0.95):
+                    lines.append('%sstage_latency_seconds%s %.6g' %
+                                 (PREFIX, _labels({'stage': stage, 'quantile': q}), _quantile(values, q)))
+                lines.append('%sstage_latency_seconds_sum%s %.6g' % (PREFIX, _labels({'stage': stage}), total))
+                lines.append('%sstage_latency_seconds_count%s %d' % (PREFIX, _labels({'stage': stage}), count))
+
+        if self.phase is not None:
+            phase = {'phase': self.phase}
+            family('progress_done', 'gauge', 'Items of the current phase done.')
+            lines.append('%sprogress_done%s %d' % (PREFIX, _labels(phase), self.done))
+            if self.total is not None:
+                family('progress_total', 'gauge', 'Items of the current phase.')
+                lines.append('%sprogress_total%s %d' % (PREFIX, _labels(phase), self.total))
+            eta = self.eta(now)
+            if eta is not None:
+                family('eta_seconds', 'gauge', 'Estimated seconds until the current phase is done.')
+                lines.append('%seta_seconds%s %.1f' % (PREFIX, _labels(phase), eta))
+
+        family('last_update_timestamp_seconds', 'gauge', 'Time these metrics were written.')
+        lines.append('%slast_update_timestamp_seconds %.3f' % (PREFIX, now))
+        return '\n'.join(lines) + '\n'
+
+    ## writes render() to a textfile-collector file -- through a temporary file and a rename
+    def write_textfile(self, path):
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+    ## one-line progress summary of the current phase
+    def progress_line(self):
+        if self.phase is None:
+            return ''
+        now = time.time()
+        done = '%d/%d' % (self.done, self.total) if self.total is not None else '%d' % self.done
+        line = '[%s] %s  %.2f img/s  %d samples  %.2f samples/s' % (
+            self.phase, done, self.rate('images_total', now), self.counter('samples_total'),
+            self.rate('samples_total', now))
+        with self._lock:
+            errors = sum(v for k, v in self._counters.items() if k[0] == 'error_images_total')
+        if errors:
+            line += '  %d errors' % errors
+        eta = self.eta(now)
+        if eta is not None:
+            line += '  ETA %d:%02d' % divmod(int(eta), 60)
+        return line
+
+
+_run_metrics = RunMetrics()
+
+
+## the metrics of this process's run
+def run_metrics():
+    return _run_metrics
+
+
+## background thread updating the textfile and the terminal progress line every interval seconds
+## -- the progress line is only drawn when the stream is a terminal
+class MetricsReporter:
+
+    def __init__(self, metrics=None, path=None, interval=REPORT_INTERVAL, stream=None):
+        self.metrics = metrics if metrics is not None else run_metrics()
+        self.path = path
+        self.interval = interval
+        self.stream = stream if stream is not None else sys.stderr
+        self._stop = threading.Event()
+        self._thread = None
+        self._width = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        return False
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='bcv-metrics', daemon=True)
+        self._thread.start()
+
+    ## stops the thread and writes the final metrics
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.report()
+        if self._width:
+            self.stream.write('\n')
+            self.stream.flush()
+
+    def report(self):
+        if self.path is not None:
+            try:
+                self.metrics.write_textfile(self.path)
+            except OSError as e:
+                print('Unable to write metrics to \'%s\': %s' % (self.path, e))
+        if self.stream.isatty():
+            line = self.metrics.progress_line()
+            self.stream.write('\r' + line.ljust(self._width))
+            self.stream.flush()
+            self._width = len(line)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.report()
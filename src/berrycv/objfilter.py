@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+objfilter.py -- rejecting dust, specks and fragments before they are cropped into sample images
+
+Every object of a photo is measured in one cv2.connectedComponentsWithStats pass over the mask: pixel
+area, bounding box aspect ratio (long side / short side) and contact with the image border are
+compared for all objects at once. Only the objects passing those are measured for solidity (contour
+area / convex hull area). Each object is rejected for the first limit it fails; the counts per
+reason go to the run metrics and to object_filter.csv in the error directory.
+"""
+import os.path
+import csv
+
+import cv2
+import numpy as np
+
+
+## name of the object filter log written to the error directory
+OBJECT_LOG_NAME = 'object_filter.csv'
+
+## reasons in the order they are checked
+REJECT_REASONS = ('small', 'large', 'elongated', 'border', 'not_solid')
+
+_OBJECT_LOG_FIELDS = ['image', 'objects', 'kept'] + list(REJECT_REASONS)
+
+
+class ObjectFilter:
+
+    ## limits -- None (False for reject_border) leaves a limit out
+    ## min_area, max_area -- object pixels; max_aspect -- bounding box long side / short side;
+    ## min_solidity -- contour area / convex hull area; reject_border -- drop objects touching the image edge
+    def __init__(self, min_area=None, max_area=None, max_aspect=None, min_solidity=None, reject_border=False):
+        self.min_area = min_area
+        self.max_area = max_area
+        self.max_aspect = max_aspect
+        self.min_solidity = min_solidity
+        self.reject_border = reject_border
+
+    ## filter from a dict of limits (the object_filter key of the sampling configuration), None when it sets none
+    @classmethod
+    def from_config(cls, limits):
+        if not limits:
+            return None
+        unknown = sorted(set(limits) - set(('min_area', 'max_area', 'max_aspect', 'min_solidity', 'reject_border')))
+        if unknown:
+            raise ValueError('Unknown object filter limits %s' % unknown)
+        return cls(**limits)
+
+    ## reason each object is rejected for, '' for the kept ones -- objects are contours of mask
+    def reasons(self, mask, objects):
+        n_objects = len(objects)
+        if n_objects == 0:
+            return []
+        _n, labels, stats, _c = cv2.connectedComponentsWithStats(mask, connectivity=8)
+
+        ## component of each contour -- the points of a contour lie on its object's pixels
+        first = np.array([c[0, 0] for c in objects], dtype=np.intp)
+        s = stats[labels[first[:, 1], first[:, 0]]]
+        area = s[:, cv2.CC_STAT_AREA]
+        left, top = s[:, cv2.CC_STAT_LEFT], s[:, cv2.CC_STAT_TOP]
+        w, h = s[:, cv2.CC_STAT_WIDTH], s[:, cv2.CC_STAT_HEIGHT]
+
+        failed = np.zeros((len(REJECT_REASONS) - 1, n_objects), dtype=bool)
+        if self.min_area is not None:
+            failed[0] = area < self.min_area
+        if self.max_area is not None:
+            failed[1] = area > self.max_area
+        if self.max_aspect is not None:
+            failed[2] = np.maximum(w, h) > self.max_aspect * np.minimum(w, h)
+        if self.reject_border:
+            failed[3] = (left == 0) | (top == 0) | (left + w >= mask.shape[1]) | (top + h >= mask.shape[0])
+
+        ## first failed limit of each object
+        reasons = np.where(failed.any(axis=0), np.array(REJECT_REASONS[:-1], dtype=object)[failed.argmax(axis=0)], '')
+
+        ## solidity of the remaining objects only -- the convex hull is per contour
+        if self.min_solidity is not None:
+            for i in np.flatnonzero(reasons == ''):
+                hull_area = cv2.contourArea(cv2.convexHull(objects[i]))
+                if hull_area > 0 and cv2.contourArea(objects[i]) < self.min_solidity * hull_area:
+                    reasons[i] = 'not_solid'
+        return list(reasons)
+
+    ## (kept objects in their order, rejected count per reason)
+    def apply(self, mask, objects):
+        reasons = self.reasons(mask, objects)
+        kept = [o for o, r in zip(objects, reasons) if r == '']
+        counts = dict((r, reasons.count(r)) for r in REJECT_REASONS)
+        return kept, counts
+
+
+## appends the object filter counts of a photo to the log in the error directory
+def log_objects(filepath, n_objects, n_kept, counts, error_dir):
+    log_path = os.path.join(error_dir, OBJECT_LOG_NAME)
+    row = dict(counts, image=filepath, objects=n_objects, kept=n_kept)
+    new = not os.path.exists(log_path)
+    with open(log_path, 'a', newline='') as f:
+        w = csv.DictWriter(f, fieldnames=_OBJECT_LOG_FIELDS)
+        if new:
+            w.writeheader()
+        w.writerow(row)
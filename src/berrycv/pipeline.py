@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+pipeline.py -- overlapped image I/O around the workflow compute stages
+
+    prefetch_images -- decodes the next images on I/O threads while the current one is processed
+    ImageWriter     -- bounded background queue for crop and result image writes
+"""
+import threading
+import queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+from .utils import read_image, read_exif_datetime
+
+
+## default number of decoded images held ahead of the compute thread
+PREFETCH_DEPTH = 2
+
+## default number of pending writes before write() blocks the compute thread
+WRITE_QUEUE_SIZE = 32
+
+
+## decodes an image and its capture datetime -- runs on an I/O thread
+def _load(path, flip_red_blue):
+    img = read_image(path, flip_red_blue=flip_red_blue)
+    dt = read_exif_datetime(path)
+    return path, img, dt
+
+
+## yields (path, img, datetime) in input order, keeping at most 'depth' decoded images in flight
+## -- the next images are read while the caller works on the current one; memory stays bounded
+##    because a new decode is only submitted once the caller has taken an image off the front
+def prefetch_images(paths, depth=PREFETCH_DEPTH, threads=2, flip_red_blue=False):
+    depth = max(1, int(depth))
+    paths = iter(paths)
+    pending = deque()
+
+    with ThreadPoolExecutor(max_workers=max(1, int(threads)), thread_name_prefix='bcv-read') as pool:
+        ## fill the window
+        for p in paths:
+            pending.append(pool.submit(_load, p, flip_red_blue))
+            if len(pending) >= depth:
+                break
+
+        while pending:
+            path, img, dt = pending.popleft().result()
+
+            ## top the window back up before handing the image over
+            for p in paths:
+                pending.append(pool.submit(_load, p, flip_red_blue))
+                break
+
+            yield path, img, dt
+
+
+## background image writer with a bounded queue -- write() blocks when the queue is full (backpressure)
+## -- arrays passed to write() are owned by the writer from then on and must not be modified by the caller
+class ImageWriter:
+
+    def __init__(self, maxsize=WRITE_QUEUE_SIZE, threads=1):
+        self._queue = queue.Queue(maxsize=max(1, int(maxsize)))
+        self._errors = []
+        self._threads = []
+        self._lock = threading.Lock()
+        self.written = 0
+        for i in range(max(1, int(threads))):
+            t = threading.Thread(target=self._run, name='bcv-write-%d' % i, daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    ## worker loop -- a None item stops the thread
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                path, img, params = item
+                if not cv2.imwrite(path, img, params):
+                    self._errors.append(path)
+                    print('Unable to write \'%s\'\n' % path)
+                else:
+                    with self._lock:
+                        self.written += 1
+            except Exception as e:
+                self._errors.append(path)
+                print('Unable to write \'%s\': %s\n' % (path, e))
+            finally:
+                self._queue.task_done()
+
+    ## queues an image for writing, same arguments as cv2.imwrite
+    def write(self, path, img, params=()):
+        if not self._threads:
+            raise RuntimeError('ImageWriter is closed')
+        self._queue.put((path, img, list(params)))
+
+    ## number of writes currently waiting in the queue
+    def pending(self):
+        return self._queue.qsize()
+
+    ## paths which could not be written
+    def errors(self):
+        return list(self._errors)
+
+    ## blocks until every queued write is on disk
+    def flush(self):
+        self._queue.join()
+
+    ## flushes the queue and stops the writer threads
+    def close(self):
+        if not self._threads:
+            return
+        for _t in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
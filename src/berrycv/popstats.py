@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+popstats.py -- mergeable per-plantbarcode population statistics of the sample traits
+
+For every plantbarcode and trait the count, mean and M2 (sum of squared deviations from the mean)
+of the per-sample values are kept -- the color means of the *_frequencies histograms (the values
+mv_means.py computes) and every numeric single-value trait. Every sample image is one observation.
+The state of a run is a small JSON sidecar; the states of runs, days or nodes combine exactly with
+the parallel Welford update of Chan et al. in O(barcodes x traits), without reading any CSV again:
+
+    n = na + nb    delta = mean_b - mean_a    mean = mean_a + delta * nb / n    M2 = M2a + M2b + delta^2 * na * nb / n
+
+A state lists the result files it was built from, so merging the same run twice is refused.
+"""
+import os
+import csv
+import json
+import math
+import hashlib
+
+
+## sidecar format version
+STATS_VERSION = 1
+
+## name of the sidecar of a run next to its result files
+STATS_SUFFIX = '_stats.json'
+
+
+## (count, mean, M2) of two merged states
+def combine(a, b):
+    na, ma, m2a = a
+    nb, mb, m2b = b
+    if na == 0:
+        return [nb, mb, m2b]
+    if nb == 0:
+        return [na, ma, m2a]
+    n = na + nb
+    delta = mb - ma
+    return [n, ma + delta * nb / n, m2a + m2b + delta * delta * na * nb / n]
+
+
+## mean of a *_frequencies histogram on its label scale -- percentages times label values, as mv_means.py
+def histogram_mean(values, labels):
+    return sum((float(v) / 100.0) * float(l) for v, l in zip(values, labels))
+
+
+## per-sample trait values of an observation dict -- histogram means and numeric single values
+def trait_values(observations):
+    values = {}
+    for variable, obs in observations.items():
+        value = obs['value']
+        if variable.endswith('_frequencies') and isinstance(value, list) and isinstance(obs.get('label'), list):
+            values[variable] = histogram_mean(value, obs['label'])
+        elif isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value):
+            values[variable] = float(value)
+    return values
+
+
+def _file_id(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class PopulationStats:
+
+    def __init__(self):
+        ## group (plantbarcode): trait: [count, mean, M2]
+        self.groups = {}
+        ## ids (sha1) of the result files the statistics were built from
+        self.sources = []
+
+    ## adds one observation -- Welford's update
+    def add(self, group, trait, value):
+        state = self.groups.setdefault(group, {}).setdefault(trait, [0, 0.0, 0.0])
+        state[0] += 1
+        delta = value - state[1]
+        state[1] += delta / state[0]
+        state[2] += delta * (value - state[1])
+
+    ## merges the statistics of another run into these -- raises ValueError when they share a result file
+    def merge(self, other):
+        shared = set(self.sources) & set(other.sources)
+        if shared:
+            raise ValueError('Statistics already include %d of the merged result files' % len(shared))
+        for group, traits in other.groups.items():
+            mine = self.groups.setdefault(group, {})
+            for trait, state in traits.items():
+                mine[trait] = combine(mine.get(trait, [0, 0.0, 0.0]), state)
+        self.sources.extend(other.sources)
+        return self
+
+    ## statistics of a plantcv workflow result JSON -- grouped by plantbarcode, and by parameter set in a sweep
+    @classmethod
+    def from_results(cls, json_file):
+        stats = cls()
+        with open(json_file, 'r') as f:
+            data = json.load(f)
+        for entity in data['entities']:
+            barcode = str(entity['metadata'].get('plantbarcode', {}).get('value'))
+            for observations in entity['observations'].values():
+                group = barcode
+                if 'parameter_set' in observations:
+                    group = '%s|%s' % (barcode, observations['parameter_set']['value'])
+                for trait, value in trait_values(observations).items():
+                    stats.add(group, trait, value)
+        stats.sources.append(_file_id(json_file))
+        return stats
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            data = json.load(f)
+        if data.get('version') != STATS_VERSION:
+            raise ValueError('%s is not a version %d statistics file' % (path, STATS_VERSION))
+        stats = cls()
+        stats.groups = data['groups']
+        stats.sources = data['sources']
+        return stats
+
+    ## writes the sidecar -- through a temporary file and a rename
+    def save(self, path):
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'version': STATS_VERSION, 'sources': self.sources, 'groups': self.groups}, f,
+                      separators=(',', ':'))
+        os.replace(tmp, path)
+
+    ## (group, trait, count, mean, sample standard deviation) of every trait, sorted
+    def summary(self):
+        rows = []
+        for group in sorted(self.groups):
+            for trait in sorted(self.groups[group]):
+                n, mean, m2 = self.groups[group][trait]
+                rows.append((group, trait, n, mean, math.sqrt(m2 / (n - 1)) if n > 1 else float('nan')))
+        return rows
+
+    def write_csv(self, path):
+        with open(path, 'w', newline='') as f:
+            w = csv.writer(f)
+            w.writerow(['plantbarcode', 'trait', 'count', 'mean', 'std'])
+            w.writerows(self.summary())
+
+
+## merges statistics files into one -- the output may be one of the inputs (a season file updated by a day)
+def merge_stats_files(paths, out_path):
+    merged = PopulationStats()
+    for path in paths:
+        merged.merge(PopulationStats.load(path))
+    merged.save(out_path)
+    return merged
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+qc.py -- fast pre-flight quality check of raw photos on a thumbnail
+
+Photos which cannot produce samples (blank frames, heavy blur, no tray, no size markers) are
+rejected before the full sampling path runs, borderline photos are flagged and still processed.
+"""
+import os.path
+import csv
+
+import cv2
+import numpy as np
+
+
+## thumbnail width used for every check
+QC_THUMB_WIDTH = 640
+
+## laplacian variance of the thumbnail -- below reject is hopeless, below flag is borderline
+## (sharp photobooth frames measure ~500, a 60px motion smear ~50, an out of focus frame < 10)
+SHARPNESS_REJECT = 20.0
+SHARPNESS_FLAG = 100.0
+
+## fraction of the sample region covered by objects -- below reject there is no tray/sample in frame
+COVERAGE_REJECT = 0.005
+COVERAGE_FLAG = 0.02
+
+## size marker bands -- the sampling retries search down to 1/7th of the sample height
+MARKER_BAND_DIVISIONS = 7
+MARKER_THRESH = 120
+MARKER_MIN_FRACTION = 0.001
+
+## reason codes
+QC_OK = 'ok'
+QC_FLAG = 'flag'
+QC_REJECT = 'reject'
+
+## name of the pre-flight log written to the error directory
+QC_LOG_NAME = 'preflight_qc.csv'
+_QC_LOG_FIELDS = ['image', 'status', 'reasons', 'sharpness', 'coverage', 'marker_bands']
+
+
+## downsamples an image to QC_THUMB_WIDTH
+def thumbnail(img, width=QC_THUMB_WIDTH):
+    h, w = img.shape[:2]
+    if w <= width:
+        return img
+    scale = width / float(w)
+    return cv2.resize(img, (width, max(1, int(round(h * scale)))), interpolation=cv2.INTER_AREA)
+
+
+## counts the marker bands (top, bottom) of the sample region holding a dark blob of marker size
+def _marker_bands(sample_hsv):
+    h = sample_hsv.shape[0]
+    band_h = max(1, h // MARKER_BAND_DIVISIONS)
+    min_area = MARKER_MIN_FRACTION * sample_hsv.shape[0] * sample_hsv.shape[1]
+    found = 0
+    for band in (sample_hsv[:band_h, :, 2], sample_hsv[h - band_h:, :, 2]):
+        dark = (band < MARKER_THRESH).astype(np.uint8)
+        n, _l, stats, _c = cv2.connectedComponentsWithStats(dark, connectivity=8)
+        if n > 1 and stats[1:, cv2.CC_STAT_AREA].max() >= min_area:
+            found += 1
+    return found
+
+
+## runs the pre-flight checks on a raw image and returns a report dictionary
+## sample_box -- (x0, y0, x1, y1) fractions of the frame holding the samples (None is the whole frame)
+## markers    -- check the size marker bands at the top and bottom of the sample region
+## -- the QR label is not checked: a label is under a pixel per module on the thumbnail, and sampling reads it anyway
+def preflight_check(img, sample_box=None, markers=False):
+    report = {'status': QC_OK, 'reasons': [], 'sharpness': 0.0, 'coverage': 0.0, 'marker_bands': None}
+
+    if img is None or len(np.shape(img)) < 3 or img.size == 0:
+        report['status'] = QC_REJECT
+        report['reasons'].append('unreadable')
+        return report
+
+    thumb = thumbnail(img)
+    th, tw = thumb.shape[:2]
+    gray = cv2.cvtColor(thumb, cv2.COLOR_BGR2GRAY)
+
+    ## sample region of the thumbnail
+    if sample_box is None:
+        sample_box = (0.0, 0.0, 1.0, 1.0)
+    x0, y0, x1, y1 = sample_box
+    sample = thumb[int(y0 * th):int(y1 * th), int(x0 * tw):int(x1 * tw)]
+    sample_hsv = cv2.cvtColor(sample, cv2.COLOR_BGR2HSV)
+
+    ## sharpness -- variance of the laplacian
+    report['sharpness'] = float(cv2.Laplacian(gray, cv2.CV_64F).var())
+
+    ## object coverage -- saturated or dark pixels against the white background
+    objects = np.logical_or(sample_hsv[:, :, 1] > 60, sample_hsv[:, :, 2] < MARKER_THRESH)
+    report['coverage'] = float(np.count_nonzero(objects)) / max(1, objects.size)
+
+    if markers:
+        report['marker_bands'] = _marker_bands(sample_hsv)
+
+    ## hopeless images
+    if report['coverage'] < COVERAGE_REJECT:
+        report['reasons'].append('blank')
+    if report['sharpness'] < SHARPNESS_REJECT:
+        report['reasons'].append('blur')
+    if markers and report['marker_bands'] == 0:
+        report['reasons'].append('no_markers')
+    if report['reasons']:
+        report['status'] = QC_REJECT
+        return report
+
+    ## borderline images
+    if report['coverage'] < COVERAGE_FLAG:
+        report['reasons'].append('low_coverage')
+    if report['sharpness'] < SHARPNESS_FLAG:
+        report['reasons'].append('soft')
+    if markers and report['marker_bands'] == 1:
+        report['reasons'].append('one_marker_band')
+    if report['reasons']:
+        report['status'] = QC_FLAG
+
+    return report
+
+
+## appends a pre-flight report to the log in the error directory
+def log_preflight(report, filepath, error_dir):
+    log_path = os.path.join(error_dir, QC_LOG_NAME)
+    row = {k: report.get(k) for k in _QC_LOG_FIELDS if k != 'image'}
+    row['image'] = filepath
+    row['reasons'] = '+'.join(report['reasons'])
+    new = not os.path.exists(log_path)
+    with open(log_path, 'a', newline='') as f:
+        w = csv.DictWriter(f, fieldnames=_QC_LOG_FIELDS)
+        if new:
+            w.writeheader()
+        w.writerow(row)
+
+
+## checks a raw image before sampling -- returns False when the image was routed to the error directory
+## -- rejected images are written to the error directory named with their reason codes,
+##    flagged and rejected images are logged to preflight_qc.csv
+def triage(raw_img, filepath, error_dir, writer=None, **check_args):
+    report = preflight_check(raw_img, **check_args)
+    if report['status'] == QC_OK:
+        return True
+
+    log_preflight(report, filepath, error_dir)
+    reasons = '+'.join(report['reasons'])
+    if report['status'] == QC_FLAG:
+        print('Pre-flight QC flagged %s: %s' % (filepath, reasons))
+        return True
+
+    print('Pre-flight QC rejected %s: %s' % (filepath, reasons))
+    name = os.path.basename(filepath).split('.')[0].replace('_', '-')
+    err_path = os.path.join(error_dir, '%s_%s.jpg' % (name, reasons))
+    if raw_img is not None and np.size(raw_img) > 0:
+        if writer is None:
+            cv2.imwrite(err_path, raw_img)
+        else:
+            writer.write(err_path, raw_img)
+    return False
@@ -34,6 +34,22 @@ def readQR(img):
         print("No QR code detected.\n")
         return ""
 
+## reads every qr code in the image, returns a list of (data string, (left, top, width, height)) -- [] if none
+## -- the data strings are truncated as readQR does
+def readQRs(img):
+    try:
+        symbols = decodeQR(img)
+    except Exception:
+        print("No QR code detected.\n")
+        return []
+    labels = []
+    for symbol in symbols:
+        qr_data = symbol.data
+        if len(qr_data) > 3:
+            qr_data = qr_data[:-2]
+        labels.append((qr_data.decode(), tuple(symbol.rect)))
+    return labels
+
 ## returns the full structure given by pyzbar
 def getQRStruct(img):
     try:
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+report.py -- color swatches and summary report of the per-plantbarcode color means (mv_means.py)
+
+The swatch grid is one NumPy array: the mean colors of all plantbarcodes are laid out as a
+rows x columns image of one pixel per barcode and scaled up to the cell size with a nearest-neighbour
+resize, so rendering costs the same per pixel for ten or ten thousand barcodes. Past SWATCH_PIXELS
+the cells shrink to keep the PNG (run-length encoded -- flat colors compress well) small and fast.
+The HTML report lists every barcode with its swatch, sample count and the mean (standard deviation)
+of each channel over its samples, headed by a histogram of the barcode means of each channel as
+inline SVG.
+"""
+import os.path
+import html
+
+import cv2
+import numpy as np
+
+
+## swatches per row of the grid
+SWATCH_COLUMNS = 20
+
+## height and width of a swatch in pixels
+SWATCH_CELL = (30, 60)
+
+## pixels of the swatch grid past which the swatches are made smaller
+SWATCH_PIXELS = 4000000
+
+## bins of the trait distribution histograms
+REPORT_BINS = 20
+
+## (height, width) of a trait distribution histogram in the report
+_HIST_SIZE = (60, 180)
+
+
+## RGB image of colors (rows of r, g, b on 0-255), one cell each, filled row by row -- unused cells are white
+## -- cells are scaled down (to at least 2 x 2) so the image stays within max_pixels
+def swatch_grid(colors, columns=SWATCH_COLUMNS, cell=SWATCH_CELL, max_pixels=SWATCH_PIXELS):
+    colors = np.clip(np.asarray(colors, dtype=np.float64).reshape(-1, 3), 0, 255).astype(np.uint8)
+    n = len(colors)
+    columns = max(1, min(columns, n))
+    rows = max(1, -(-n // columns))
+    grid = np.full((rows * columns, 3), 255, dtype=np.uint8)
+    grid[:n] = colors
+    grid = grid.reshape(rows, columns, 3)
+    scale = min(1.0, (float(max_pixels) / (rows * columns * cell[0] * cell[1])) ** 0.5) if max_pixels else 1.0
+    h, w = max(2, int(cell[0] * scale)), max(2, int(cell[1] * scale))
+    return cv2.resize(grid, (columns * w, rows * h), interpolation=cv2.INTER_NEAREST)
+
+
+## inline SVG bar chart of the histogram of values
+def _histogram_svg(values, bins=REPORT_BINS, size=_HIST_SIZE):
+    values = np.asarray(values, dtype=np.float64)
+    values = values[np.isfinite(values)]
+    if values.size == 0:
+        return ''
+    counts, edges = np.histogram(values, bins=bins)
+    h, w = size
+    bar = w / float(bins)
+    heights = counts * (h / float(max(1, counts.max())))
+    bars = ''.join('<rect x="%.1f" y="%.1f" width="%.1f" height="%.1f"/>' % (i * bar, h - bh, bar - 1, bh)
+                   for i, bh in enumerate(heights) if bh > 0)
+    return ('<svg width="%d" height="%d"><title>%g - %g</title><g fill="#4a7">%s</g></svg>' %
+            (w, h + 1, edges[0], edges[-1], bars))
+
+
+## writes <name>_swatches.png and <name>_report.html to resultdir -- returns their paths
+## labels -- plantbarcodes; colors -- their mean r, g, b; counts -- samples per barcode
+## traits -- trait names; means, stds -- barcodes x traits arrays of the means and standard deviations over the samples
+def write_report(name, resultdir, labels, colors, counts, traits, means, stds):
+    name = str(name)
+    png_path = os.path.join(str(resultdir), name + '_swatches.png')
+    html_path = os.path.join(str(resultdir), name + '_report.html')
+    colors = np.clip(np.asarray(colors, dtype=np.float64).reshape(-1, 3), 0, 255).astype(np.uint8)
+    means = np.asarray(means, dtype=np.float64).reshape(len(labels), len(traits))
+    stds = np.asarray(stds, dtype=np.float64).reshape(len(labels), len(traits))
+
+    if len(labels):
+        cv2.imwrite(png_path, cv2.cvtColor(swatch_grid(colors), cv2.COLOR_RGB2BGR),
+                    [cv2.IMWRITE_PNG_STRATEGY, cv2.IMWRITE_PNG_STRATEGY_RLE])
+
+    head = ''.join('<th>%s<br>%s</th>' % (html.escape(t.replace('_frequencies', '')), _histogram_svg(means[:, j]))
+                   for j, t in enumerate(traits))
+    cell = '<td>%.2f (%.2f)</td>'
+    rows = []
+    for i, label in enumerate(labels):
+        r, g, b = colors[i]
+        rows.append('<tr><td style="background:#%02x%02x%02x;width:40px"></td><td>%s</td><td>%d</td>%s</tr>' %
+                    (r, g, b, html.escape(str(label)), counts[i],
+                     ''.join(cell % (m, s) for m, s in zip(means[i], stds[i]))))
+    with open(html_path, 'w') as f:
+        f.write('<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>%s color means</title>'
+                '<style>body{font-family:sans-serif;font-size:12px}td,th{padding:2px 6px;text-align:right}'
+                'th{vertical-align:bottom}</style></head><body>\n'
+                '<h1>%s</h1><p>%d plantbarcodes, %d samples -- mean (standard deviation) over the samples; '
+                'the histograms are of the plantbarcode means</p>\n'
+                '<table><tr><th></th><th>plantbarcode</th><th>samples</th>%s</tr>\n' %
+                (html.escape(name), html.escape(name), len(labels), int(np.sum(counts)), head))
+        f.write('\n'.join(rows))
+        f.write('\n</table></body></html>\n')
+    return png_path, html_path
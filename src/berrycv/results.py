@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+results.py -- per-sample observation collector in place of the global pcv.outputs
+
+A Results object is created for each sample (or call) and passed explicitly to the analysis
+steps, so samples can be processed side by side in threads of one worker. It has the
+add_observation() interface of plantcv's Outputs and writes the same JSON schema.
+"""
+import os.path
+import json
+import threading
+
+import numpy as np
+
+
+## value types which serialize to JSON -- the types plantcv's Outputs accepts
+_JSON_TYPES = (int, float, str, list, bool, tuple, dict, type(None), np.float64)
+
+
+class Results:
+
+    def __init__(self):
+        self.observations = {}
+        self._lock = threading.Lock()
+
+    ## records one observation -- same arguments and checks as pcv.outputs.add_observation
+    def add_observation(self, sample, variable, trait, method, scale, datatype, value, label):
+        if type(value) not in _JSON_TYPES:
+            raise TypeError('The Data type %s is not compatible with JSON! Please use only these: %s!' %
+                            (type(value), ', '.join(t.__name__ for t in _JSON_TYPES)))
+        with self._lock:
+            self.observations.setdefault(sample, {})[variable] = {
+                'trait': trait,
+                'method': method,
+                'scale': scale,
+                'datatype': str(datatype),
+                'value': value,
+                'label': label
+            }
+
+    ## value of a recorded observation, default when it was not recorded
+    def value(self, variable, sample='default', default=None):
+        obs = self.observations.get(sample, {}).get(variable)
+        if obs is None:
+            return default
+        return obs['value']
+
+    ## copies the observations of another collector into this one
+    def update(self, other):
+        with self._lock:
+            for sample, variables in other.observations.items():
+                self.observations.setdefault(sample, {}).update(variables)
+
+    def clear(self):
+        with self._lock:
+            self.observations = {}
+
+    ## writes the observations as plantcv result JSON -- metadata already in the file is kept
+    def save_results(self, filename):
+        if os.path.isfile(filename):
+            with open(filename, 'r') as f:
+                hierarchical_data = json.load(f)
+                hierarchical_data['observations'] = self.observations
+        else:
+            hierarchical_data = {'metadata': {}, 'observations': self.observations}
+        with open(filename, mode='w') as f:
+            json.dump(hierarchical_data, f)
@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+"""
+scheduler.py -- fault-isolating runner for the per-image workflow jobs
+
+Every image is processed by its own workflow process (the jobs built by plantcv's job_builder), at
+most n_workers at a time. A process which runs past the time limit or grows past the memory limit
+is killed and the next job takes its slot, so one pathological photo costs one timeout instead of
+stalling the batch. Failed jobs are retried once at the end of the queue; images which keep
+failing are copied to the error directory next to a <name>.failure.json record.
+
+Sampling runs sample_workflow.py the same way, on chunks of SAMPLE_CHUNK consecutive photos so the
+start-up of a process is paid once per chunk. A sampling job touches its heartbeat file after every
+photo, and the time limit runs from the last touch -- it is the time one photo may take. The photos
+of a failed chunk are sampled again one process each, with the retries and failure records of the
+analysis jobs; the manifest parts and metrics of the successful jobs are then joined in photo order.
+"""
+import os.path
+import io
+import sys
+import re
+import csv
+import json
+import time
+import shutil
+import datetime
+import tempfile
+import subprocess
+from collections import deque
+
+from .shards import canonicalize_results_file
+from .manifest import MANIFEST_NAME, ManifestWriter, find_manifest, manifest_metadata
+from .qc import QC_LOG_NAME
+from .objfilter import OBJECT_LOG_NAME
+from .metrics import run_metrics
+from .threads import ThreadBudget, image_pixels
+
+
+## seconds an image may take before its process is killed
+JOB_TIMEOUT = 600
+
+## extra attempts for a failed image
+JOB_RETRIES = 1
+
+## seconds between checks of the running jobs
+POLL_INTERVAL = 0.1
+
+## characters of stderr kept in a failure record
+STDERR_TAIL = 4000
+
+## photos per sampling process
+SAMPLE_CHUNK = 16
+
+_UNITS = {'': 1, 'B': 1, 'KB': 1000, 'MB': 1000 ** 2, 'GB': 1000 ** 3, 'TB': 1000 ** 4,
+          'KIB': 1024, 'MIB': 1024 ** 2, 'GIB': 1024 ** 3, 'TIB': 1024 ** 4}
+
+
+## memory size in bytes from a number or a dask-style string ('4GB', '512MiB') -- None for no limit
+def parse_memory(value):
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    m = re.match(r'^\s*([0-9.]+)\s*([a-zA-Z]*)\s*$', str(value))
+    if m is None or m.group(2).upper() not in _UNITS:
+        raise ValueError('Unrecognized memory size \'%s\'' % value)
+    return int(float(m.group(1)) * _UNITS[m.group(2).upper()])
+
+
+## resident memory of a process in bytes -- None where /proc is not available (no memory limit there)
+def _rss_bytes(pid):
+    try:
+        with open('/proc/%d/statm' % pid) as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+## value following a flag in a job command, None when absent
+def _job_arg(job, flag):
+    try:
+        return job[job.index(flag) + 1]
+    except (ValueError, IndexError):
+        return None
+
+
+## one attempt of a job in a worker process
+class _Attempt:
+
+    def __init__(self, job, number, env=None):
+        self.job = job
+        self.number = number
+        self.stderr = tempfile.TemporaryFile()
+        self.start = time.time()
+        self.killed = None
+        self.heartbeat = _job_arg(job, '--heartbeat')
+        self.proc = subprocess.Popen(job, stderr=self.stderr, shell=False, env=env)
+
+    def elapsed(self):
+        return time.time() - self.start
+
+    ## seconds since the job started or last touched its heartbeat file
+    def idle(self):
+        last = self.start
+        if self.heartbeat is not None:
+            try:
+                last = max(last, os.path.getmtime(self.heartbeat))
+            except OSError:
+                pass
+        return time.time() - last
+
+    def kill(self, reason):
+        self.killed = reason
+        self.proc.kill()
+
+    ## record of a finished attempt
+    def record(self):
+        self.stderr.seek(0)
+        err = self.stderr.read().decode('utf-8', 'replace')
+        self.stderr.close()
+        rc = self.proc.returncode
+        if self.killed is not None:
+            reason = self.killed
+        elif rc is not None and rc < 0:
+            reason = 'crash (signal %d)' % -rc
+        else:
+            reason = 'exit code %s' % rc
+        return {'attempt': self.number, 'reason': reason, 'returncode': rc,
+                'seconds': round(self.elapsed(), 3), 'stderr': err[-STDERR_TAIL:]}
+
+
+## copies a failed image to the error directory and writes its failure record
+def write_failure(error_dir, job, attempts):
+    image = _job_arg(job, '--image')
+    name = os.path.basename(str(image)).rsplit('.', 1)[0]
+    os.makedirs(error_dir, exist_ok=True)
+    if image is not None and os.path.isfile(image):
+        shutil.copy2(image, os.path.join(error_dir, os.path.basename(image)))
+    record = {'image': image, 'command': job, 'failed': datetime.datetime.now().isoformat(timespec='seconds'),
+              'attempts': attempts}
+    with open(os.path.join(error_dir, name + '.failure.json'), 'w') as f:
+        json.dump(record, f, indent=4)
+
+
+## runs job commands with at most 'workers' processes, a per-job time and memory limit and retries
+## -- the --result file of a job is restored before a retry and removed when the job fails for good,
+##    so a killed process never leaves a half-written result behind for process_results
+## -- the time limit of a job with a --heartbeat file runs from the last touch of the file
+## env -- environment of the worker processes (the thread limits of berrycv.threads), None to inherit this one
+## phase -- name of the jobs in the metrics: 'analysis' or 'sampling'
+## returns a summary dictionary -- jobs, succeeded, retried, failed (list of image paths)
+def run_jobs(jobs, workers=1, timeout=JOB_TIMEOUT, memory_limit=None, retries=JOB_RETRIES, error_dir=None,
+             metrics=None, env=None, phase='analysis'):
+    workers = max(1, int(workers))
+    pending = deque((job, []) for job in jobs)
+    running = []
+    templates = {}
+    summary = {'jobs': len(pending), 'succeeded': 0, 'retried': 0, 'failed': []}
+    metrics = metrics if metrics is not None else run_metrics()
+    metrics.begin(phase, len(pending))
+
+    ## keep the metadata templates written by job_builder for retries
+    for job, _a in pending:
+        result = _job_arg(job, '--result')
+        if result is not None and os.path.isfile(result):
+            with open(result, 'r') as f:
+                templates[result] = f.read()
+
+    while pending or running:
+        ## fill the free worker slots
+        while pending and len(running) < workers:
+            job, attempts = pending.popleft()
+            result = _job_arg(job, '--result')
+            if attempts and result in templates:
+                with open(result, 'w') as f:
+                    f.write(templates[result])
+            running.append((_Attempt(job, len(attempts) + 1, env=env), attempts))
+        metrics.set('queue_depth', len(pending), queue=phase)
+
+        time.sleep(POLL_INTERVAL)
+
+        still_running = []
+        for attempt, attempts in running:
+            ## enforce the limits of the running jobs
+            if attempt.proc.poll() is None:
+                if timeout and attempt.idle() > timeout:
+                    attempt.kill('timeout after %g s' % timeout)
+                elif memory_limit:
+                    rss = _rss_bytes(attempt.proc.pid)
+                    if rss is not None and rss > memory_limit:
+                        attempt.kill('memory %d MB over the %d MB limit' % (rss // 1000 ** 2, memory_limit // 1000 ** 2))
+                if attempt.killed is None:
+                    still_running.append((attempt, attempts))
+                    continue
+                attempt.proc.wait()
+
+            ## finished, crashed or killed
+            metrics.observe(phase, attempt.elapsed())
+            if attempt.proc.returncode == 0 and attempt.killed is None:
+                attempt.stderr.close()
+                summary['succeeded'] += 1
+                metrics.inc('%s_jobs_total' % phase, status='succeeded')
+                metrics.advance()
+                continue
+
+            attempts = attempts + [attempt.record()]
+            image = _job_arg(attempt.job, '--image')
+            print('Job failed for %s: %s' % (image, attempts[-1]['reason']), file=sys.stderr)
+            if len(attempts) <= retries:
+                summary['retried'] += 1
+                metrics.inc('%s_jobs_total' % phase, status='retried')
+                pending.append((attempt.job, attempts))
+                continue
+
+            ## persistent failure
+            summary['failed'].append(image)
+            metrics.inc('%s_jobs_total' % phase, status='failed')
+            metrics.advance()
+            result = _job_arg(attempt.job, '--result')
+            if result is not None and os.path.isfile(result):
+                os.remove(result)
+            if error_dir is not None:
+                write_failure(error_dir, attempt.job, attempts)
+                metrics.inc('error_images_total', reason=phase)
+        running = still_running
+
+    return summary
+
+
+## rewrites the rows appended to a log of the error directory since it was 'offset' bytes long in the order of
+## 'paths' -- a photo sampled again keeps its last row, and the headers of concurrent first writers are dropped
+def _tidy_log(path, offset, paths):
+    if not os.path.isfile(path):
+        return
+    with open(path, 'rb') as f:
+        head = f.read(offset)
+        rows = list(csv.reader(io.StringIO(f.read().decode('utf-8'), newline='')))
+    header = None
+    if offset == 0 and rows:
+        header, rows = rows[0], rows[1:]
+    else:
+        with open(path, 'r', newline='') as f:
+            header = next(csv.reader(f), None)
+    latest = dict((row[0], row) for row in rows if row and row != header)
+    order = dict((p, k) for k, p in enumerate(paths))
+    out = io.StringIO()
+    writer = csv.writer(out)
+    if offset == 0 and header is not None:
+        writer.writerow(header)
+    writer.writerows(sorted(latest.values(), key=lambda row: order.get(row[0], len(order))))
+    with open(path, 'wb') as f:
+        f.write(head + out.getvalue().encode('utf-8'))
+
+
+## samples photos (or videos) with sample_workflow.py processes through run_jobs
+## command -- the sample_workflow.py command line without --image; each job adds its photos, manifest part,
+##            heartbeat file and metrics file
+## chunk -- photos per process of the first pass, at most an equal share of the photos per worker
+## records -- manifest records written before the samples (the duplicate photos of berrycv.dedup)
+## the sample manifest of sample_dir is started over; photos which keep failing are copied to error_dir next
+## to a <name>.failure.json record. returns a summary dictionary -- photos, jobs, succeeded, retried, failed
+def run_sampling_jobs(command, paths, sample_dir, error_dir, chunk=SAMPLE_CHUNK, workers=1, timeout=JOB_TIMEOUT,
+                      memory_limit=None, retries=JOB_RETRIES, metrics=None, env=None, records=()):
+    paths = list(paths)
+    workers = max(1, int(workers))
+    metrics = metrics if metrics is not None else run_metrics()
+    logs = [os.path.join(error_dir, log) for log in (QC_LOG_NAME, OBJECT_LOG_NAME)]
+    offsets = [os.path.getsize(log) if os.path.isfile(log) else 0 for log in logs]
+    summary = {'photos': len(paths), 'jobs': 0, 'succeeded': 0, 'retried': 0, 'failed': []}
+    work = tempfile.mkdtemp(prefix='sampling_')
+
+    ## job of a chunk or photo -- its files in the work directory are named by key
+    def job(key, image):
+        part = os.path.join(work, key)
+        return command + ['--image', image, '--manifest', part + '.manifest.jsonl', '--heartbeat', part + '.heartbeat',
+                          '--metrics-json', part + '.metrics.json']
+
+    def run(jobs, **limits):
+        done = run_jobs(jobs, workers=workers, timeout=timeout, memory_limit=memory_limit, metrics=metrics, env=env,
+                        phase='sampling', **limits)
+        for k in ('jobs', 'succeeded', 'retried'):
+            summary[k] += done[k]
+        return set(done['failed'])
+
+    try:
+        ## first pass -- chunks of consecutive photos, without retries or failure records
+        size = max(1, min(int(chunk), -(-len(paths) // workers)))
+        chunks = [('chunk%d' % k, paths[k:k + size]) for k in range(0, len(paths), size)] if size > 1 else []
+        failed_chunks = set()
+        if chunks:
+            for key, members in chunks:
+                with open(os.path.join(work, key + '.txt'), 'w') as f:
+                    f.write(''.join(p + '\n' for p in members))
+            failed_chunks = run([job(key, os.path.join(work, key + '.txt')) for key, members in chunks], retries=0,
+                                error_dir=None)
+
+        ## second pass -- the photos of the failed chunks (all photos when there are no chunks), one process each
+        photos = [(k, p) for k, p in enumerate(paths)
+                  if not chunks or os.path.join(work, chunks[k // size][0] + '.txt') in failed_chunks]
+        failed = run([job('photo%d' % k, p) for k, p in photos], retries=retries, error_dir=error_dir)
+        summary['failed'] = [p for p in paths if p in failed]
+
+        ## manifest parts and metrics of the successful jobs in photo order
+        parts = []
+        for k, p in enumerate(paths):
+            key = chunks[k // size][0] if chunks else None
+            if key is not None and os.path.join(work, key + '.txt') not in failed_chunks:
+                if k % size == 0:
+                    parts.append(key)
+            elif p not in failed:
+                parts.append('photo%d' % k)
+        os.makedirs(sample_dir, exist_ok=True)
+        with ManifestWriter(os.path.join(sample_dir, MANIFEST_NAME)) as manifest:
+            for record in records:
+                manifest.add(record)
+            for key in parts:
+                part = os.path.join(work, key)
+                if os.path.isfile(part + '.manifest.jsonl'):
+                    with open(part + '.manifest.jsonl', 'r') as f:
+                        for line in f:
+                            if line.strip():
+                                manifest.add(json.loads(line))
+                if os.path.isfile(part + '.metrics.json'):
+                    metrics.merge(part + '.metrics.json')
+        for log, offset in zip(logs, offsets):
+            _tidy_log(log, offset, paths)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    return summary
+
+
+## runs a plantcv workflow configuration (the analyze-workflow_config.json format) through run_jobs
+## -- same steps as plantcv-workflow.py: metadata_parser, job_builder, the jobs, process_results;
+##    the metadata come from the sample manifest (berrycv.manifest) when the input directory has one.
+##    n_workers and memory of cluster_config become the worker count and per-image memory limit,
+##    job_timeout and job_retries (optional keys) the per-image time limit and retries.
+##    the cores of thread_budget (optional key, default all) are split between the workers (berrycv.threads)
+##    -- n_workers 'auto' chooses the workers and threads per worker from the image size
+##    the entities of the result JSON are ordered by image file (berrycv.shards.canonical_results)
+def run_workflow(config_file, error_dir=None):
+    import plantcv.parallel
+
+    config = plantcv.parallel.WorkflowConfig()
+    config.import_config(config_file=config_file)
+    if not config.validate_config():
+        raise ValueError("Invalid configuration file. Check errors above.")
+
+    ## temporary directory of the per-image result files
+    start_time = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+    if config.tmp_dir is not None:
+        os.makedirs(config.tmp_dir, exist_ok=True)
+    config.tmp_dir = tempfile.mkdtemp(prefix=start_time + '_', dir=config.tmp_dir)
+    os.makedirs(config.img_outdir, exist_ok=True)
+
+    ## remove JSON results file if append=False
+    if not config.append and os.path.exists(config.json):
+        os.remove(config.json)
+
+    ## job list and metadata from the sample manifest of the sampling stage -- from the file names without one
+    manifest = find_manifest(config.input_dir)
+    if manifest is not None:
+        meta = manifest_metadata(config, manifest)
+    else:
+        meta = plantcv.parallel.metadata_parser(config=config)
+    jobs = plantcv.parallel.job_builder(meta=meta, config=config)
+
+    ## workers and threads per worker within the thread budget
+    cluster_config = config.cluster_config or {}
+    budget = ThreadBudget(getattr(config, 'thread_budget', None), cluster_config.get('n_workers', 1))
+    pixels = image_pixels([_job_arg(job, '--image') for job in jobs])
+    workers, threads = budget.plan(pixels)
+    print(budget.report(workers, threads, pixels))
+    metrics = run_metrics()
+    metrics.set('analysis_workers', workers)
+    metrics.set('analysis_threads_per_worker', threads)
+
+    summary = run_jobs(jobs, workers=workers,
+                       timeout=getattr(config, 'job_timeout', JOB_TIMEOUT),
+                       memory_limit=parse_memory(cluster_config.get('memory')),
+                       retries=getattr(config, 'job_retries', JOB_RETRIES),
+                       error_dir=error_dir, metrics=metrics, env=budget.env(threads))
+
+    plantcv.parallel.process_results(job_dir=config.tmp_dir, json_file=config.json)
+    canonicalize_results_file(config.json)
+    if config.cleanup is True:
+        shutil.rmtree(config.tmp_dir)
+    return summary
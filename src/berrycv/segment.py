@@ -0,0 +1,576 @@
+#!/usr/bin/env python3
+"""
+segment.py -- sample segmentation engine shared by the photobooth, leaf and single-sample modes
+
+One raw photo goes through the same steps in every mode:
+
+    pre-flight QC -> QR label + sample region (layout) -> mask -> size markers -> object filter -> sample images (splitter)
+
+The modes only differ in the strategies plugged into those steps:
+
+    layout   -- where the QR label and the samples are in the frame (several labels, each with its own
+                tray, in the multi-tray mode)
+    markers  -- whether size markers are detected and their mean area reported
+    splitter -- whether every object is cropped to its own sample or the masked image is one sample
+"""
+import os.path
+import math
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from .read_qr import readQR, readQRs, getQRStruct
+from .utils import create_sub, read_image, read_exif_datetime, list_images, is_image_list, read_image_list, touch
+from .pipeline import prefetch_images, ImageWriter, PREFETCH_DEPTH, WRITE_QUEUE_SIZE
+from .buffers import worker_pool
+from .masks import generate_mask, apply_mask, logical_and, logical_or, invert, find_objects, roi_objects, auto_crop
+from .markers import report_size_marker_area
+from .results import Results
+from .shards import select_shard
+from .metrics import run_metrics
+from .calibration import session_key
+from .manifest import MANIFEST_NAME, ManifestWriter, sample_record, duplicate_record
+from .objfilter import log_objects
+from . import qc
+
+
+## assembles the sample filename with the metadata provided in the parameters
+def sample_filename(dt_original, qr_raw, sample_id, img_type, mean_area):
+
+    ## format datetime string
+    dt_original_format = str(dt_original.replace(":", "-"))
+
+    ## format QR code data
+    qr_format = label_str(qr_raw)
+
+    ## return filename string
+    return ("%s_%s_%s_%s_%s" % (dt_original_format, qr_format, str(sample_id), str(img_type), str(mean_area)))
+
+## QR label text made safe for file and directory names
+def label_str(qr):
+    return str(qr).replace(":", "+").replace("|", "+")
+
+## isolates the name in the filename to remove the full path and extension
+## -- underscores become dashes for the plantbarcodes ('_' is the chosen delimeter for metadata)
+def name_from_path(filepath):
+    return os.path.basename(filepath).split('.')[0].replace('_', '-')
+
+
+## -- layouts -- each returns (qr, sample_img) for a raw photo
+##    (a list of (qr, QR symbol rectangle) labels as qr for the multi layouts)
+
+## photobooth -- QR label in the left third, samples in the right two thirds
+class PhotoboothLayout:
+    qc_box = (1.0 / 3, 0.0, 1.0, 1.0)
+    multi = False
+
+    def locate(self, raw_img, filepath):
+        qr = readQR(raw_img)
+
+        ## no qr detected, substitute for name
+        if qr == "":
+            qr = name_from_path(filepath)
+
+        ## cut into 2/3rds to create sample image
+        return qr, raw_img[:, math.floor(1*(raw_img.shape[1])/3):]
+
+## leaf -- QR label at the top, samples below it
+class LeafLayout:
+    qc_box = None
+    multi = False
+
+    ## share of the frame height dropped when no QR is found
+    top_divisions = 10
+
+    def locate(self, raw_img, filepath):
+        qr = getQRStruct(raw_img)
+
+        ## no qr detected, substitute for name and drop the top of the frame
+        if not qr:
+            return name_from_path(filepath), raw_img[math.floor(raw_img.shape[0]/self.top_divisions):, :]
+
+        ## cut the qr portion off
+        qr_bbox = qr[0].rect
+        sample_img = raw_img[math.floor(1 * (qr_bbox[1] + qr_bbox[3])):, :]
+        qr = readQR(raw_img)
+        print("QR: " + qr)
+        return qr, sample_img
+
+## single sample -- QR label in the bottom eighth, the rest of the frame is the sample
+class SingleLayout:
+    qc_box = (0.0, 0.0, 1.0, 7.0 / 8)
+    multi = False
+
+    def locate(self, raw_img, filepath):
+        qr = getQRStruct(raw_img)
+
+        ## no qr detected, substitute for name
+        if not qr:
+            qr = name_from_path(filepath)
+        else:
+            qr = readQR(raw_img)
+            print("QR: " + qr)
+
+        ## cut qr portion off
+        return qr, raw_img[:raw_img.shape[0] - math.floor(raw_img.shape[0]/8), :]
+
+## multi-tray -- several trays in the frame, each with its own QR label; the whole frame is the sample image
+## -- labels are (qr, symbol rectangle), [(file name, None)] when no QR label can be read
+class MultiTrayLayout:
+    qc_box = None
+    multi = True
+
+    def locate(self, raw_img, filepath):
+        labels = readQRs(raw_img)
+        if not labels:
+            return [(name_from_path(filepath), None)], raw_img
+        for qr, _rect in labels:
+            print("QR: " + qr)
+        return labels, raw_img
+
+
+## pixels around a QR symbol whose objects are parts of the label, not samples
+QR_PADDING = 20
+
+## rounds of refining the offset of the trays from their labels
+OFFSET_ROUNDS = 5
+
+## distance from the moved label center, in median distances of the objects, beyond which an object is on no
+## read tray -- a tray whose label was not read is a tray pitch away from the nearest read one
+MAX_SPREAD = 3.0
+
+## objects of each label of a multi layout and the objects of no label -- objects centered on a QR symbol (the
+## label itself) are dropped and the others go to the label whose center, moved by the offset of the trays from
+## their labels, is nearest
+## -- every tray lies at the same offset from its label (a row or a grid of trays), taken as the median offset of
+##    the objects from their labels, starting from the nearest labels and refined over OFFSET_ROUNDS
+## -- an object further from its label than max_spread median distances is unassigned: the tray of a label which
+##    was not read, which must not be filed under a neighbouring tray's label
+def assign_objects(objects, labels, padding=QR_PADDING, max_spread=MAX_SPREAD):
+    rects = [rect for _qr, rect in labels]
+    if rects[0] is None:
+        return [list(objects)], []
+    rects = np.array(rects, dtype=np.float64)
+    centers = rects[:, :2] + rects[:, 2:] / 2.0
+    kept, points = [], []
+    for obj in objects:
+        x, y, w, h = cv2.boundingRect(obj)
+        c = np.array([x + w / 2.0, y + h / 2.0])
+        if ((c >= rects[:, :2] - padding) & (c <= rects[:, :2] + rects[:, 2:] + padding)).all(axis=1).any():
+            continue
+        kept.append(obj)
+        points.append(c)
+    groups = [[] for _l in labels]
+    if not kept:
+        return groups, []
+    points = np.array(points)
+    offset = np.zeros(2)
+    for _round in range(OFFSET_ROUNDS):
+        nearest = np.argmin(((points[:, None, :] - (centers + offset)[None, :, :]) ** 2).sum(axis=2), axis=1)
+        refined = np.median(points - centers[nearest], axis=0)
+        if np.allclose(refined, offset):
+            break
+        offset = refined
+    distances = np.sqrt(((points[:, None, :] - (centers + offset)[None, :, :]) ** 2).sum(axis=2))
+    nearest = np.argmin(distances, axis=1)
+    distance = distances[np.arange(len(kept)), nearest]
+    limit = max_spread * np.median(distance)
+    unassigned = []
+    for obj, label, d in zip(kept, nearest, distance):
+        if d > limit:
+            unassigned.append(obj)
+        else:
+            groups[int(label)].append(obj)
+    return groups, unassigned
+
+
+## -- marker handling -- each returns (sample objects, mean marker area), or None when the photo is an error
+
+## no size markers -- every object is a sample, the marker area is handled in analysis_workflow
+class NoMarkers:
+    detect = False
+    calibration = None
+
+    def separate(self, sample_img, mask, id_objects, obj_hierarchy, results, pool, metrics=None, session=None):
+        return id_objects, 0
+
+## size markers in bands at the top and bottom of the sample image -- the bands shrink from
+## 1/10th to 1/7th of the height until markers are found
+## -- with a calibration (berrycv.calibration) the markers are measured once per camera and session
+##    and later photos only check them in the calibrated bands
+class SizeMarkers:
+    detect = True
+
+    def __init__(self, max_divisions=10, min_divisions=7, thresh=120, calibration=None):
+        self.max_divisions = max_divisions
+        self.min_divisions = min_divisions
+        self.thresh = thresh
+        self.calibration = calibration
+
+    ## marker and sample objects of bands of 1/img_divisions of the height -- masks are taken from the pool
+    def _bands(self, sample_img, id_objects, obj_hierarchy, img_divisions, pool):
+        height, width = sample_img.shape[:2]
+        band = math.floor(1*height/img_divisions)
+
+        ## identify markers in ROIs of the size markers
+        _c, _h, marker1_kept_mask, _a = roi_objects(sample_img.shape, x=0, y=0, h=band, w=width,
+                                                    object_contour=id_objects, obj_hierarchy=obj_hierarchy,
+                                                    pool=pool)
+        _c, _h, marker2_kept_mask, _a = roi_objects(sample_img.shape, x=0,
+                                                    y=math.floor((img_divisions-1)*height/img_divisions),
+                                                    h=band, w=width,
+                                                    object_contour=id_objects, obj_hierarchy=obj_hierarchy,
+                                                    pool=pool)
+
+        ## find sample roi objects in the roi region of the sample data
+        _c, _h, roi_kept_mask, _a = roi_objects(sample_img.shape, x=0, y=band,
+                                                h=math.floor((img_divisions-2)*height/img_divisions), w=width,
+                                                object_contour=id_objects, obj_hierarchy=obj_hierarchy,
+                                                pool=pool)
+
+        ## combine marker masks and sample data masks to filter objects
+        marker_mask = logical_or(marker1_kept_mask, marker2_kept_mask, dst=marker1_kept_mask)
+
+        ## find items present in both masks
+        negative_mask = invert(logical_and(roi_kept_mask, marker_mask, dst=marker2_kept_mask),
+                               dst=marker2_kept_mask)
+
+        ## remove shared items from marker and sample masks
+        sample_mask = logical_and(negative_mask, roi_kept_mask, dst=roi_kept_mask)
+        marker_mask = logical_and(negative_mask, marker_mask, dst=marker_mask)
+
+        ## filter objects into two id lists
+        marker_id_objects, _mh = find_objects(marker_mask)
+        sample_id_objects, _sh = find_objects(sample_mask)
+        return marker_id_objects, sample_id_objects, marker_mask
+
+    ## session -- calibration key of the photo (berrycv.calibration.session_key), None to always detect
+    def separate(self, sample_img, mask, id_objects, obj_hierarchy, results, pool, metrics=None, session=None):
+        calibration = self.calibration if session is not None else None
+
+        ## calibrated session -- check the markers in the known bands instead of measuring them again
+        entry = calibration.get(session) if calibration is not None else None
+        if entry is not None and tuple(entry['shape']) == sample_img.shape[:2]:
+            with pool.scope():
+                marker_id_objects, sample_id_objects, marker_mask = self._bands(sample_img, id_objects, obj_hierarchy,
+                                                                                entry['divisions'], pool)
+                marker_pixels = cv2.countNonZero(marker_mask)
+            if calibration.check(entry, marker_pixels, len(marker_id_objects)):
+                if metrics is not None:
+                    metrics.inc('marker_calibration_hits_total')
+                results.update(calibration.observations(entry))
+                return sample_id_objects, math.floor(results.value('marker_area') / results.value('num_markers'))
+            if metrics is not None:
+                metrics.inc('marker_calibration_misses_total')
+
+        img_divisions = self.max_divisions
+        marker_id_objects = []
+        sample_id_objects = []
+        marker_pixels = 0
+        while len(marker_id_objects) <= 0 and img_divisions >= self.min_divisions:
+
+            ## masks of each attempt go back to the pool before the next one
+            with pool.scope():
+                marker_id_objects, sample_id_objects, marker_mask = self._bands(sample_img, id_objects, obj_hierarchy,
+                                                                                img_divisions, pool)
+
+                ## whole sample image with only the size markers left for reporting their area
+                marker_img = apply_mask(sample_img, marker_mask, 'white', pool=pool)
+                try:
+                    report_size_marker_area(marker_img, results, thresh=self.thresh, label='default')
+                except ValueError:
+                    img_divisions -= 1 ## reduce divisions -- try again
+                    if metrics is not None and img_divisions >= self.min_divisions:
+                        metrics.inc('marker_retries_total')
+                    continue
+                marker_pixels = cv2.countNonZero(marker_mask)
+                results.add_observation(sample='default', variable='num_markers', trait='number of size markers which contribute to the reported area -- used in determining the mean area', \
+                                        method='count of markers', scale='amount', datatype=int, \
+                                        value=len(marker_id_objects), label='markers')
+
+        ## error img
+        if len(marker_id_objects) <= 0 and img_divisions < self.min_divisions:
+            return None
+
+        ## (re)calibrate the session
+        if calibration is not None:
+            calibration.put(session, sample_img.shape, img_divisions, marker_pixels, len(marker_id_objects), results)
+
+        ## calculate mean marker area and store for filename assembly
+        return sample_id_objects, math.floor(results.value('marker_area') / results.value('num_markers'))
+
+
+## -- splitters -- each yields (sample id, sample image)
+
+## every object is cropped, with padding, to its own sample image
+class ObjectSplitter:
+    pool_masked = True
+    filters = True
+
+    def __init__(self, padding=10):
+        self.padding = padding
+
+    def split(self, mask, masked, sample_objects):
+        for o in range(len(sample_objects)):
+            ## crop the mask and the image around the ROI of the current object
+            crop_mask = auto_crop(mask, sample_objects[o], padding_x=self.padding, padding_y=self.padding, color='image')
+            crop_img = auto_crop(masked, sample_objects[o], padding_x=self.padding, padding_y=self.padding, color='image')
+
+            ## apply mask to cropped image
+            yield o, apply_mask(crop_img, crop_mask, 'white')
+
+## the masked sample image is a single sample -- it is written out, so it is not taken from the pool
+class WholeImage:
+    pool_masked = False
+    filters = False
+
+    def split(self, mask, masked, sample_objects):
+        yield 0, masked
+
+
+## strategies of each sampling mode
+MODES = {
+    'photobooth': lambda: (PhotoboothLayout(), SizeMarkers(), ObjectSplitter()),
+    'leaf': lambda: (LeafLayout(), NoMarkers(), ObjectSplitter()),
+    'single': lambda: (SingleLayout(), NoMarkers(), WholeImage()),
+    'multitray': lambda: (MultiTrayLayout(), NoMarkers(), ObjectSplitter())
+}
+
+
+## sample isolation and labeling -- creates labeled sample images for workflow parallelization
+class SegmentationEngine:
+
+    ## metrics -- RunMetrics the stage latencies and counters are recorded into (default run_metrics())
+    ## object_filter -- ObjectFilter the sample objects go through before cropping, None to crop every object
+    ## color_correction -- ColorCorrection of the raw photos before masking (berrycv.colorcorr), None to leave them
+    ## dedup -- DuplicateFinder the photos of a directory go through before sampling (berrycv.dedup), None to sample all
+    def __init__(self, layout, markers, splitter, sample_dir, error_dir, qc=True, metrics=None, object_filter=None,
+                 color_correction=None, dedup=None):
+        self.layout = layout
+        self.markers = markers
+        self.splitter = splitter
+        self.object_filter = object_filter
+        self.color_correction = color_correction
+        self.dedup = dedup
+        self.sample_dir = sample_dir
+        self.error_dir = error_dir
+        self.qc = qc
+        self.metrics = metrics if metrics is not None else run_metrics()
+
+        ## ManifestWriter the samples are recorded to while run() samples (berrycv.manifest)
+        self.manifest = None
+
+    ## engine with the strategies of a mode -- 'photobooth', 'leaf' or 'single'
+    @classmethod
+    ## calibration -- MarkerCalibration for the modes with size markers, None to measure them on every photo
+    def for_mode(cls, mode, sample_dir, error_dir, qc=True, metrics=None, calibration=None, object_filter=None,
+                 color_correction=None, dedup=None):
+        if mode not in MODES:
+            raise ValueError("Sampling mode '%s' is not one of %s" % (mode, ', '.join(MODES)))
+        layout, markers, splitter = MODES[mode]()
+        if markers.detect:
+            markers.calibration = calibration
+        return cls(layout, markers, splitter, sample_dir, error_dir, qc=qc, metrics=metrics,
+                   object_filter=object_filter, color_correction=color_correction, dedup=dedup)
+
+    ## writes an image through the background writer when one is given
+    def _write(self, writer, path, img):
+        if writer is None:
+            cv2.imwrite(path, img)
+        else:
+            writer.write(path, img)
+
+    ## crops the sample objects of one QR label and writes them to the label's directory -- returns their number
+    def _write_samples(self, qr, sample_objects, mask, masked, filepath, dt_og, mean_marker_area, writer):
+
+        ## create subdirectories
+        sample_dir = os.path.join(self.sample_dir, label_str(qr) + "/")
+        create_sub(sample_dir)
+
+        ## o will be a unique id passed into sample_id for the filename metadata
+        count = 0
+        for o, sample in self.splitter.split(mask, masked, sample_objects):
+            filename_str = sample_filename(dt_og, qr, o, "VIS", mean_marker_area)
+            self._write(writer, sample_dir + filename_str + '.jpg', sample)
+            if self.manifest is not None:
+                self.manifest.add(sample_record(sample_dir + filename_str + '.jpg', filepath, dt_og, qr,
+                                                label_str(qr), o, "VIS", mean_marker_area))
+            count += 1
+        return count
+
+    ## segments one raw photo into sample images -- returns the number of samples written, None for an error photo
+    def build_samples(self, raw_img, filepath, dt_og=None, writer=None, pool=None):
+
+        ## full-frame intermediates are taken from the worker's buffer pool
+        if pool is None:
+            pool = worker_pool()
+
+        ## observations of this photo only -- nothing is shared with other photos in flight
+        results = Results()
+        metrics = self.metrics
+        metrics.inc('images_total')
+
+        ## read the date and time of the photo from the exif data if the prefetcher has not already
+        if dt_og is None:
+            dt_og = read_exif_datetime(filepath)
+
+        ## cheap pre-flight check on a thumbnail -- hopeless photos go straight to the error directory
+        if self.qc:
+            with metrics.time('qc'):
+                passed = qc.triage(raw_img, filepath, self.error_dir, writer,
+                                   sample_box=self.layout.qc_box, markers=self.markers.detect)
+            if not passed:
+                metrics.inc('error_images_total', reason='qc')
+                return None
+
+        ## session color correction of the photo segmented -- the error directory gets the photo as taken
+        img = raw_img
+        if self.color_correction is not None:
+            with metrics.time('color_correct'):
+                img = self.color_correction.correct(raw_img, filepath, dt_og)
+
+        ## read the QR code information and crop the image to the samples
+        with metrics.time('locate'):
+            qr, sample_img = self.layout.locate(img, filepath)
+
+        ## the layouts fall back to the file name when no QR label can be read
+        labels = qr if self.layout.multi else [(qr, None)]
+        qr = labels[0][0]
+        metrics.inc('qr_reads_total')
+        if qr == name_from_path(filepath):
+            metrics.inc('qr_failures_total')
+
+        ## create mask and apply it to the cropped image -- full-frame intermediates come from the buffer pool
+        with metrics.time('mask'):
+            mask = generate_mask(sample_img, pool=pool)
+            masked = apply_mask(sample_img, mask, 'white', pool=pool if self.splitter.pool_masked else None)
+
+            ## identify objects
+            id_objects, obj_hierarchy = find_objects(mask)
+        print('\t')
+        print('Found %d objects in %s' % (len(id_objects), filepath))
+
+        ## separate the size markers from the samples -- calibrated per camera and session when there is a calibration
+        session = session_key(filepath, dt_og) if self.markers.calibration is not None else None
+        with metrics.time('markers'):
+            separated = self.markers.separate(sample_img, mask, id_objects, obj_hierarchy, results, pool, metrics,
+                                              session=session)
+        if separated is None:
+            self._write(writer, os.path.join(self.error_dir, str(qr.replace(":", "+")) + '.jpg'), raw_img)
+            metrics.inc('error_images_total', reason='markers')
+            return None
+        sample_objects, mean_marker_area = separated
+
+        ## drop dust, specks and fragments before they are cropped -- counted per reason
+        if self.object_filter is not None and self.splitter.filters:
+            with metrics.time('filter'):
+                n_objects = len(sample_objects)
+                sample_objects, rejected = self.object_filter.apply(mask, sample_objects)
+            for reason, n in rejected.items():
+                if n:
+                    metrics.inc('objects_rejected_total', n, reason=reason)
+            log_objects(filepath, n_objects, len(sample_objects), rejected, self.error_dir)
+
+        ## crop and write the samples of each label -- the regions of a multi-tray photo in parallel
+        with metrics.time('split'):
+            ## the objects of a multi layout's labels are dropped however many labels were read
+            regions, unassigned = [sample_objects], []
+            if self.layout.multi:
+                regions, unassigned = assign_objects(sample_objects, labels)
+
+            ## objects on a tray whose label was not read -- the photo goes to the error directory unsampled
+            if unassigned:
+                print('%d objects of %s are on no read QR label' % (len(unassigned), filepath))
+                self._write(writer, os.path.join(self.error_dir, '%s_unassigned.jpg' % name_from_path(filepath)),
+                            raw_img)
+                metrics.inc('error_images_total', reason='unassigned')
+                return None
+            if len(labels) == 1:
+                count = self._write_samples(qr, regions[0], mask, masked, filepath, dt_og, mean_marker_area, writer)
+            else:
+                with ThreadPoolExecutor(max_workers=len(labels)) as region_pool:
+                    count = sum(region_pool.map(
+                        lambda region: self._write_samples(region[0][0], region[1], mask, masked, filepath, dt_og,
+                                                           mean_marker_area, writer),
+                        zip(labels, regions)))
+        metrics.inc('samples_total', count)
+        if writer is not None:
+            metrics.set('queue_depth', writer.pending(), queue='write')
+        return count
+
+    ## samples a photo, a directory of photos or a list file of photos -- decodes ahead and writes behind
+    ## for a directory or list
+    ## shard -- (index, count) to sample only that shard of a directory (berrycv.shards)
+    ## manifest -- sample manifest to start instead of the sample directory's (a job of scheduler.run_sampling_jobs)
+    ## heartbeat -- file touched after every photo, for the scheduler to tell a slow job from a stuck one
+    def run(self, image, imgformat='jpg', prefetch=PREFETCH_DEPTH, io_threads=2, write_queue=WRITE_QUEUE_SIZE,
+            shard=None, manifest=None, heartbeat=None):
+        create_sub(self.sample_dir)
+        create_sub(self.error_dir)
+
+        ## buffers for full-frame intermediates, reused from one image to the next
+        pool = worker_pool()
+
+        ## samples are recorded in the manifest of the sample directory as they are queued
+        ## -- a directory run starts it over, a run on one photo (one of many plantcv-workflow.py jobs) appends
+        listing = os.path.isdir(image) or is_image_list(image)
+        try:
+            self.manifest = ManifestWriter(manifest or os.path.join(self.sample_dir, MANIFEST_NAME),
+                                           append=manifest is None and not listing)
+        except OSError as e:
+            print('Unable to write the sample manifest to \'%s\': %s' % (self.sample_dir, e))
+
+        ## crops are written in the background while the next image is segmented
+        with ImageWriter(maxsize=write_queue) as writer, self.manifest or contextlib.nullcontext():
+
+            ## directory or list of images -- decode the next images on I/O threads while the current one is sampled
+            if listing:
+                paths = list_images(image, imgformat) if os.path.isdir(image) else read_image_list(image)
+                if shard is not None:
+                    paths = select_shard(paths, image, *shard)
+
+                ## one photo of each group of repeated or near-duplicate photos -- the others go to the manifest
+                if self.dedup is not None:
+                    with self.metrics.time('dedup'):
+                        paths, duplicates = self.dedup.select(paths)
+                    for duplicate, kept, distance in duplicates:
+                        print('Skipping %s -- duplicate of %s (%d bits)' % (duplicate, kept, distance))
+                        if self.manifest is not None:
+                            self.manifest.add(duplicate_record(duplicate, kept, distance))
+                self.metrics.begin('sampling', len(paths))
+                images = prefetch_images(paths, depth=prefetch, threads=io_threads)
+                while True:
+                    ## time spent waiting on the decoders
+                    with self.metrics.time('decode_wait'):
+                        item = next(images, None)
+                    if item is None:
+                        break
+                    filepath, raw_img, dt_og = item
+
+                    ## if not bad image, analyze
+                    if raw_img is not None:
+                        with pool.scope():
+                            with self.metrics.time('sample'):
+                                self.build_samples(raw_img, filepath, dt_og, writer, pool)
+                    self.metrics.advance()
+                    if heartbeat is not None:
+                        touch(heartbeat)
+
+                print('Buffer pool: %(allocations)d allocations, %(reuses)d reuses, '
+                      '%(high_water_bytes)d bytes high-water mark' % pool.stats())
+            else:
+                raw_img = read_image(image)
+                self.metrics.begin('sampling', 1)
+
+                ## if not bad image, analyze
+                if raw_img is not None:
+                    with pool.scope():
+                        with self.metrics.time('sample'):
+                            self.build_samples(raw_img, image, writer=writer, pool=pool)
+                self.metrics.advance()
+
+        ## the writer has flushed its queue
+        self.manifest = None
+        self.metrics.set('queue_depth', 0, queue='write')
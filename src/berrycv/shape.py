@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+shape.py -- contour shape traits without the drawing of pcv.analyze_object
+
+The reported traits are computed the way pcv.analyze_object computes them (area and centroid
+from the mask moments, hull, perimeter and extents from the contour, longest path from the
+caliper line through the centroid), but the full-frame image copies, annotation drawing and
+ellipse fit are skipped.
+"""
+import cv2
+import numpy as np
+
+
+## method recorded with every shape observation
+SHAPE_METHOD = 'berrycv.analyze_shapes'
+
+## caliper line width -- pcv.params.line_thickness default
+CALIPER_THICKNESS = 5
+
+
+## true when no mask pixel lies on the outer border_width pixels of the frame -- matches pcv.within_frame
+def within_frame(mask, border_width=1):
+    return not (np.count_nonzero(mask[:border_width, :]) or np.count_nonzero(mask[-border_width:, :]) or
+                np.count_nonzero(mask[:, :border_width]) or np.count_nonzero(mask[:, -border_width:]))
+
+
+## outline of the 4px dot pcv.analyze_object draws at the centroid, traced in a small window around it
+def _centroid_dot(cx, cy, frame_shape):
+    rows, cols = frame_shape[:2]
+    x0, y0 = max(cx - 5, 0), max(cy - 5, 0)
+    x1, y1 = min(cx + 6, cols), min(cy + 6, rows)
+    dot = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+    cv2.circle(dot, (cx - x0, cy - y0), 4, (255), -1)
+    return cv2.findContours(dot, cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE, offset=(x0, y0))[-2][0]
+
+
+## number of hull pixels under the caliper line -- the 'longest_path' of pcv.analyze_object
+## -- the line is drawn across the whole frame (opencv clips thick lines against the image, so a
+##    smaller canvas would rasterize it differently), the hull only over its bounding box
+def _caliper_length(hull, cmx, cmy, frame_shape, thickness=CALIPER_THICKNESS):
+    ix, iy = frame_shape[:2]
+
+    ## hull vertex farthest from the centroid dot
+    vhull = np.vstack(hull)
+    dot = _centroid_dot(int(cmx), int(cmy), frame_shape)
+    dist = [abs(cv2.pointPolygonTest(dot, (int(v[0]), int(v[1])), True)) for v in vhull]
+    caliper_max_x, caliper_max_y = vhull[int(np.argmax(dist))]
+    caliper_mid_x, caliper_mid_y = int(cmx), int(cmy)
+
+    ## line through both points, ending on the frame edges
+    xdiff = float(caliper_max_x - caliper_mid_x)
+    ydiff = float(caliper_max_y - caliper_mid_y)
+    slope = 1
+    if xdiff != 0:
+        slope = ydiff / xdiff
+    b_line = caliper_mid_y - (slope * caliper_mid_x)
+
+    if slope != 0:
+        xintercept = int(-b_line / slope)
+        xintercept1 = int((ix - b_line) / slope)
+        if 0 <= xintercept <= iy and 0 <= xintercept1 <= iy:
+            p1, p2 = (xintercept1, ix), (xintercept, 0)
+        else:
+            p1, p2 = (0, int(b_line)), (iy, int((slope * iy) + b_line))
+    else:
+        p1, p2 = (iy, caliper_mid_y), (0, caliper_mid_y)
+
+    ## overlap of the line with the filled hull
+    line = np.zeros((ix, iy), dtype=np.uint8)
+    cv2.line(line, (int(p1[0]), int(p1[1])), (int(p2[0]), int(p2[1])), (255), thickness)
+    bx, by, bw, bh = cv2.boundingRect(hull)
+    filled = np.zeros((bh, bw), dtype=np.uint8)
+    cv2.drawContours(filled, [hull], -1, (255), -1, offset=(-bx, -by))
+    return cv2.countNonZero(cv2.bitwise_and(line[by:by + bh, bx:bx + bw], filled))
+
+
+## traits of one contour -- area and centroid come from the whole mask, as in pcv.analyze_object
+def _object_traits(obj, area, cmx, cmy, frame_shape):
+    hull = cv2.convexHull(obj)
+    hull_area = cv2.contourArea(hull)
+    solidity = 1
+    if int(hull_area) != 0:
+        solidity = area / hull_area
+    x, y, width, height = cv2.boundingRect(obj)
+    return {
+        'convex_hull_area': hull_area,
+        'solidity': solidity,
+        'perimeter': cv2.arcLength(obj, closed=True),
+        'width': width,
+        'height': height,
+        'longest_path': _caliper_length(hull, cmx, cmy, frame_shape),
+        'convex_hull_vertices': len(hull)
+    }
+
+
+## computes the shape traits of every object of a sample and records them into outputs
+## objects -- contours of the sample (bcv.find_objects); contours with fewer than 5 points are skipped
+## outputs -- plantcv Outputs-like object with add_observation()
+## returns the trait dictionary recorded (empty when nothing could be measured)
+## -- repeated pcv.analyze_object calls under the same label leave the traits of the last measurable
+##    object behind, so only that object is measured
+def analyze_shapes(mask, objects, outputs, label='default'):
+    objects = [obj for obj in objects if len(obj) >= 5]
+    if not objects:
+        return {}
+
+    ## the mask-level measurements are shared by every object
+    m = cv2.moments(mask, binaryImage=True)
+    area = m['m00']
+    if not area:
+        return {}
+    cmx, cmy = float(m['m10'] / area), float(m['m01'] / area)
+    in_bounds = within_frame(mask)
+
+    t = _object_traits(objects[-1], area, cmx, cmy, mask.shape)
+    t.update({'area': area, 'center_of_mass': (cmx, cmy), 'object_in_frame': in_bounds})
+
+    outputs.add_observation(sample=label, variable='in_bounds', trait='whether the plant goes out of bounds ',
+                            method=SHAPE_METHOD, scale='none', datatype=bool,
+                            value=in_bounds, label='none')
+    outputs.add_observation(sample=label, variable='area', trait='area',
+                            method=SHAPE_METHOD, scale='pixels', datatype=int,
+                            value=t['area'], label='pixels')
+    outputs.add_observation(sample=label, variable='convex_hull_area', trait='convex hull area',
+                            method=SHAPE_METHOD, scale='pixels', datatype=int,
+                            value=t['convex_hull_area'], label='pixels')
+    outputs.add_observation(sample=label, variable='solidity', trait='solidity',
+                            method=SHAPE_METHOD, scale='none', datatype=float,
+                            value=t['solidity'], label='none')
+    outputs.add_observation(sample=label, variable='perimeter', trait='perimeter',
+                            method=SHAPE_METHOD, scale='pixels', datatype=int,
+                            value=t['perimeter'], label='pixels')
+    outputs.add_observation(sample=label, variable='width', trait='width',
+                            method=SHAPE_METHOD, scale='pixels', datatype=int,
+                            value=t['width'], label='pixels')
+    outputs.add_observation(sample=label, variable='height', trait='height',
+                            method=SHAPE_METHOD, scale='pixels', datatype=int,
+                            value=t['height'], label='pixels')
+    outputs.add_observation(sample=label, variable='longest_path', trait='longest path',
+                            method=SHAPE_METHOD, scale='pixels', datatype=int,
+                            value=t['longest_path'], label='pixels')
+    outputs.add_observation(sample=label, variable='center_of_mass', trait='center of mass',
+                            method=SHAPE_METHOD, scale='none', datatype=tuple,
+                            value=t['center_of_mass'], label=("x", "y"))
+    outputs.add_observation(sample=label, variable='convex_hull_vertices', trait='convex hull vertices',
+                            method=SHAPE_METHOD, scale='none', datatype=int,
+                            value=t['convex_hull_vertices'], label='none')
+    outputs.add_observation(sample=label, variable='object_in_frame', trait='object in frame',
+                            method=SHAPE_METHOD, scale='none', datatype=bool,
+                            value=t['object_in_frame'], label='none')
+    return t
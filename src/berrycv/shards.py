@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+shards.py -- deterministic split of an input set over several hosts and the merge of their results
+
+A raw image belongs to shard int(sha1(path relative to the input directory)) % K, so every host
+computes the same split without coordination. Each shard run writes shard.json to its result
+directory; merge_shards() combines the samples, error directories and result JSON of all K shard
+directories into what a single run over the whole input set writes (the CSVs and color means are
+then compiled from the merged JSON as usual).
+"""
+import os.path
+import csv
+import json
+import shutil
+import hashlib
+
+from .qc import QC_LOG_NAME
+from .objfilter import OBJECT_LOG_NAME
+from .sweep import SET_SEPARATOR
+from .manifest import MANIFEST_NAME, read_manifest as read_sample_manifest, ManifestWriter
+
+
+## name of the shard manifest written to a shard's result directory
+SHARD_MANIFEST = 'shard.json'
+
+
+## parses 'i/K' into (i, K)
+def parse_shard(value):
+    try:
+        index, count = (int(v) for v in str(value).split('/'))
+    except ValueError:
+        raise ValueError('Shard must be given as INDEX/COUNT, e.g. 0/4 -- got \'%s\'' % value)
+    if count < 1 or not 0 <= index < count:
+        raise ValueError('Shard index must be in 0..COUNT-1 -- got \'%s\'' % value)
+    return index, count
+
+
+## key of an image for sharding -- its path relative to the input directory with '/' separators,
+## so that hosts with different mount points (or operating systems) agree
+def shard_key(path, root):
+    return os.path.relpath(path, root).replace(os.sep, '/')
+
+
+## shard of a key -- sha1 rather than hash(), which is salted per process
+def shard_of(key, count):
+    return int(hashlib.sha1(key.encode('utf-8')).hexdigest(), 16) % count
+
+
+## the paths of a listing which belong to shard index of count, in listing order
+def select_shard(paths, root, index, count):
+    return [p for p in paths if shard_of(shard_key(p, root), count) == index]
+
+
+## writes the manifest of a shard run to its result directory
+def write_manifest(resultdir, index, count, name, indir):
+    manifest = {'index': index, 'count': count, 'name': name, 'indir': indir, 'resultdir': resultdir}
+    with open(os.path.join(resultdir, SHARD_MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=4)
+    return manifest
+
+
+def read_manifest(shard_dir):
+    path = os.path.join(shard_dir, SHARD_MANIFEST)
+    if not os.path.isfile(path):
+        raise ValueError('%s is not a shard result directory (no %s)' % (shard_dir, SHARD_MANIFEST))
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+## orders the entities of a plantcv workflow result by image file and rebuilds the variables from
+## them in the way process_results does -- the result no longer depends on the order the jobs ran in
+def canonical_results(data):
+    data['entities'].sort(key=lambda e: str(e.get('metadata', {}).get('image', {}).get('value')))
+    variables = {}
+    for obs in data['entities']:
+        for var in obs['metadata']:
+            variables[var] = {"category": "metadata", "datatype": "<class 'str'>"}
+        for sample in obs['observations']:
+            for othervars in obs['observations'][sample]:
+                variables[othervars] = {"category": "observations",
+                                        "datatype": obs['observations'][sample][othervars]['datatype']}
+    data['variables'] = variables
+    return data
+
+
+## rewrites the canonical result JSON file in place
+def canonicalize_results_file(json_file):
+    with open(json_file, 'r') as f:
+        data = json.load(f)
+    with open(json_file, 'w') as f:
+        json.dump(canonical_results(data), f)
+
+
+## sort key reproducing the order of utils.list_images -- files of a directory before its subdirectories
+def _listing_key(path):
+    parts = path.replace(os.sep, '/').split('/')
+    return tuple((1, p) for p in parts[:-1]) + ((0, parts[-1]),)
+
+
+## moves an entity of a shard's result to the merged sample directory -- the image path and the sample
+## label (the image path less the working directory, see analysis_workflow.py) become those a single
+## run from the current directory would record; labels tagged with a parameter set (sweep.py) keep their tag
+def _relocate(entity, old_samples, new_samples, wd):
+    image = entity['metadata'].get('image')
+    if image is None or not str(image['value']).startswith(old_samples):
+        return
+    old_path = image['value']
+    new_path = new_samples + old_path[len(old_samples):]
+    image['value'] = new_path
+
+    keys = list(entity['observations'])
+    if len(keys) == 1:
+        old_label = keys[0]
+    else:
+        labels = set(k.split(SET_SEPARATOR, 1)[0] for k in keys)
+        if len(labels) != 1:
+            return
+        old_label = labels.pop()
+    new_label = new_path[len(wd) + 1:]
+    relabeled = {}
+    for old_key, variables in entity['observations'].items():
+        new_key = new_label + old_key[len(old_label):]
+        for obs in variables.values():
+            if obs.get('label') == old_key:
+                obs['label'] = new_key
+        relabeled[new_key] = variables
+    entity['observations'] = relabeled
+
+
+## the sample manifest records of a shard with their paths in the merged sample directory, keyed in the
+## order a single run writes them -- raw photos in listing order, the samples of a photo in shard order
+def _relocate_manifest(path, manifest, new_samples):
+    old_samples = os.path.join(manifest['resultdir'], 'samples')
+    keyed = []
+    for n, record in enumerate(read_sample_manifest(path)):
+        if record['path'].startswith(old_samples):
+            record['path'] = new_samples + record['path'][len(old_samples):]
+        keyed.append(((_listing_key(shard_key(record['source'], manifest['indir'])), n), record))
+    return keyed
+
+
+## merges the per-photo logs (pre-flight QC, object filter) of the shards in the order a single run writes them
+def _merge_logs(logs, out_path):
+    header, rows = None, []
+    for log in logs:
+        with open(log, 'r', newline='') as f:
+            reader = csv.reader(f)
+            header = next(reader, None) or header
+            rows.extend(reader)
+    if header is None:
+        return
+    rows.sort(key=lambda r: _listing_key(r[0]))
+    with open(out_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+## merges the result directories of all shards of a run into resultdir, writing <name>_output.json
+## -- raises ValueError when shards are missing, duplicated or from runs with different counts
+def merge_shards(shard_dirs, name, resultdir):
+    manifests = [read_manifest(d) for d in shard_dirs]
+    counts = set(m['count'] for m in manifests)
+    if len(counts) != 1:
+        raise ValueError('Shards come from runs with different shard counts: %s' % sorted(counts))
+    count = counts.pop()
+    indices = sorted(m['index'] for m in manifests)
+    if indices != list(range(count)):
+        raise ValueError('Expected shards 0..%d, got %s' % (count - 1, indices))
+
+    os.makedirs(resultdir, exist_ok=True)
+    new_samples = os.path.join(str(resultdir), 'samples')
+    wd = os.getcwd()
+    merged = {'variables': {}, 'entities': []}
+    logs = {}
+    records = []
+    for shard_dir, manifest in zip(shard_dirs, manifests):
+        ## sample and error images -- names come from the raw images, so shards never collide
+        for sub in ('samples', 'error'):
+            src = os.path.join(shard_dir, sub)
+            if not os.path.isdir(src):
+                continue
+            for log in (QC_LOG_NAME, OBJECT_LOG_NAME):
+                if os.path.isfile(os.path.join(src, log)):
+                    logs.setdefault(log, []).append(os.path.join(src, log))
+            if os.path.isfile(os.path.join(src, MANIFEST_NAME)):
+                records.extend(_relocate_manifest(os.path.join(src, MANIFEST_NAME), manifest, new_samples))
+            shutil.copytree(src, os.path.join(str(resultdir), sub), dirs_exist_ok=True,
+                            ignore=shutil.ignore_patterns(QC_LOG_NAME, OBJECT_LOG_NAME, MANIFEST_NAME))
+
+        results_json = os.path.join(shard_dir, manifest['name'] + '_output.json')
+        if not os.path.isfile(results_json):
+            continue
+        with open(results_json, 'r') as f:
+            data = json.load(f)
+        old_samples = os.path.join(manifest['resultdir'], 'samples')
+        for entity in data['entities']:
+            _relocate(entity, old_samples, new_samples, wd)
+        merged['entities'].extend(data['entities'])
+
+    for log, paths in logs.items():
+        _merge_logs(paths, os.path.join(str(resultdir), 'error', log))
+    if records:
+        records.sort(key=lambda r: r[0])
+        with ManifestWriter(os.path.join(new_samples, MANIFEST_NAME)) as writer:
+            for _key, record in records:
+                writer.add(record)
+
+    out_json = os.path.join(str(resultdir), str(name) + '_output.json')
+    with open(out_json, 'w') as f:
+        json.dump(canonical_results(merged), f)
+    return out_json
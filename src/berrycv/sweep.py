@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+sweep.py -- evaluating many settings of the analysis steps over one decode of each sample image
+
+A sweep file lists parameter sets of the analysis (names and defaults in analysis.PARAMS), either
+as a list of sets or as a grid whose every combination is a set:
+
+    [{"id": "narrow", "disease_hue_max": 20}, {"id": "wide", "disease_hue_max": 30, "disease_sat_min": 20}]
+    {"disease_hue_max": [20, 25, 30], "mask_fill": [500, 1000]}     -- sets p000..p005
+
+Settings not given keep their defaults. run_sweep() runs the selected steps once per set on one
+image; the sets share one store of intermediates, so the image is decoded once and the HSV image,
+contours and masked pixels are computed once per distinct value of the settings they depend on.
+Observations are recorded under the sample label tagged with the set id (<label>|<id>), along with
+a parameter_set observation holding the id.
+"""
+import json
+import itertools
+
+from .analysis import PARAMS, run_steps
+
+
+## separator between a sample label and the id of its parameter set
+SET_SEPARATOR = '|'
+
+
+## checks the settings of a parameter set -- raises ValueError on unknown names or invalid values
+def _check_params(params):
+    unknown = sorted(set(params) - set(PARAMS))
+    if unknown:
+        raise ValueError('Unknown sweep parameters %s -- known are %s' % (unknown, sorted(PARAMS)))
+    blur = params.get('bloom_blur', PARAMS['bloom_blur'])
+    if int(blur) != blur or blur < 1 or blur % 2 == 0:
+        raise ValueError('bloom_blur must be an odd positive kernel size -- got %s' % blur)
+    return params
+
+
+## [(id, params)] of a sweep given as a list of sets or a grid of values per parameter
+def parameter_sets(sweep):
+    if isinstance(sweep, dict):
+        names = sorted(sweep)
+        grid = [v if isinstance(v, list) else [v] for v in (sweep[n] for n in names)]
+        sets = [dict(zip(names, values)) for values in itertools.product(*grid)]
+        width = max(3, len(str(len(sets) - 1)))
+        return [('p%0*d' % (width, i), _check_params(s)) for i, s in enumerate(sets)]
+
+    parsed = []
+    for i, s in enumerate(sweep):
+        s = dict(s)
+        set_id = str(s.pop('id', 'p%03d' % i))
+        if SET_SEPARATOR in set_id:
+            raise ValueError('Parameter set id \'%s\' must not contain \'%s\'' % (set_id, SET_SEPARATOR))
+        parsed.append((set_id, _check_params(s)))
+    ids = [set_id for set_id, _p in parsed]
+    if len(set(ids)) != len(ids):
+        raise ValueError('Parameter set ids must be unique -- got %s' % ids)
+    return parsed
+
+
+## parameter sets of a sweep file
+def read_sweep(path):
+    with open(path, 'r') as f:
+        return parameter_sets(json.load(f))
+
+
+## runs the selected steps on one sample image for every parameter set -- no result images are written
+def run_sweep(img, steps, results, label, sets, pool=None, approximate=None):
+    store = {}
+    for set_id, params in sets:
+        tagged = label + SET_SEPARATOR + set_id
+        results.add_observation(sample=tagged, variable='parameter_set', trait='parameter set of the sweep',
+                                method='berrycv.sweep', scale='none', datatype=str,
+                                value=set_id, label='none')
+        run_steps(img, steps, results, tagged, pool=pool, approximate=approximate, params=params, store=store)
+    return store
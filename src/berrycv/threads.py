@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+threads.py -- one thread budget shared by the analysis worker processes and the native libraries in them
+
+OpenCV, the BLAS behind NumPy and OpenMP each start a thread pool per core in every worker process,
+so n workers on c cores run n * c threads and throughput falls as workers are added. The budget
+splits the cores between the workers instead: each worker process is started with the OpenMP/BLAS
+limits in its environment (read by the libraries when they load) and sets OpenCV's thread count
+with limit_threads(), so workers x threads per worker never exceeds the cores.
+
+With n_workers 'auto' the split follows the image size: sample crops, where a parallel region costs
+more than it saves, run as one single-threaded worker per core; full frames run as fewer workers of
+one thread per PIXELS_PER_THREAD pixels. A fixed n_workers gets the cores divided between its workers.
+"""
+import os
+
+from PIL import Image
+
+
+## environment variables limiting the thread pools of the native libraries of a worker process
+THREAD_ENV = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+              'NUMEXPR_NUM_THREADS', 'OPENCV_FOR_THREADS_NUM')
+
+## environment variable the workers read their OpenCV thread count from
+WORKER_THREADS_ENV = 'BERRYCV_THREADS'
+
+## pixels of a median image per thread of its worker when the workers are planned automatically
+PIXELS_PER_THREAD = 1500000
+
+## images whose size is read to plan the workers
+SIZE_PROBES = 8
+
+
+## cores this process may run on
+def available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+## median pixel count of up to 'probes' evenly spaced images -- only the headers are read, 0 without images
+def image_pixels(paths, probes=SIZE_PROBES):
+    paths = [p for p in paths if p is not None]
+    if not paths:
+        return 0
+    step = max(1, len(paths) // probes)
+    sizes = []
+    for path in paths[::step][:probes]:
+        try:
+            with Image.open(path) as img:
+                sizes.append(img.width * img.height)
+        except (OSError, ValueError):
+            continue
+    return sorted(sizes)[len(sizes) // 2] if sizes else 0
+
+
+## n_workers from a command flag -- 'auto' or a positive count
+def parse_workers(value):
+    if str(value).lower() == 'auto':
+        return 'auto'
+    workers = int(value)
+    if workers < 1:
+        raise ValueError('Workers must be \'auto\' or a positive count -- got \'%s\'' % value)
+    return workers
+
+
+class ThreadBudget:
+
+    ## cores -- threads the workers may run in total, None for the cores of this process
+    ## workers -- worker processes, 'auto' (or None) to choose them from the image size
+    def __init__(self, cores=None, workers='auto'):
+        self.cores = max(1, int(cores)) if cores else available_cores()
+        if workers in (None, 'auto'):
+            self.workers = None
+        else:
+            self.workers = max(1, int(workers))
+
+    ## (worker processes, threads per worker) for images of a median pixel count
+    ## -- more workers than cores are cut to the cores
+    def plan(self, pixels):
+        if self.workers is not None:
+            workers = min(self.workers, self.cores)
+            return workers, max(1, self.cores // workers)
+        threads = min(self.cores, max(1, int(pixels // PIXELS_PER_THREAD)))
+        return max(1, self.cores // threads), threads
+
+    ## environment of a worker process running 'threads' threads
+    def env(self, threads, base=None):
+        env = dict(os.environ if base is None else base)
+        for var in THREAD_ENV + (WORKER_THREADS_ENV,):
+            env[var] = str(threads)
+        return env
+
+    def report(self, workers, threads, pixels):
+        return ('Thread budget: %d cores, %d workers x %d threads (%s, median image %.2f MP)' %
+                (self.cores, workers, threads, 'auto' if self.workers is None else 'n_workers %d' % self.workers,
+                 pixels / 1e6))
+
+
+## sets OpenCV's thread count of a worker process from its budget -- returns it, None outside a budget
+def limit_threads():
+    threads = os.environ.get(WORKER_THREADS_ENV)
+    if not threads:
+        return None
+    import cv2
+
+    cv2.setNumThreads(int(threads))
+    return int(threads)
@@ -5,9 +5,11 @@ utils.py -- utiities for directory management and file IO
 import os.path
 import json
 import glob
+import datetime
 import cv2
-import plantcv as pcv
-import matplotlib.pyplot as pyplot
+from PIL import Image, ExifTags
+
+from .imcache import image_cache
 
 
 ## creates subdirectory by name
@@ -22,8 +24,12 @@ def create_sub(sub):
             pass
 
 ## reads in an image and makes the color channel adjustments from BGR to RGB
+## -- through the process's decoded-image cache when one is set (see imcache.py)
 def read_image(name, flip_red_blue=False):
     try:
+        cache = image_cache()
+        if cache is not None:
+            return cache.read(name, flip_red_blue=flip_red_blue)
         img = cv2.imread(name)
         if flip_red_blue:
             img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB) ## step necessary to flip channels upon read
@@ -32,9 +38,48 @@ def read_image(name, flip_red_blue=False):
         print('Unable to open \'%s\':\n' % name)
         return []
 
+## reads the original capture datetime from the exif data, falls back to the current time
+def read_exif_datetime(filepath):
+    try:
+        ## read the date and time of the photo from a dict of the exif data
+        with Image.open(filepath) as exif_img:
+            exif_tags = {ExifTags.TAGS[i]: j for i, j in exif_img._getexif().items() if i in ExifTags.TAGS}
+
+        ## store original capture datetime
+        return exif_tags['DateTimeOriginal']
+    except Exception:
+        return datetime.datetime.now().strftime('%Y-%m-%d %H-%M-%S')
+
+## lists the images under a directory (recursively) with the given extension, sorted for a stable order
+def list_images(indir, imgformat='jpg'):
+    ext = '.' + str(imgformat).lower().lstrip('.')
+    images = []
+    for dirpath, dirnames, filenames in os.walk(indir):
+        dirnames.sort()
+        for f in sorted(filenames):
+            if f.lower().endswith(ext):
+                images.append(os.path.join(dirpath, f))
+    return images
+
+## whether a path is a list file of images (a .txt file, one path per line) rather than an image or directory
+def is_image_list(path):
+    return os.path.splitext(str(path))[1].lower() == '.txt' and os.path.isfile(path)
+
+## reads the image paths of a list file -- one per line, blank lines skipped
+def read_image_list(path):
+    with open(path, 'r') as f:
+        return [line.rstrip('\n') for line in f if line.strip()]
+
+## creates a file or updates its modification time -- the heartbeat of a sampling job (see scheduler.py)
+def touch(path):
+    with open(path, 'a'):
+        os.utime(path, None)
+
 ## returns a binary mask of the image for use in object detection
 def generate_thresh_mask(img):
-    
+    ## plantcv is slow to import -- load it only when this is called
+    from plantcv import plantcv as pcv
+
     ## first isolate the saturation channel, threshold it
     s = pcv.rgb2gray_hsv(rgb_img=img, channel='s')
     s_th = pcv.threshold.triangle(gray_img=s, max_value=255, object_type='light', xstep=20)
@@ -63,6 +108,7 @@ def generate_thresh_mask(img):
 
 ## image show func for pyplot output
 def show_image(i):
+    import matplotlib.pyplot as pyplot
     pyplot.imshow(i)
     pyplot.show()
 
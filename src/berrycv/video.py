@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+"""
+video.py -- sampling berries filmed on a conveyor belt by a fixed camera
+
+The frames of a video are decoded on a background thread into a bounded queue, so only a few are
+in memory at once. Frames hardly differing from the last one sampled (the belt stopped) are
+skipped, and frames of an empty belt -- whose threshold would only split noise -- have no objects.
+Every other frame is masked as a photo is (berrycv.masks) and its objects are tracked from
+frame to frame: each object is matched to the track whose box, moved on by the track's last step,
+overlaps it most (IoU), or else whose center is nearest, within a box diagonal. A track which is
+not seen for max_missed frames has left the belt, and its berry is written out once, cropped from
+its best frame -- the sharpest (variance of the Laplacian) of the frames it is whole in.
+
+QR labels on the belt mark the lots: the labels are read every qr_every frames, and a new label
+starts a lot with the berries seen from the frame the label came into view. The objects of the
+label card itself are tracked but not sampled. The samples go to one directory per lot, named as
+the samples of the photo modes, and are analyzed as they are.
+"""
+import os
+import datetime
+import queue
+import threading
+import contextlib
+
+import cv2
+import numpy as np
+
+from .read_qr import readQRs
+from .utils import create_sub, touch
+from .pipeline import ImageWriter, PREFETCH_DEPTH, WRITE_QUEUE_SIZE
+from .buffers import worker_pool
+from .masks import generate_mask, apply_mask, find_objects, auto_crop
+from .metrics import run_metrics
+from .manifest import MANIFEST_NAME, ManifestWriter, sample_record
+from .segment import sample_filename, label_str, name_from_path, QR_PADDING
+
+
+## extensions read as videos
+VIDEO_FORMATS = ('.mp4', '.avi', '.mov', '.mkv')
+
+## frames between QR label reads
+QR_EVERY = 5
+
+## overlap of a track's predicted box and an object's box for them to be matched
+MIN_IOU = 0.3
+
+## center shift, in box diagonals, of an object matched to a track without overlap
+MAX_SHIFT = 1.0
+
+## frames a track may go unseen before its berry is written out
+MAX_MISSED = 3
+
+## pixels of the smallest object tracked -- specks of mask noise are smaller
+MIN_AREA = 200
+
+## mean difference (0-255) of 1/8-scale grayscale frames below which a frame repeats the last one
+STILL_DIFF = 1.0
+
+## standard deviation (0-255) of a 1/8-scale grayscale frame below which the belt is empty
+EMPTY_STD = 3.0
+
+## pixels of background around a cropped berry, as the photo modes
+_PADDING = 10
+
+
+def is_video(path):
+    return str(path).lower().endswith(VIDEO_FORMATS)
+
+
+## the videos of a directory (recursively), or the video itself, sorted for a stable order
+def list_videos(path):
+    if not os.path.isdir(path):
+        return [str(path)]
+    videos = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        videos.extend(os.path.join(dirpath, f) for f in sorted(filenames) if is_video(f))
+    return videos
+
+
+## yields (index, frame) of a video in order, decoded on a background thread at most 'depth' frames ahead
+def read_frames(path, depth=PREFETCH_DEPTH):
+    capture = cv2.VideoCapture(str(path))
+    if not capture.isOpened():
+        raise ValueError('Unable to read the video \'%s\'' % path)
+    frames = queue.Queue(maxsize=max(1, int(depth)))
+    stop = threading.Event()
+
+    def decode():
+        index = 0
+        while not stop.is_set():
+            ok, frame = capture.read()
+            item = (index, frame) if ok else None
+            while not stop.is_set():
+                try:
+                    frames.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if item is None:
+                return
+            index += 1
+
+    thread = threading.Thread(target=decode, name='bcv-video', daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = frames.get()
+            if item is None:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+        capture.release()
+
+
+## intersection over union of boxes (x, y, w, h) -- a (len(a), len(b)) matrix
+def box_iou(a, b):
+    a = np.asarray(a, dtype=np.float64).reshape(-1, 4)
+    b = np.asarray(b, dtype=np.float64).reshape(-1, 4)
+    x0 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y0 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x1 = np.minimum(a[:, None, 0] + a[:, None, 2], b[None, :, 0] + b[None, :, 2])
+    y1 = np.minimum(a[:, None, 1] + a[:, None, 3], b[None, :, 1] + b[None, :, 3])
+    inter = np.clip(x1 - x0, 0, None) * np.clip(y1 - y0, 0, None)
+    union = (a[:, 2] * a[:, 3])[:, None] + (b[:, 2] * b[:, 3])[None, :] - inter
+    return inter / np.maximum(union, 1e-9)
+
+
+class Track:
+
+    def __init__(self, track_id, box, frame):
+        self.id = track_id
+        self.box = np.asarray(box, dtype=np.float64)
+        self.step = np.zeros(2)
+        self.birth = frame
+        self.missed = 0
+        self.label = False
+
+        ## best frame so far -- (whole, sharpness), the cropped sample and its frame
+        self.score = None
+        self.sample = None
+        self.frame = None
+
+    ## box expected in the next frame -- moved on by the last step
+    def predicted(self):
+        return np.concatenate([self.box[:2] + self.step, self.box[2:]])
+
+    def center(self):
+        return self.box[:2] + self.box[2:] / 2.0
+
+    def move(self, box):
+        box = np.asarray(box, dtype=np.float64)
+        self.step = (box[:2] + box[2:] / 2.0) - self.center()
+        self.box = box
+        self.missed = 0
+
+
+## matches the objects of each frame to the tracks of the objects of the frames before
+class ObjectTracker:
+
+    def __init__(self, min_iou=MIN_IOU, max_shift=MAX_SHIFT, max_missed=MAX_MISSED):
+        self.min_iou = min_iou
+        self.max_shift = max_shift
+        self.max_missed = max_missed
+        self.tracks = []
+        self._next_id = 0
+
+    ## (track of each box, tracks ended) for the boxes (x, y, w, h) of the objects of frame
+    ## -- matched greedily, by overlap with the predicted boxes and then by center distance
+    def update(self, boxes, frame):
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        matched = [None] * len(boxes)
+        free = set(range(len(self.tracks)))
+        if self.tracks and len(boxes):
+            predicted = np.array([t.predicted() for t in self.tracks])
+            iou = box_iou(predicted, boxes)
+            for t, b in zip(*np.unravel_index(np.argsort(-iou, axis=None, kind='stable'), iou.shape)):
+                if iou[t, b] < self.min_iou:
+                    break
+                if t in free and matched[b] is None:
+                    matched[b] = self.tracks[t]
+                    free.discard(t)
+
+            ## objects moving by more than their size between frames -- nearest center within a box diagonal
+            centers = predicted[:, :2] + predicted[:, 2:] / 2.0
+            shift = np.hypot(*(centers[:, None, :] - (boxes[None, :, :2] + boxes[None, :, 2:] / 2.0)).transpose(2, 0, 1))
+            shift /= np.hypot(predicted[:, 2], predicted[:, 3])[:, None]
+            for t, b in zip(*np.unravel_index(np.argsort(shift, axis=None, kind='stable'), shift.shape)):
+                if shift[t, b] > self.max_shift:
+                    break
+                if t in free and matched[b] is None:
+                    matched[b] = self.tracks[t]
+                    free.discard(t)
+
+        for b, box in enumerate(boxes):
+            if matched[b] is None:
+                matched[b] = Track(self._next_id, box, frame)
+                self._next_id += 1
+                self.tracks.append(matched[b])
+            else:
+                matched[b].move(box)
+
+        ended = []
+        for t in sorted(free):
+            track = self.tracks[t]
+            track.missed += 1
+            if track.missed > self.max_missed:
+                ended.append(track)
+        if ended:
+            self.tracks = [t for t in self.tracks if t not in ended]
+        return matched, ended
+
+    ## the tracks still open, ended -- at the end of a video
+    def finish(self):
+        ended, self.tracks = self.tracks, []
+        return ended
+
+
+class VideoIngest:
+
+    ## sample_dir -- directory of the lot directories of samples; object_filter -- berrycv.ObjectFilter or None
+    ## qr_every -- frames between QR label reads; still_diff -- frame difference below which a frame is skipped
+    def __init__(self, sample_dir, object_filter=None, qr_every=QR_EVERY, min_iou=MIN_IOU, max_shift=MAX_SHIFT,
+                 max_missed=MAX_MISSED, min_area=MIN_AREA, still_diff=STILL_DIFF, empty_std=EMPTY_STD, metrics=None):
+        if qr_every < 1:
+            raise ValueError('QR labels must be read every 1 or more frames, not %d' % qr_every)
+        self.sample_dir = str(sample_dir)
+        self.object_filter = object_filter
+        self.qr_every = qr_every
+        self.min_iou = min_iou
+        self.max_shift = max_shift
+        self.max_missed = max_missed
+        self.min_area = min_area
+        self.still_diff = still_diff
+        self.empty_std = empty_std
+        self.metrics = metrics if metrics is not None else run_metrics()
+        self.manifest = None
+
+    ## capture time of frame 0 -- the video's modification time less its duration
+    @staticmethod
+    def _start_time(path, capture_fps, frame_count):
+        start = os.path.getmtime(path)
+        if capture_fps > 0 and frame_count > 0:
+            start -= frame_count / capture_fps
+        return datetime.datetime.fromtimestamp(start)
+
+    ## keeps the crop of an object when this frame is its track's best -- whole (off the frame edge) and sharpest
+    def _score(self, track, obj, box, frame_img, gray, mask, index):
+        x, y, w, h = box
+        whole = x > 0 and y > 0 and x + w < gray.shape[1] and y + h < gray.shape[0]
+        score = (whole, float(cv2.Laplacian(gray[y:y + h, x:x + w], cv2.CV_64F).var()))
+        if track.score is None or score > track.score:
+            track.score = score
+            track.frame = index
+            crop_mask = auto_crop(mask, obj, padding_x=_PADDING, padding_y=_PADDING, color='image')
+            crop_img = auto_crop(frame_img, obj, padding_x=_PADDING, padding_y=_PADDING, color='image')
+            track.sample = apply_mask(crop_img, crop_mask, 'white')
+
+    ## writes the berries of ended tracks to the directories of their lots -- returns their number
+    def _write(self, tracks, writer, path, lots, start, fps, counts):
+        written = 0
+        for track in sorted(tracks, key=lambda t: t.id):
+            if track.label or track.sample is None:
+                self.metrics.inc('tracks_total', result='label' if track.label else 'empty')
+                continue
+            lot = [name for frame, name in lots if frame <= track.birth][-1]
+            sample_id = counts.get(lot, 0)
+            counts[lot] = sample_id + 1
+            dt = (start + datetime.timedelta(seconds=track.frame / fps)).strftime('%Y-%m-%d %H-%M-%S')
+            lot_dir = os.path.join(self.sample_dir, label_str(lot) + '/')
+            create_sub(lot_dir)
+            sample_path = lot_dir + sample_filename(dt, lot, sample_id, 'VIS', 0) + '.jpg'
+            writer.write(sample_path, track.sample)
+            if self.manifest is not None:
+                record = sample_record(sample_path, path, dt, lot, label_str(lot), sample_id, 'VIS', 0)
+                record.update({'frame': track.frame, 'track': track.id})
+                self.manifest.add(record)
+            track.sample = None
+            self.metrics.inc('tracks_total', result='sampled')
+            written += 1
+        self.metrics.inc('samples_total', written)
+        return written
+
+    ## samples the berries of one video -- returns the number of samples written
+    ## heartbeat -- file touched after every frame (see SegmentationEngine.run)
+    def sample_video(self, path, writer, pool=None, depth=PREFETCH_DEPTH, heartbeat=None):
+        if pool is None:
+            pool = worker_pool()
+        capture = cv2.VideoCapture(str(path))
+        fps = capture.get(cv2.CAP_PROP_FPS) or 0.0
+        frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+        capture.release()
+        start = self._start_time(path, fps, frame_count)
+        fps = fps if fps > 0 else 1.0
+
+        ## (first frame, lot) -- the berries before the first label are named after the video
+        lots = [(0, name_from_path(path))]
+        counts = {}
+        tracker = ObjectTracker(self.min_iou, self.max_shift, self.max_missed)
+        self.metrics.begin('sampling', frame_count)
+        written = 0
+        last_thumb = None
+        for index, frame_img in read_frames(path, depth):
+            self.metrics.advance()
+            if heartbeat is not None:
+                touch(heartbeat)
+            with pool.scope():
+                gray = cv2.cvtColor(frame_img, cv2.COLOR_BGR2GRAY)
+
+                ## the belt stopped -- the frame repeats the last one sampled
+                thumb = cv2.resize(gray, (max(1, gray.shape[1] // 8), max(1, gray.shape[0] // 8)),
+                                   interpolation=cv2.INTER_AREA)
+                if last_thumb is not None and cv2.absdiff(thumb, last_thumb).mean() < self.still_diff:
+                    self.metrics.inc('video_frames_total', result='still')
+                    continue
+                last_thumb = thumb
+
+                ## nothing on the belt -- the open tracks go on unseen
+                if thumb.std() < self.empty_std:
+                    self.metrics.inc('video_frames_total', result='empty')
+                    _tracks, ended = tracker.update([], index)
+                    written += self._write(ended, writer, path, lots, start, fps, counts)
+                    continue
+                self.metrics.inc('video_frames_total', result='tracked')
+
+                with self.metrics.time('mask'):
+                    mask = generate_mask(frame_img, pool=pool)
+                    objects, _hierarchy = find_objects(mask)
+                    objects = [o for o in objects if cv2.contourArea(o) >= self.min_area]
+                    if self.object_filter is not None:
+                        objects, rejected = self.object_filter.apply(mask, objects)
+                        for reason, n in rejected.items():
+                            if n:
+                                self.metrics.inc('objects_rejected_total', n, reason=reason)
+
+                with self.metrics.time('track'):
+                    boxes = [cv2.boundingRect(o) for o in objects]
+                    tracks, ended = tracker.update(boxes, index)
+                    for track, obj, box in zip(tracks, objects, boxes):
+                        self._score(track, obj, box, frame_img, gray, mask, index)
+
+                ## QR labels on the belt -- the objects of a label card are not sampled, a new label starts a lot
+                if index % self.qr_every == 0:
+                    with self.metrics.time('locate'):
+                        labels = readQRs(frame_img)
+                    for qr, rect in labels:
+                        rx, ry, rw, rh = rect
+                        on_card = [t for t, (x, y, w, h) in zip(tracks, boxes)
+                                   if rx - QR_PADDING <= x + w / 2.0 <= rx + rw + QR_PADDING and
+                                   ry - QR_PADDING <= y + h / 2.0 <= ry + rh + QR_PADDING]
+                        for track in on_card:
+                            track.label = True
+                        if qr != lots[-1][1]:
+                            first = min([t.birth for t in on_card] + [index])
+                            lots.append((max(first, lots[-1][0]), qr))
+                            print('Lot %s from frame %d of %s' % (qr, first, path))
+
+            written += self._write(ended, writer, path, lots, start, fps, counts)
+
+        written += self._write(tracker.finish(), writer, path, lots, start, fps, counts)
+        print('%d berries in %d lots of %s' % (written, len(counts), path))
+        return written
+
+    ## samples a video or the videos of a directory -- frames are decoded ahead and samples written behind
+    ## manifest, heartbeat -- as for SegmentationEngine.run
+    def run(self, video, prefetch=PREFETCH_DEPTH, write_queue=WRITE_QUEUE_SIZE, manifest=None, heartbeat=None):
+        create_sub(self.sample_dir)
+        pool = worker_pool()
+        try:
+            self.manifest = ManifestWriter(manifest or os.path.join(self.sample_dir, MANIFEST_NAME),
+                                           append=manifest is None and not os.path.isdir(video))
+        except OSError as e:
+            print('Unable to write the sample manifest to \'%s\': %s' % (self.sample_dir, e))
+
+        written = 0
+        with ImageWriter(maxsize=write_queue) as writer, self.manifest or contextlib.nullcontext():
+            for path in list_videos(video):
+                written += self.sample_video(path, writer, pool, prefetch, heartbeat)
+        self.manifest = None
+        return written
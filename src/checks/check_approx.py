@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+check_approx.py -- the approximate color and disease steps against the exact ones on examples/
+
+Every example photo runs through the color and disease steps exactly and with --approximate as a
+pixel count and as a sample rate (the mask given, as the analysis workflow does). Each estimated
+channel mean must be within two recorded 95% half-widths of the mean of the exact histogram, and the
+estimated disease factor within two half-widths of the exact one.
+
+    python checks/check_approx.py [examples dir]        (from src)
+"""
+import os
+import sys
+import glob
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import berrycv as bcv  ## local library
+from berrycv.color import COLOR_CHANNELS
+
+## --approximate values checked: a pixel count and a sample rate
+APPROXIMATE = (10000, 0.01)
+## allowed error, in recorded 95% half-widths
+TOLERANCE = 2.0
+
+
+## observations of the color and disease steps and their time in ms -- the second of two runs
+def run(img, mask, approximate):
+    for _ in range(2):
+        results = bcv.Results()
+        t = time.perf_counter()
+        bcv.run_steps(img, ['color', 'disease'], results, 'x', pool=None, approximate=approximate, mask=mask)
+        elapsed = (time.perf_counter() - t) * 1e3
+    return results.observations['x'], elapsed
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    indir = argv[0] if argv else os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'examples')
+    files = sorted(glob.glob(os.path.join(indir, '*.jpg')))
+    failed = 0
+    for f in files:
+        img = bcv.read_image(f)
+        mask = bcv.generate_mask(img)
+        exact, t_exact = run(img, mask, None)
+        for approximate in APPROXIMATE:
+            est, t_est = run(img, mask, approximate)
+            worst = 0.0
+            for var, _trait, values, _bins in COLOR_CHANNELS:
+                exact_mean = np.dot(np.array(exact[var]['value']) / 100, values)
+                mean = est[var.replace('_frequencies', '_mean')]['value']
+                ci = est[var.replace('_frequencies', '_mean_ci95')]['value']
+                worst = max(worst, abs(mean - exact_mean) / max(ci, 1e-9))
+            d, d_ci = est['disease_factor']['value'], est['disease_factor_ci95']['value']
+            d_exact = exact['disease_factor']['value']
+            ok = worst <= TOLERANCE and abs(d - d_exact) <= TOLERANCE * d_ci
+            failed += not ok
+            print('%s %s --approximate %g: %d of %d pixels, worst mean error %.2f half-widths, disease %.4f vs %.4f'
+                  ' +- %.4f -- %.1f ms instead of %.1f ms' %
+                  ('PASS' if ok else 'FAIL', os.path.basename(f), approximate, est['color_sampled_pixels']['value'],
+                   est['color_total_pixels']['value'], worst, d, d_exact, d_ci, t_est, t_exact))
+    if not files:
+        print('FAIL no photos in %s' % indir)
+    sys.exit(1 if failed or not files else 0)
+
+
+if __name__ == '__main__':
+    main()
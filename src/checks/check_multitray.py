@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+check_multitray.py -- multi-tray sampling of synthetic photos: a row of trays, a grid of trays, a single tray
+and a row with an unreadable label
+
+Each tray is a QR label in its top left corner and a 3 x 2 grid of drawn berries, tray k holding
+k + 3 of them, so a berry filed under another tray's label changes the counts. The photos are sampled
+with the multitray mode and the samples of every label are counted. A photo with a tray whose label
+cannot be read must not be sampled at all, but sent to the error directory as unassigned.
+
+    python checks/check_multitray.py        (from src)
+"""
+import os
+import sys
+import json
+import tempfile
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import berrycv as bcv  ## local library
+
+
+## pixels of a tray and the gap between trays
+TRAY = (700, 900)
+GAP = 60
+
+
+## a tray of n berries under the QR label text -- white background; no label when text is None
+def draw_tray(text, n):
+    tray = np.full(TRAY + (3,), 255, np.uint8)
+    if text is not None:
+        ## the labels end in a line break, which readQR strips
+        q = cv2.QRCodeEncoder.create().encode(text + '\r\n')
+        q = cv2.resize(q, (q.shape[1] * 8, q.shape[0] * 8), interpolation=cv2.INTER_NEAREST)
+        tray[30:30 + q.shape[0], 30:30 + q.shape[1]] = cv2.cvtColor(q, cv2.COLOR_GRAY2BGR)
+    for k in range(n):
+        center = (330 + (k % 3) * 200, 320 + (k // 3) * 200)
+        cv2.ellipse(tray, center, (45 + 3 * k, 40), 10 * k, 0, 360, (90, 40, 60), -1)
+    return tray
+
+
+## photo of trays laid out in rows x columns, tray unread without a label -- returns it and the expected samples
+## of each label, none when a tray has no label
+def draw_photo(name, rows, columns, unread=None):
+    photo = np.full((rows * (TRAY[0] + GAP) + GAP, columns * (TRAY[1] + GAP) + GAP, 3), 255, np.uint8)
+    expected = {}
+    for k in range(rows * columns):
+        r, c = divmod(k, columns)
+        label = '%s-%d' % (name, k)
+        y, x = GAP + r * (TRAY[0] + GAP), GAP + c * (TRAY[1] + GAP)
+        photo[y:y + TRAY[0], x:x + TRAY[1]] = draw_tray(None if k == unread else label, k + 3)
+        expected[label] = k + 3
+    return photo, {} if unread is not None else expected
+
+
+def main():
+    layouts = [('row', 1, 4, None), ('grid', 2, 2, None), ('single', 1, 1, None), ('unread', 1, 4, 1)]
+    failed = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, rows, columns, unread in layouts:
+            indir = os.path.join(tmp, name)
+            os.makedirs(indir)
+            photo, expected = draw_photo(name, rows, columns, unread)
+            cv2.imwrite(os.path.join(indir, name + '.jpg'), photo, [cv2.IMWRITE_JPEG_QUALITY, 95])
+
+            sample_dir = os.path.join(tmp, name + '-out', 'samples')
+            os.makedirs(sample_dir)
+            engine = bcv.SegmentationEngine.for_mode('multitray', sample_dir, sample_dir.replace('samples', 'error'))
+            engine.run(indir)
+
+            counts = {}
+            with open(os.path.join(sample_dir, bcv.manifest.MANIFEST_NAME)) as f:
+                for line in f:
+                    record = json.loads(line)
+                    counts[record['qr']] = counts.get(record['qr'], 0) + 1
+            error = os.path.exists(os.path.join(sample_dir.replace('samples', 'error'), name + '_unassigned.jpg'))
+            ok = counts == expected and error == (unread is not None)
+            failed += not ok
+            print('%s %s (%d x %d trays%s): expected %s, got %s%s' %
+                  ('PASS' if ok else 'FAIL', name, rows, columns, ', tray %d unread' % unread if unread is not None else '',
+                   expected, counts, ', sent to the error directory as unassigned' if error else ''))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
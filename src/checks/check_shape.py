@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+check_shape.py -- berrycv.analyze_shapes against pcv.analyze_object on the samples of examples/
+
+The example photos are sampled with the photobooth mode; on every sample the objects are measured
+with repeated pcv.analyze_object calls (what the shape step used to do) and with analyze_shapes, and
+every trait analyze_shapes records must equal plantcv's (the ellipse traits are not reported).
+
+    python checks/check_shape.py [examples dir]        (from src)
+"""
+import os
+import sys
+import glob
+import time
+import tempfile
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import berrycv as bcv  ## local library
+
+## traits of pcv.analyze_object which analyze_shapes does not report
+ELLIPSE_TRAITS = {'ellipse_center', 'ellipse_major_axis', 'ellipse_minor_axis', 'ellipse_angle',
+                  'ellipse_eccentricity'}
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    from plantcv import plantcv as pcv
+    from plantcv.plantcv.classes import Outputs
+
+    indir = argv[0] if argv else os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'examples')
+    mismatches = 0
+    t_pcv = t_bcv = 0.0
+    with tempfile.TemporaryDirectory() as tmp:
+        sample_dir = os.path.join(tmp, 'samples')
+        os.makedirs(sample_dir)
+        bcv.SegmentationEngine.for_mode('photobooth', sample_dir, os.path.join(tmp, 'error')).run(indir)
+        files = sorted(glob.glob(os.path.join(sample_dir, '**', '*.jpg'), recursive=True))
+        for f in files:
+            img = cv2.imread(f)
+            mask = bcv.generate_mask(img)
+            objects, _hierarchy = bcv.find_objects(mask)
+
+            pcv.outputs.clear()
+            t = time.perf_counter()
+            for obj in objects:
+                pcv.analyze_object(img=img, obj=obj, mask=mask, label='s')
+            t_pcv += time.perf_counter() - t
+
+            outputs = Outputs()
+            t = time.perf_counter()
+            bcv.analyze_shapes(mask, objects, outputs, label='s')
+            t_bcv += time.perf_counter() - t
+
+            expected = pcv.outputs.observations.get('s', {})
+            got = outputs.observations.get('s', {})
+            if set(got) != set(expected) - ELLIPSE_TRAITS:
+                mismatches += 1
+                print('FAIL %s: traits differ %s' % (f, sorted(set(got) ^ (set(expected) - ELLIPSE_TRAITS))))
+                continue
+            for trait in got:
+                a, b = expected[trait]['value'], got[trait]['value']
+                if not np.allclose(np.array(a, dtype=float), np.array(b, dtype=float)):
+                    mismatches += 1
+                    print('FAIL %s: %s plantcv %s, berrycv %s' % (f, trait, a, b))
+
+    print('%s %d samples, %d mismatches -- pcv.analyze_object %.2f s, analyze_shapes %.2f s' %
+          ('PASS' if not mismatches and files else 'FAIL', len(files), mismatches, t_pcv, t_bcv))
+    sys.exit(1 if mismatches or not files else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+check_shards.py -- K shard processes merged against a single run of examples/
+
+main.py runs once over the input directory, then K times with --shard i/K side by side (one
+process each, its own result directory), and --merge combines the shards into the result directory
+of the single run. Every file of the merged result must be byte for byte the file of the single run.
+main.py runs from src and writes its configuration into src/config, which is restored afterwards.
+
+    python checks/check_shards.py [-k K] [-a "shape color"] [-i examples dir]        (from src)
+"""
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN = os.path.join(SRC, 'main.py')
+CONFIG = os.path.join(SRC, 'config')
+
+
+def options(argv=None):
+    parser = argparse.ArgumentParser(description="Compare K merged shards with a single run.")
+    parser.add_argument("-k", "--shards", help="Number of shards.", type=int, default=3)
+    parser.add_argument("-a", "--analysis", help="Analysis steps.", default="shape color")
+    parser.add_argument("-i", "--indir", help="Input image folder.", default=os.path.join(SRC, '..', 'examples'))
+    return parser.parse_args(argv)
+
+
+def run_main(args, cwd, log):
+    with open(log, 'w') as f:
+        return subprocess.Popen([sys.executable, MAIN] + args, cwd=cwd, stdout=f, stderr=subprocess.STDOUT)
+
+
+## last lines of a log of main.py
+def tail(log, n=20):
+    with open(log) as f:
+        return ''.join(f.readlines()[-n:])
+
+
+## relative paths of the files under a directory
+def listing(top):
+    return sorted(os.path.relpath(os.path.join(d, f), top) for d, _dirs, files in os.walk(top) for f in files)
+
+
+def main(argv=None):
+    args = options(argv)
+    indir = os.path.abspath(args.indir)
+    failed = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        saved = os.path.join(tmp, 'config')
+        shutil.copytree(CONFIG, saved)
+        means = os.path.join(SRC, 'mv_means.csv')
+        keep_means = os.path.exists(means)
+        out = os.path.join(tmp, 'out')
+        single = os.path.join(tmp, 'single')
+        try:
+            ## single run, moved aside so the merge can write the same result directory
+            common = ['-a'] + args.analysis.split() + ['-i', indir, '-n', 'check', '-P']
+            log = os.path.join(tmp, 'single.log')
+            if run_main(common + ['-r', out], SRC, log).wait():
+                print('FAIL single run\n' + tail(log))
+                return 1
+            shutil.move(out, single)
+
+            ## K shards side by side
+            shard_dirs = [os.path.join(tmp, 'shard%d' % i) for i in range(args.shards)]
+            logs = [os.path.join(tmp, 'shard%d.log' % i) for i in range(args.shards)]
+            procs = [run_main(common + ['-r', d, '--shard', '%d/%d' % (i, args.shards)], SRC, log)
+                     for i, (d, log) in enumerate(zip(shard_dirs, logs))]
+            for i, (p, log) in enumerate(zip(procs, logs)):
+                if p.wait():
+                    print('FAIL shard %d/%d\n%s' % (i, args.shards, tail(log)))
+                    return 1
+            log = os.path.join(tmp, 'merge.log')
+            if run_main(['-n', 'check', '-r', out, '--merge'] + shard_dirs, SRC, log).wait():
+                print('FAIL merge\n' + tail(log))
+                return 1
+        finally:
+            shutil.rmtree(CONFIG)
+            shutil.copytree(saved, CONFIG)
+            if not keep_means and os.path.exists(means):
+                os.remove(means)
+
+        a, b = listing(single), listing(out)
+        for f in sorted(set(a) ^ set(b)):
+            failed += 1
+            print('FAIL only in %s: %s' % ('the single run' if f in a else 'the merge', f))
+        for f in sorted(set(a) & set(b)):
+            with open(os.path.join(single, f), 'rb') as fa, open(os.path.join(out, f), 'rb') as fb:
+                if fa.read() != fb.read():
+                    failed += 1
+                    print('FAIL differs: %s' % f)
+        print('%s %d shards merged against a single run: %d files compared, %d differences' %
+              ('PASS' if not failed else 'FAIL', args.shards, len(set(a) & set(b)), failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
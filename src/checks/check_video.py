@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+check_video.py -- conveyor video sampling of a synthetic belt: berries counted per lot and cropped whole
+
+A 720p video of a belt is rendered: a QR label card, 6 drawn berries, a second card and 6 more
+berries pass the camera at 24 pixels a frame, the belt stops for 15 frames on the way, and every
+frame gets camera noise. The berries are ellipses of different sizes, so a berry sampled twice, cut
+in two, cropped at the frame edge or filed under the wrong lot shows up. The video is sampled as
+with -V, and every lot must hold its 6 berries, each cropped whole -- its box and the padding.
+
+    python checks/check_video.py        (from src)
+"""
+import os
+import sys
+import json
+import tempfile
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import berrycv as bcv  ## local library
+from berrycv.video import _PADDING
+
+## frame size, belt speed in pixels per frame, frames of the stop and the frame rate
+FRAME = (720, 1280)
+SPEED = 24
+STOP = (60, 75)
+FPS = 30
+
+## lots on the belt, each a label card and its berries
+LOTS = [('LOT-A:1', 6), ('LOT-B:2', 6)]
+
+## pixels a mask edge may move under the compression and noise
+TOLERANCE = 4
+
+
+## the QR label card of text -- the labels end in a line break, which readQR strips
+def draw_card(text):
+    q = cv2.QRCodeEncoder.create().encode(text + '\r\n')
+    q = cv2.resize(q, (q.shape[1] * 8, q.shape[0] * 8), interpolation=cv2.INTER_NEAREST)
+    return cv2.cvtColor(q, cv2.COLOR_GRAY2BGR)
+
+
+## berry k -- half axes of an upright ellipse, each berry a different size
+def berry_axes(k):
+    return 36 + 3 * k, 30 + 2 * k
+
+
+## items on the belt, (belt position, top, card image or berry number), and the berries of each lot
+def layout():
+    items, lots, pos, k = [], {}, 0, 0
+    for text, n in LOTS:
+        items.append((pos, 200, draw_card(text)))
+        pos += 320
+        lots[text] = []
+        for _ in range(n):
+            items.append((pos, 140 + (k % 2) * 280, k))
+            lots[text].append(k)
+            pos += 170
+            k += 1
+        pos += 150
+    return items, lots, pos
+
+
+## renders the belt video -- the items enter from the left
+def render(path, items, length):
+    rng = np.random.default_rng(0)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), FPS, FRAME[::-1])
+    offset, n = -200, 0
+    while offset < length + FRAME[1]:
+        frame = np.full(FRAME + (3,), 250, np.uint8)
+        for pos, top, item in items:
+            x = offset - pos
+            if isinstance(item, int):
+                a, b = berry_axes(item)
+                cv2.ellipse(frame, (x + a, top + b), (a, b), 0, 0, 360, (90, 40, 60), -1)
+                continue
+            h, w = item.shape[:2]
+            x0, x1 = max(0, x), min(FRAME[1], x + w)
+            if x1 > x0:
+                frame[top:top + h, x0:x1] = item[:, x0 - x:x1 - x]
+        frame = np.clip(frame + rng.normal(0, 2, frame.shape), 0, 255).astype(np.uint8)
+        writer.write(frame)
+        n += 1
+        if not STOP[0] <= n < STOP[1]:
+            offset += SPEED
+    writer.release()
+    return n
+
+
+def main():
+    items, lots, length = layout()
+    failed = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        video = os.path.join(tmp, 'belt.avi')
+        frames = render(video, items, length)
+        sample_dir = os.path.join(tmp, 'samples')
+        bcv.VideoIngest(sample_dir).run(video)
+
+        samples = {}
+        with open(os.path.join(sample_dir, bcv.manifest.MANIFEST_NAME)) as f:
+            for line in f:
+                record = json.loads(line)
+                samples.setdefault(record['qr'], []).append(record)
+        for text, berries in lots.items():
+            ## tracks are numbered as the berries come into view, in belt order
+            records = sorted(samples.pop(text, []), key=lambda r: r['track'])
+            sizes = [cv2.imread(r['path']).shape[:2] for r in records]
+            expected = [(2 * b + 1 + 2 * _PADDING, 2 * a + 1 + 2 * _PADDING) for a, b in map(berry_axes, berries)]
+            if len(sizes) != len(expected):
+                failed += 1
+                print('FAIL lot %s: %d berries, %d samples' % (text, len(expected), len(sizes)))
+                continue
+            ok = all(abs(s[0] - e[0]) <= TOLERANCE and abs(s[1] - e[1]) <= TOLERANCE for s, e in zip(sizes, expected))
+            failed += not ok
+            print('%s lot %s: %d berries, %d samples -- crops %s, expected %s' %
+                  ('PASS' if ok else 'FAIL', text, len(expected), len(sizes), sizes, expected))
+        for lot, records in samples.items():
+            failed += 1
+            print('FAIL %d samples in unexpected lot %s' % (len(records), lot))
+    print('%s %d frames' % ('PASS' if not failed else 'FAIL', frames))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,22 +6,24 @@ Description: main script for executing all stages of sample segmentation, featur
 and file conversion for workflows from parsed args
 Author: TJ Schultz
 Date: 6/7/2023
--- various seemingly unused dependencies are imported in this script
-    to successfully build the application using pyinstaller
+-- the workflow modules are imported inside the functions which run them, so startup does not pay
+    for plantcv, matplotlib or pandas; pyinstaller still finds and bundles them from those imports
 """
 
+import time
+## cold start is measured from the first statement of the script
+_T_START = time.perf_counter()
+
 import argparse
 import json
 import sys
 import os
 import subprocess
-import cv2
-import numpy as np
+import platform
+import shutil
+
 import berrycv as bcv
-from plantcv import plantcv as pcv
-from sample_workflow import *
-from analysis_workflow import *
-from mv_means import *
+
 ## warning control
 python_hand = 'python'
 if not sys.warnoptions:
@@ -29,26 +31,58 @@ if not sys.warnoptions:
     warnings.simplefilter("ignore")
     os.environ["PYTHONWARNINGS"] = "ignore"
 
-## fix multiple options issue with argparser
-to_exclude = ['options']
-for _m in to_exclude:
-    del globals()[_m]
+## cold-start budget in seconds -- from the first statement until the configuration is written and
+## sampling starts (~0.05 s measured; importing plantcv, matplotlib and pandas up front took ~3 s).
+## a pyinstaller onefile build unpacks itself before python starts, which is not included here
+STARTUP_BUDGET = 1.0
+
+f_missing_message = 'is missing or in an incorrect format. Exiting.'
+
 
-print(os.getcwd())
 ## define command flags for launching the workflows
-def options():
+def options(argv=None):
     parser = argparse.ArgumentParser(description="Image processing workflow with PlantCV.")
     parser.add_argument("-a", "--analysis",
                         help="List of analysis steps to run separated by space. Includes 'shape', 'color'->", \
-                        nargs="*", required=True)
-    parser.add_argument("-i", "--indir", help="Input image folder directory", required=True)
+                        nargs="*")
+    parser.add_argument("-i", "--indir", help="Input image folder directory")
     parser.add_argument("-n","--name", help="Name of the result files without extension.", required=True)
     parser.add_argument("-r", "--resultdir", help="Output directory for results files.", required=True)
     parser.add_argument("-P", "--photobooth", help="Indicate photobooth use (building samples)", action="store_true")
     parser.add_argument("-S", "--single", help="Indicate single sample mode (one masked photo per input photo)", action="store_true")
+    parser.add_argument("-M", "--multitray", help="Indicate multi-tray mode (several trays with their own QR labels per photo)",
+                        action="store_true")
+    parser.add_argument("-V", "--video", help="Indicate conveyor videos as input (berries tracked across frames)",
+                        action="store_true")
     parser.add_argument("-vv", "--verbose", help="Toggles verbose output during workflow. Used in debugging.", required=False)
+    parser.add_argument("--shard", help="Process only shard INDEX/COUNT of the input photos (e.g. 0/4).",
+                        type=bcv.parse_shard, default=None)
+    parser.add_argument("--metrics", help="Prometheus textfile-collector file the run metrics are written to.",
+                        default=None)
+    parser.add_argument("--approximate", help="Estimate color and disease from a pixel sample of each image -- "
+                                              "a sample rate (< 1) or a pixel count (>= 1).",
+                        type=float, default=None)
+    parser.add_argument("--sweep", help="JSON file of analysis parameter sets to evaluate in one run (see Parameter sweeps).",
+                        default=None)
+    parser.add_argument("--workers", help="Analysis worker processes, or 'auto' to choose them from the image size.",
+                        type=bcv.threads.parse_workers, default=None)
+    parser.add_argument("--threads", help="Threads the analysis workers may run in total (default all cores).",
+                        type=int, default=None)
+    parser.add_argument("--merge", help="Merge the result directories of all shards of a run into --resultdir.",
+                        nargs="+", default=None)
     ## read command flags
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.merge is None and (args.analysis is None or args.indir is None):
+        parser.error("the following arguments are required: -a/--analysis, -i/--indir")
+    if args.threads is not None and args.threads < 1:
+        parser.error("--threads must be at least 1")
+    if args.approximate is not None and args.approximate <= 0:
+        parser.error("--approximate must be a positive sample rate or pixel count")
+    if args.sweep is not None:
+        try:
+            bcv.read_sweep(args.sweep)
+        except (OSError, ValueError) as e:
+            parser.error("invalid --sweep file: %s" % e)
     print(args)
     return args
 
@@ -57,113 +91,276 @@ def resource_path(relative_path):
     base_path = getattr(sys, '_MEIPASS', os.path.dirname(os.path.abspath(__file__)))
     return os.path.join(base_path, relative_path)
 
-## obtain args
-args = options()
+## sampling mode selected by the -P/-S/-M flags
+def sample_mode(args):
+    if args.single:
+        return "single"
+    elif args.multitray:
+        return "multitray"
+    elif args.photobooth:
+        return "photobooth"
+    return "leaf"
 
-## read configuration files necessary for running all stages of the workflow
-## read launch configuration -- config.json
-f_missing_message = 'is missing or in an incorrect format. Exiting.'
+## configuration files of the run -- a shard works on copies in its result directory, so that several
+## shards can run side by side from one installation
+def config_paths(args):
+    paths = [resource_path('./config/sample-workflow_config.json'),
+             resource_path('./config/analyze-workflow_config.json')]
+    if args.shard is None:
+        return paths
+    shard_config = os.path.join(str(args.resultdir), 'config')
+    bcv.create_sub(str(args.resultdir))
+    bcv.create_sub(shard_config)
+    shard_paths = [os.path.join(shard_config, os.path.basename(p)) for p in paths]
+    for p, shard_p in zip(paths, shard_paths):
+        shutil.copyfile(p, shard_p)
+    return shard_paths
 
-## define relative paths
-sample_config_path = resource_path('./config/sample-workflow_config.json')
-analyze_config_path = resource_path('./config/analyze-workflow_config.json')
+## read sample extraction workflow configuration -- sample-workflow_config.json
+def write_sample_config(args, config_path):
+    try:
+        with open(config_path, 'r+') as _f:
+            sample_config = json.load(_f)
+            sample_config['input_dir'] = str(args.indir)
+            sample_config['img_outdir'] = os.path.join(str(args.resultdir), 'samples')
+            if args.single:
+                sample_config['workflow'] = "single_sample_workflow.py"
+            elif args.photobooth or args.multitray or args.video:
+                sample_config['workflow'] = "sample_workflow.py"
+            else:
+                sample_config['workflow'] = "sample_leaf_workflow.py"
+            _f.seek(0)        ## seek f
+            json.dump(sample_config, _f, indent=4)
+            _f.truncate()     ## remove end
+    except Exception:
+        print('config/sample-workflow_config.json', f_missing_message)
+        sys.exit(1)
+    return sample_config
 
-bcv.create_sub('config')
+## read feature extraction workflow configuration -- analyze-workflow_config.json
+def write_analyze_config(args, sample_config, config_path):
+    try:
+        with open(config_path, 'r+') as _f:
+            analyze_config = json.load(_f)
+            bcv.create_sub(str(args.resultdir))
+            analyze_config['input_dir'] = os.path.join(sample_config['img_outdir'])
+            analyze_config['json'] = os.path.join(str(args.resultdir), str(args.name) + "_output.json")
 
-## read sample extraction workflow configuration -- sample-workflow_config.json
-try:
-    sample_config = []
-    with open(sample_config_path, 'r+') as _f:
-        sample_config = json.load(_f)
-        sample_config['input_dir'] = str(args.indir)
-        sample_config['img_outdir'] = os.path.join(str(args.resultdir), 'samples')
-        if args.single:
-            sample_config['workflow'] = "single_sample_workflow.py"
-        elif args.photobooth:
-            sample_config['workflow'] = "sample_workflow.py"
-        else:
-            sample_config['workflow'] = "sample_leaf_workflow.py"
-        _f.seek(0)        ## seek f
-        json.dump(sample_config, _f, indent=4)
-        _f.truncate()     ## remove end
-except:
-    print('config/sample-workflow_config.json', f_missing_message)
-    sys.exit(1)
+            ## fix img_outdir
+            analyze_config['img_outdir'] = str(args.resultdir)
 
+            ## add analysis args
+            analyze_config['other_args'] = ['--analysis', ' '.join(args.analysis)]
+            if args.approximate is not None:
+                analyze_config['other_args'] += ['--approximate', str(args.approximate)]
+            if args.sweep is not None:
+                analyze_config['other_args'] += ['--sweep', os.path.abspath(args.sweep)]
+            ## thread budget of the analysis workers (berrycv.threads)
+            if args.threads is not None:
+                analyze_config['thread_budget'] = args.threads
+            if args.workers is not None:
+                analyze_config['cluster_config']['n_workers'] = args.workers
+            if sample_config.get('image_cache'):
+                analyze_config['other_args'] += ['--image-cache', str(sample_config['image_cache']),
+                                                 '--image-cache-size', str(sample_config.get('image_cache_size', '20GB'))]
 
+            _f.seek(0)  ## seek f
+            json.dump(analyze_config, _f, indent=4)
+            _f.truncate()  ## remove end
+    except Exception:
+        print('config/analyze-workflow_config.json', f_missing_message)
+        sys.exit(1)
+    return analyze_config
 
-## read feature extraction workflow configuration -- analyze-workflow_config.json
-try:
-    analyze_config = []
-    with open(analyze_config_path, 'r+') as _f:
-        analyze_config = json.load(_f)
-        bcv.create_sub(str(args.resultdir))
-        analyze_config['input_dir'] = os.path.join(sample_config['img_outdir'])
-        analyze_config['json'] = os.path.join(str(args.resultdir), str(args.name) + "_output.json")
+## get scripts directory
+## -- take the directory or the path of the sys.executable object (different platforms)
+def scripts_dir():
+    if platform.system() in ["Windows"]:
+        if os.path.isdir(sys.executable):
+            return os.path.join(sys.executable, 'Scripts')
+        return os.path.join(os.path.dirname(sys.executable), 'Scripts')
+    return os.path.dirname(sys.executable)
+
+## sample_workflow.py flags of the object_filter limits of the sampling configuration
+def object_filter_args(limits):
+    flags = []
+    for key in ('min_area', 'max_area', 'max_aspect', 'min_solidity'):
+        if limits.get(key) is not None:
+            flags += ['--' + key.replace('_', '-'), str(limits[key])]
+    if limits.get('reject_border'):
+        flags.append('--reject-border')
+    return flags
 
-        ## fix img_outdir
-        analyze_config['img_outdir'] = str(args.resultdir)
+## sample_workflow.py flags of the color_correction settings of the sampling configuration
+def color_correction_args(settings):
+    if not settings.get('target'):
+        return []
+    flags = ['--color-target', str(settings['target'])]
+    for card in settings.get('cards', []):
+        flags += ['--color-card', str(card)]
+    if settings.get('lut_dir'):
+        flags += ['--lut-dir', str(settings['lut_dir'])]
+    if settings.get('lut_bits') is not None:
+        flags += ['--lut-bits', str(settings['lut_bits'])]
+    return flags
 
-        ## add analysis args
-        analyze_config['other_args'] = ['--analysis', ' '.join(args.analysis)]
+## duplicate finder of the dedup settings of the sampling configuration -- None without a policy
+def duplicate_finder(settings, threads=2):
+    if not settings.get('policy'):
+        return None
+    return bcv.DuplicateFinder(max_distance=settings.get('max_distance', bcv.dedup.MAX_DISTANCE),
+                               method=settings.get('hash') or 'dhash', policy=settings['policy'], threads=threads)
 
-        _f.seek(0)  ## seek f
-        json.dump(analyze_config, _f, indent=4)
-        _f.truncate()  ## remove end
+## sample_workflow.py flags of the video settings of the sampling configuration
+def video_args(settings):
+    flags = []
+    for key, flag in (('qr_every', '--qr-every'), ('min_iou', '--track-iou'), ('max_missed', '--track-missed'),
+                      ('still_diff', '--still-diff')):
+        if settings.get(key) is not None:
+            flags += [flag, str(settings[key])]
+    return flags
 
-except:
-    print('config/analyze-workflow_config.json', f_missing_message)
-    sys.exit(1)
+## run sample_workflow.py on the photos (or videos) of the input directory through the job scheduler
+## (berrycv.scheduler) -- chunks of job_chunk photos per process, each photo within job_timeout seconds and
+## the process within the memory of cluster_config; photos which keep failing go to the error directory with a
+## failure record. near-duplicate photos are set aside here, before the photos are split between the processes
+def run_sampling(args, sample_config):
+    sample_dir = sample_config['img_outdir']
+    bcv.create_sub(os.path.join(str(args.resultdir), 'samples'))
+    io_threads = sample_config.get('io_threads', 2)
+    command = ([python_hand, resource_path('sample_workflow.py'), '--mode', sample_mode(args),
+                '--outdir', sample_dir, '--imgformat', str(sample_config['imgformat']),
+                '--prefetch', str(sample_config.get('prefetch', 2)), '--io-threads', str(io_threads),
+                '--write-queue', str(sample_config.get('write_queue', 32))] +
+               (['--no-qc'] if not sample_config.get('preflight_qc', True) else []) +
+               (['--no-marker-cache'] if not sample_config.get('marker_cache', True) else []) +
+               (['--marker-cache', str(sample_config['marker_cache_file'])]
+                if sample_config.get('marker_cache_file') else []) +
+               (['--image-cache', str(sample_config['image_cache']),
+                 '--image-cache-size', str(sample_config.get('image_cache_size', '20GB'))]
+                if sample_config.get('image_cache') else []) +
+               object_filter_args(sample_config.get('object_filter') or {}) +
+               color_correction_args(sample_config.get('color_correction') or {}) +
+               (['--video'] + video_args(sample_config.get('video') or {}) if args.video else []))
 
+    ## photos in listing order, or the videos one per job
+    indir = str(args.indir)
+    if args.video:
+        paths, chunk = bcv.video.list_videos(indir), 1
+    else:
+        paths = bcv.list_images(indir, str(sample_config['imgformat'])) if os.path.isdir(indir) else [indir]
+        chunk = sample_config.get('job_chunk', bcv.scheduler.SAMPLE_CHUNK)
+    if args.shard is not None:
+        paths = bcv.shards.select_shard(paths, indir, *args.shard)
 
+    with bcv.MetricsReporter(path=args.metrics) as reporter:
+        ## one photo of each group of repeated or near-duplicate photos -- the others go to the manifest
+        records = []
+        finder = None if args.video else duplicate_finder(sample_config.get('dedup') or {}, io_threads)
+        if finder is not None:
+            with reporter.metrics.time('dedup'):
+                paths, duplicates = finder.select(paths)
+            for duplicate, kept, distance in duplicates:
+                print('Skipping %s -- duplicate of %s (%d bits)' % (duplicate, kept, distance))
+                records.append(bcv.manifest.duplicate_record(duplicate, kept, distance))
 
-## apply to main configuration -- config.json
-print('Sampling configuration:', sample_config)
-print('Analysis configuration:', analyze_config)
+        ## workers and threads per worker within the thread budget
+        cluster_config = sample_config.get('cluster_config') or {}
+        budget = bcv.ThreadBudget(sample_config.get('thread_budget'), cluster_config.get('n_workers', 1))
+        pixels = 0 if args.video else bcv.threads.image_pixels(paths)
+        workers, threads = budget.plan(pixels)
+        print(budget.report(workers, threads, pixels))
 
-## get the working directory
-wd_dir = os.getcwd()
+        summary = bcv.scheduler.run_sampling_jobs(
+            command, paths, sample_dir, sample_dir.replace('samples', 'error'), chunk=chunk, workers=workers,
+            timeout=sample_config.get('job_timeout', bcv.scheduler.JOB_TIMEOUT),
+            memory_limit=bcv.scheduler.parse_memory(cluster_config.get('memory')),
+            retries=sample_config.get('job_retries', bcv.scheduler.JOB_RETRIES),
+            metrics=reporter.metrics, env=budget.env(threads), records=records)
+    print('Sampling: %d of %d photos in %d jobs, %d retried, %d failed' %
+          (summary['photos'] - len(summary['failed']), summary['photos'], summary['jobs'], summary['retried'],
+           len(summary['failed'])))
+    return summary
 
-## get scripts directory
-## -- take the directory or the path of the sys.executable object (different platforms)
-import platform
+## run the plantcv analysis workflow -- one process per sample image with a time and memory limit
+## (berrycv.scheduler); samples which keep failing go to the error directory with a failure record
+def run_analysis(args, config_path):
+    with bcv.MetricsReporter(path=args.metrics):
+        summary = bcv.scheduler.run_workflow(config_path, error_dir=os.path.join(str(args.resultdir), 'error'))
+    print('Analysis: %d of %d samples, %d retried, %d failed' %
+          (summary['succeeded'], summary['jobs'], summary['retried'], len(summary['failed'])))
+    return summary
 
-if platform.system() in ["Windows"]:
-    s_dir = ''
-    if os.path.isdir(sys.executable):
-        s_dir = os.path.join(sys.executable, 'Scripts')
-    else:
-        s_dir = os.path.join(os.path.dirname(sys.executable), 'Scripts')
-else:
-    s_dir = os.path.dirname(sys.executable)
+## call plantcv_utils.py : json2csv, then the color means
+def run_compilation(args, s_dir):
+    import mv_means
+
+    ## get output json name
+    results_json = os.path.join(str(args.resultdir), str(args.name) + "_output.json")
+
+    sample_set_name = str(args.name)
+    rc = subprocess.call([python_hand, os.path.join(s_dir, 'plantcv-utils.py'), 'json2csv', '-j', results_json,\
+                          '-c', os.path.join(args.resultdir, sample_set_name)], shell=False)
+    if rc != 0:
+        print('plantcv-utils.py json2csv exited with code %d. Exiting.' % rc)
+        sys.exit(rc)
+
+    mv_means.run(str(args.name), str(args.resultdir), str(args.resultdir))
+
+    ## mergeable population statistics of the run -- combined across runs with season_stats.py
+    stats = bcv.PopulationStats.from_results(results_json)
+    stats.save(os.path.join(str(args.resultdir), sample_set_name + bcv.popstats.STATS_SUFFIX))
+    stats.write_csv(os.path.join(str(args.resultdir), sample_set_name + '_pop_stats.csv'))
+
+
+def main(argv=None):
+    print(os.getcwd())
+
+    ## obtain args
+    args = options(argv)
+
+    s_dir = scripts_dir()
+
+    ## combine the shards of a run, then compile them as a single run would
+    if args.merge is not None:
+        print('MERGING %d SHARDS' % len(args.merge))
+        bcv.create_sub(str(args.resultdir))
+        bcv.merge_shards(args.merge, str(args.name), str(args.resultdir))
+        run_compilation(args, s_dir)
+        return
+
+    ## read configuration files necessary for running all stages of the workflow
+    bcv.create_sub('config')
+    sample_config_path, analyze_config_path = config_paths(args)
+    sample_config = write_sample_config(args, sample_config_path)
+    analyze_config = write_analyze_config(args, sample_config, analyze_config_path)
+    if args.shard is not None:
+        bcv.shards.write_manifest(str(args.resultdir), args.shard[0], args.shard[1], str(args.name), str(args.indir))
 
-## main
+    ## apply to main configuration -- config.json
+    print('Sampling configuration:', sample_config)
+    print('Analysis configuration:', analyze_config)
 
-## before calling subprocesses, check input_dir for sampling
-if not os.path.exists(args.indir):
-    print("Input directory non-existent. Check flags.")
-    sys.exit(-1)
+    ## before running the stages, check input_dir for sampling
+    if not os.path.exists(args.indir):
+        print("Input directory non-existent. Check flags.")
+        sys.exit(-1)
 
-## call run sample_workflow -- create samples for extraction
-print('(1/3)\tSAMPLING')
+    startup = time.perf_counter() - _T_START
+    print('Startup: %.2f s (budget %.1f s)' % (startup, STARTUP_BUDGET))
+    if startup > STARTUP_BUDGET:
+        print('Warning: startup exceeded its budget -- check for slow module-level imports')
 
-bcv.create_sub(os.path.join(str(args.resultdir), 'samples'))
-subprocess.call([python_hand, os.path.join(s_dir, 'plantcv-workflow.py'), '--config',\
-                 'config/sample-workflow_config.json'], shell=False)
+    ## run sample_workflow -- create samples for extraction
+    print('(1/3)\tSAMPLING')
+    run_sampling(args, sample_config)
 
-print('(2/3)\tANALYSIS')
-## call plantcv_workflow.py
-subprocess.call([python_hand, os.path.join(s_dir, 'plantcv-workflow.py'), '--config',\
-                 'config/analyze-workflow_config.json'], shell=False)
+    print('(2/3)\tANALYSIS')
+    run_analysis(args, analyze_config_path)
 
-## get output json name
-results_json = os.path.join(str(args.resultdir), str(args.name) + "_output.json")
+    print('(3/3)\tDOWNSTREAM DATA COMPILATION')
+    run_compilation(args, s_dir)
 
-print('(3/3)\tDOWNSTREAM DATA COMPILATION')
-## call plantcv_utils.py : json2csv
-sample_set_name = str(args.name)
-subprocess.call([python_hand, os.path.join(s_dir, 'plantcv-utils.py'), 'json2csv', '-j', results_json,\
-                 '-c', os.path.join(args.resultdir, sample_set_name)], shell=False)
 
-subprocess.call([python_hand, 'mv_means.py', '-n', str(args.name), '-i', str(args.resultdir),\
-                 '-r', str(args.resultdir)], shell=False)
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,13 @@
 import os.path
 
-import pandas as pd
 import argparse
 import glob
 
-# for generating image tables of the color means by plantbarcode
-from PIL import Image, ImageDraw
-IMAGE = 0
+cspace_domains = ['blue_frequencies', 'green_frequencies', 'red_frequencies',\
+                  'lightness_frequencies', 'green-magenta_frequencies', 'blue-yellow_frequencies',\
+                  'hue_frequencies', 'saturation_frequencies', 'value_frequencies']
 
-def options():
+def options(argv=None):
     parser = argparse.ArgumentParser(description="Image processing workflow with PlantCV.",\
                                      prog='python -m mymodule')
     parser.add_argument("-n", "--name", help="Name from main args", required=True)
@@ -16,101 +15,87 @@ def options():
     parser.add_argument("-r", "--resultdir", help="Output directory for results files.", required=True)
 
     ## read command flags
-    args, _u = parser.parse_known_args()
+    args, _u = parser.parse_known_args(argv)
     return args
 
 
-args = options()
-path = os.path.join(os.getcwd(), str(args.indir))
-cspace_domains = ['blue_frequencies', 'green_frequencies', 'red_frequencies',\
-                  'lightness_frequencies', 'green-magenta_frequencies', 'blue-yellow_frequencies',\
-                  'hue_frequencies', 'saturation_frequencies', 'value_frequencies']
+## aggregates the color means of the json2csv multi-value csv files under indir into resultdir
+## -- pandas and berrycv are only imported when the aggregation runs
+def run(name, indir, resultdir):
+    import pandas as pd
+    # for the color swatches and report of the means by plantbarcode
+    from berrycv import report
 
-# fix in dir
+    path = os.path.join(os.getcwd(), str(indir))
 
+    # fix in dir
 
-# load dataframes
-masterdf = pd.DataFrame()
-for f in glob.glob(path + '/**/*.csv', recursive=True):
-    # only color data
 
-    if 'multi' not in f:
-        continue
-    df = pd.read_csv(f)
+    # load dataframes
+    masterdf = pd.DataFrame()
+    for f in glob.glob(path + '/**/*.csv', recursive=True):
+        # only color data
 
-    # append the dataframe to the master dataframe
-    if masterdf.size < 1:
-        masterdf = df
-    else:
-        masterdf = masterdf.append(df)
-
-# now for each independent plantbarcode, and sampleid
-# store the means in a new dataframe
-means = pd.DataFrame(columns=(['plantbarcode', 'id'] + cspace_domains))
-try:
-    pbcs = masterdf['plantbarcode'].unique()
-except:
-    pbcs = pd.DataFrame()
-# get unique plantbarcodes
-for p in pbcs:
-    # get unique ids
-    ids = masterdf[masterdf['plantbarcode'] == p]['id'].unique()
-
-    for i in ids:
-        # return the subset of the dataframe containing the relevant color data
-        sample = masterdf[masterdf['plantbarcode'] == p]
-        sample = sample[sample['id'] == i]
-
-        # calculate the prob means for the sample in every colorspace
-        row = {}
-        for dim in cspace_domains:
-            sum = 0
-            trait = sample[sample['trait'] == dim]
-            for label in trait['label'].unique():
-                sum += (float(trait[trait['label'] == label]['value'].mean()) / 100.00) * label
-            row[dim] = sum
-
-        # add information to row before appending to the result dataframe
-        row['plantbarcode'] = p
-        row['id'] = i
-        means = means.append(pd.DataFrame([row]))
-
-## get str of args name
-name = str(args.name)
-means.to_csv(os.path.join(str(args.resultdir), name + '_mv_means.csv'), index=False)
-
-# calculate population means -- drop id values
-means.drop('id', axis=1)
-pop_means = means.groupby('plantbarcode', as_index=False)[cspace_domains].mean()
-pop_means.to_csv(os.path.join(str(args.resultdir), name + '_mv_pop_means.csv'), index=False)
-
-agg = pd.DataFrame(columns=(['plantbarcode'] + cspace_domains))
-
-for p in pbcs:
-    sample = means[means['plantbarcode'] == p]
-    row = {}
-    for dim in cspace_domains:
-        sum = 0
-        for val in sample[dim]:
-            sum += val
-        row[dim] = sum / sample[dim].size
-    row['plantbarcode'] = p
-    agg = agg.append(pd.DataFrame([row]))
-agg.to_csv('mv_means.csv', index=False)
-
-img = None
-
-for p in pbcs:
-    r = int(agg[agg['plantbarcode']==p]['red_frequencies'])
-    g = int(agg[agg['plantbarcode']==p]['green_frequencies'])
-    b = int(agg[agg['plantbarcode']==p]['blue_frequencies'])
-    i = Image.new('RGB', (60, 30), color = (r, g, b))
-    if img is None:
-        img = i
+        if 'multi' not in f:
+            continue
+        df = pd.read_csv(f)
+
+        # append the dataframe to the master dataframe
+        if masterdf.size < 1:
+            masterdf = df
+        else:
+            masterdf = pd.concat([masterdf, df])
+
+    # now for each independent plantbarcode, and sampleid
+    # store the means in a new dataframe
+    if 'plantbarcode' not in masterdf:
+        pbcs = []
+        means = pd.DataFrame(columns=(['plantbarcode', 'id'] + cspace_domains))
     else:
-        dst = Image.new('RGB', (img.width, img.height + i.height))
-        dst.paste(img, (0, 0))
-        dst.paste(i, (0, img.height))
-        img = dst
-if IMAGE:
-    img.save('img.jpg')
\ No newline at end of file
+        # get unique plantbarcodes
+        pbcs = masterdf['plantbarcode'].unique()
+
+        # the prob means of every sample in every colorspace -- the mean frequency of each label,
+        # weighted by the label and summed over the labels, in one pass over the color rows
+        color = masterdf[masterdf['trait'].isin(cspace_domains)]
+        freq = color.groupby(['plantbarcode', 'id', 'trait', 'label'], sort=False)['value'].mean()
+        weighted = freq / 100.00 * freq.index.get_level_values('label')
+        sums = weighted.groupby(level=['plantbarcode', 'id', 'trait'], sort=False).sum().unstack('trait')
+
+        # one row per plantbarcode, and its ids, in order of appearance -- colorspaces without data are 0
+        samples = masterdf.drop_duplicates(['plantbarcode', 'id'])[['plantbarcode', 'id']]
+        rank = {p: k for k, p in enumerate(pbcs)}
+        samples = samples.sort_values('plantbarcode', key=lambda s: s.map(rank), kind='stable')
+        means = sums.reindex(index=pd.MultiIndex.from_frame(samples), columns=cspace_domains).fillna(0)
+        means = means.rename_axis(columns=None).reset_index()
+
+    ## get str of args name
+    name = str(name)
+    means.to_csv(os.path.join(str(resultdir), name + '_mv_means.csv'), index=False)
+
+    # calculate population means -- drop id values
+    means.drop('id', axis=1)
+    pop_means = means.groupby('plantbarcode', as_index=False)[cspace_domains].mean()
+    pop_means.to_csv(os.path.join(str(resultdir), name + '_mv_pop_means.csv'), index=False)
+
+    ## color means of the plantbarcodes in order of appearance
+    agg = means.groupby('plantbarcode', sort=False)[cspace_domains].mean().reindex(pbcs).reset_index()
+    agg.to_csv('mv_means.csv', index=False)
+
+    ## swatches and summary report -- sample counts and spread of the color means per plantbarcode
+    if len(pbcs):
+        spread = means.groupby('plantbarcode', sort=False)[cspace_domains].agg(['count', 'std']).reindex(pbcs)
+        report.write_report(name, resultdir, list(pbcs),
+                            agg[['red_frequencies', 'green_frequencies', 'blue_frequencies']].to_numpy(dtype=float),
+                            spread[(cspace_domains[0], 'count')].to_numpy(), cspace_domains,
+                            agg[cspace_domains].to_numpy(dtype=float),
+                            spread.xs('std', axis=1, level=1)[cspace_domains].to_numpy(dtype=float))
+
+
+def main(argv=None):
+    args = options(argv)
+    run(args.name, args.indir, args.resultdir)
+
+
+if __name__ == '__main__':
+    main()
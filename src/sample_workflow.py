@@ -5,262 +5,144 @@ Name: sample_workflow.py
 Description: sample creation workflow
 Author: TJ Schultz
 Date: 12/29/2021
+-- the segmentation itself is berrycv.SegmentationEngine; --mode selects the photobooth, leaf,
+    single-sample or multi-tray strategies (sample_leaf_workflow.py and single_sample_workflow.py preset it)
+-- --video (or a video as --image) samples conveyor videos with berrycv.VideoIngest instead
 """
 
-import matplotlib.pyplot as pyplot
-import glob
 import os.path
-import sys
 import argparse
-from datetime import date
-import re
-import datetime
-import math
 
-from plantcv import plantcv as pcv
 import berrycv as bcv  ## local library
-import cv2
-import numpy as np
-from PIL import Image, ExifTags
 
 ## workflow options for plantcv workflow -- add arguments for plantcv-workflow.py compatibility
-def options():
+def options(argv=None):
     parser = argparse.ArgumentParser(description="Imaging processing with PlantCV.",\
                                      prog='python -m mymodule')
-    parser.add_argument("-i", "--image", help="Input image file.", required=True)
+    parser.add_argument("-i", "--image", help="Input image file, directory or .txt list of image files.", required=True)
     parser.add_argument("-r","--result", help="Result file.", required= False )
     parser.add_argument("-o", "--outdir", help="Output directory for image files.", required=False)
     parser.add_argument("-w","--writeimg", help="Write out images.", default=False, action="store_true")
     parser.add_argument("-D", "--debug", help="Turn on debug, prints intermediate images.")
-    args, _u = parser.parse_known_args()
+    parser.add_argument("--mode", help="Sampling mode -- photobooth, leaf, single or multitray.", default="photobooth",
+                        choices=sorted(bcv.segment.MODES))
+    parser.add_argument("--imgformat", help="Image extension used when --image is a directory.", default="jpg")
+    parser.add_argument("--prefetch", help="Number of images decoded ahead of the current one in directory mode.",
+                        default=bcv.pipeline.PREFETCH_DEPTH, type=int)
+    parser.add_argument("--io-threads", help="Number of threads decoding images in directory mode.", default=2, type=int)
+    parser.add_argument("--write-queue", help="Number of image writes queued before sampling waits on the disk.",
+                        default=bcv.pipeline.WRITE_QUEUE_SIZE, type=int)
+    parser.add_argument("--shard", help="Sample only shard INDEX/COUNT of the input directory (e.g. 0/4).",
+                        type=bcv.shards.parse_shard, default=None)
+    parser.add_argument("--metrics", help="Prometheus textfile the run metrics are written to while sampling.",
+                        default=None)
+    parser.add_argument("--manifest", help="Sample manifest to write instead of the output directory's.", default=None)
+    parser.add_argument("--heartbeat", help="File touched after every photo or video frame.", default=None)
+    parser.add_argument("--metrics-json", help="JSON file the run metrics are saved to at the end.", default=None)
+    parser.add_argument("--marker-cache", help="JSON file the size marker calibrations are kept in between runs.",
+                        default=None)
+    parser.add_argument("--no-marker-cache", help="Measure the size markers on every photo instead of once per session.",
+                        dest="marker_cache_on", default=True, action="store_false")
+    parser.add_argument("--min-area", help="Drop objects of fewer pixels before cropping.", type=int, default=None)
+    parser.add_argument("--max-area", help="Drop objects of more pixels before cropping.", type=int, default=None)
+    parser.add_argument("--max-aspect", help="Drop objects whose bounding box is more elongated (long / short side).",
+                        type=float, default=None)
+    parser.add_argument("--min-solidity", help="Drop objects less solid (area / convex hull area).", type=float,
+                        default=None)
+    parser.add_argument("--reject-border", help="Drop objects touching the edge of the sample region.",
+                        default=False, action="store_true")
+    parser.add_argument("--dedup", help="Sample one photo of each group of near-duplicate photos, kept by policy.",
+                        default=None, choices=bcv.dedup.POLICIES)
+    parser.add_argument("--dedup-distance", help="Hash bits near-duplicate photos may differ in.",
+                        default=bcv.dedup.MAX_DISTANCE, type=int)
+    parser.add_argument("--dedup-hash", help="Perceptual hash of the duplicate check.", default="dhash",
+                        choices=sorted(bcv.dedup.HASHES))
+    parser.add_argument("--color-target", help="Photo of the color card in the reference colors.", default=None)
+    parser.add_argument("--color-card", help="Photo of the color card in a session to correct (repeatable).",
+                        dest="color_cards", default=[], action="append")
+    parser.add_argument("--lut-dir", help="Directory the compiled color correction tables are kept in.", default=None)
+    parser.add_argument("--lut-bits", help="Bits per channel indexing the color correction table (1-8).",
+                        default=bcv.colorcorr.LUT_BITS, type=int)
+    parser.add_argument("--video", help="Input is a conveyor video, or a directory of them, tracked frame by frame.",
+                        default=False, action="store_true")
+    parser.add_argument("--qr-every", help="Frames of a video between QR label reads.", default=bcv.video.QR_EVERY,
+                        type=int)
+    parser.add_argument("--track-iou", help="Box overlap of an object with a track for them to be matched.",
+                        default=bcv.video.MIN_IOU, type=float)
+    parser.add_argument("--track-missed", help="Frames a berry may go unseen before it is written out.",
+                        default=bcv.video.MAX_MISSED, type=int)
+    parser.add_argument("--still-diff", help="Mean frame difference (0-255) below which a video frame is skipped.",
+                        default=bcv.video.STILL_DIFF, type=float)
+    parser.add_argument("--no-qc", help="Skip the pre-flight quality check of raw images.", dest="qc",
+                        default=True, action="store_false")
+    parser.add_argument("--image-cache", help="Directory of the decoded-image cache (none to decode every image).",
+                        default=None)
+    parser.add_argument("--image-cache-size", help="Size limit of the decoded-image cache, e.g. 20GB.", default=None)
+    args, _u = parser.parse_known_args(argv)
     return args
 
-##
-
-## get the working directory
-wd = os.getcwd()
-
-## get args as namespaces dictionary
-args = vars(options())
-## create SAMPLE_SUBSET_NAME
-SAMPLE_SUBSET_NAME = os.path.dirname(args['image'])
-## create subfolders for image data
-sample_parent_dir = os.path.join(str(args['outdir']))
-error_parent_dir = sample_parent_dir.replace('samples', 'error')
-
-bcv.create_sub(sample_parent_dir)
-
-## assembles the sample filename with the metadata provided in the parameters
-def assemble_filename_str(dt_original, qr_raw, sample_id, img_type, mean_area):
-
-    ## format datetime string
-    dt_original_format = str(dt_original.replace(":", "-"))
-
-    ## format QR code data
-    qr_format = str(qr_raw.replace(":", "+"))
-    qr_format = str(qr_format.replace("|", "+"))
-
-    ## format id
-    sample_id_format = str(sample_id)
-
-    ## format img_type
-    img_type_format = str(img_type)
-
-    ## format mean area
-    mean_area_format = str(mean_area)
-
-    ## return filename string
-    return ("%s_%s_%s_%s_%s" % (dt_original_format, qr_format, sample_id_format, img_type_format, mean_area_format))
-
-## returns a binary mask of the image for use in object detection
-def generate_mask(img):
-
-    ## first isolate the saturation channel, threshold it
-    s = pcv.rgb2gray_hsv(rgb_img=img, channel='s')
-    s_th = pcv.threshold.triangle(gray_img=s, max_value=255, object_type='light', xstep=20)
-
-
-    ## then isolate the lightness channel, threshold it
-    l = pcv.rgb2gray_lab(rgb_img=img, channel='l')
-    l_th = pcv.threshold.triangle(gray_img=l, max_value=255, object_type='dark')
-
-    ## blur the saturation and lightness image to soften small features
-    s_th_blur = pcv.median_blur(gray_img=s_th, ksize=5)
-    l_th_blur = pcv.median_blur(gray_img=l_th, ksize=5)
-
-    ## 'logical or' the images to create a joined binary image
-    ls = pcv.logical_or(s_th_blur, l_th_blur)
-
-    ## pass a filled image back after logical-or joining the inverted fill
-    ls_fill = pcv.fill(bin_img=ls, size=1000)
-
-    ls_fill_inv = pcv.fill(bin_img=pcv.invert(ls_fill), size=1000)
-
-    ls_or_final = pcv.logical_or(pcv.invert(ls_fill_inv), ls_fill)
-    return ls_or_final
-
-
-## sample isolation and labeling workflow -- creates labeled images for workflow parallelization. filename provided for redundancy
-def build_samples(raw_img, filepath):
-
-        ## get the working directory
-        wd = os.getcwd()
-
-        try:
-            ## read the date and time of the photo from a dict of the exif data
-            exif_img = Image.open(filepath)
-            exif_tags = { ExifTags.TAGS[i]: j for i, j in exif_img._getexif().items() if i in ExifTags.TAGS }
-
-            ## store original capture datetime
-            dt_og = exif_tags['DateTimeOriginal']
-        except:
-            dt_og = datetime.datetime.now().strftime('%Y-%m-%d %H-%M-%S').replace('\..*','')
-
-        ## read the QR code information
-        qr = bcv.readQR(raw_img)
-
-        ## no qr detected, substitute for name
-        if qr == "":
-            ## isolate the name in filename to remove the full path and extension
-            ## correct for underscores in filenames for the plantbarcodes with dashes ('_' is the chosen delimeter for metadata)
-            name = os.path.basename(filepath).split('.')[0].replace('_', '-')
-            qr = name
-
-        ## crop image to exclude the QR
-        ##information
-        ## cut into 2/3rds to create sample image
-        sample_img = raw_img[:, math.floor(1*(raw_img.shape[1])/3):]
-
-        ## create mask and apply it to the cropped image
-        mask = generate_mask(sample_img)
-        masked = pcv.apply_mask(img=sample_img, mask=mask, mask_color='white')
-
-        ## identify objects
-        id_objects,obj_hierarchy = pcv.find_objects(img=sample_img, mask=mask)
-        print('\t')
-        print('Found %d objects in %s' % (len(id_objects), filepath))
-
-        ## create empty list for marker id objects
-        img_divisions = 10
-        marker_id_objects = []
-        while len(marker_id_objects) <= 0 and img_divisions >= 7:
-
-            ## create ROIs of the size markers
-            marker1_contour, marker1_hierarchy = pcv.roi.rectangle(img=sample_img, x=0, y=0,\
-                                                           h=math.floor(1*(sample_img.shape[0])/img_divisions), w=sample_img.shape[1])
-
-            marker2_contour, marker2_hierarchy = pcv.roi.rectangle(img=sample_img, x=0, y=math.floor((img_divisions-1)*(sample_img.shape[0])/img_divisions),\
-                                                           h=math.floor(1*(sample_img.shape[0])/img_divisions), w=sample_img.shape[1])
-
-            ## identify markers
-            marker1_objects, marker1_obj_hierarchy, marker1_kept_mask, _ = pcv.roi_objects(img=sample_img, roi_contour=marker1_contour,
-                                                                              roi_hierarchy=marker1_hierarchy,
-                                                                              object_contour=id_objects,
-                                                                              obj_hierarchy=obj_hierarchy,
-                                                                              roi_type='partial')
-
-            marker2_objects, marker2_obj_hierarchy, marker2_kept_mask, _ = pcv.roi_objects(img=sample_img, roi_contour=marker2_contour,
-                                                                              roi_hierarchy=marker2_hierarchy,
-                                                                              object_contour=id_objects,
-                                                                              obj_hierarchy=obj_hierarchy,
-                                                                              roi_type='partial')
-
-            ## create roi contour region of the sample data
-            roi_contour, roi_hierarchy = pcv.roi.rectangle(img=sample_img, x=0, y=math.floor(1*(sample_img.shape[0])/img_divisions),\
-                                                           h=math.floor((img_divisions-2)*(sample_img.shape[0])/img_divisions), w=sample_img.shape[1])
-
-
-            ## find sample roi objects
-            roi_objects, roi_obj_hierarchy, roi_kept_mask, obj_area = pcv.roi_objects(img=sample_img, roi_contour=roi_contour,
-                                                                              roi_hierarchy=roi_hierarchy,
-                                                                              object_contour=id_objects,
-                                                                              obj_hierarchy=obj_hierarchy,
-                                                                              roi_type='partial')
-
-            ## combine marker masks and sample data masks to filter objects
-            marker_mask = pcv.logical_or(marker1_kept_mask, marker2_kept_mask)
-
-            ## find items present in both masks
-            negative_mask = pcv.invert(pcv.logical_and(roi_kept_mask, marker_mask))
-
-            ## remove shared items from marker and sample masks
-            sample_mask = pcv.logical_and(negative_mask, roi_kept_mask)
-            marker_mask = pcv.logical_and(negative_mask, marker_mask)
-
-            ## filter objects into two id lists and hierarchies
-            marker_id_objects,marker_obj_hierarchy = pcv.find_objects(img=sample_img, mask=marker_mask)
-
-
-            ## create a new contour, hierarchy of the whole sample image for reporting size markers
-            marker_img = pcv.apply_mask(img=sample_img, mask=marker_mask, mask_color='white')
-            size_contour, size_hierarchy = pcv.roi.rectangle(img=marker_img, x=0, y=0,\
-                                                           h=sample_img.shape[0], w=sample_img.shape[1])
-
-            sample_id_objects,sample_obj_hierarchy = pcv.find_objects(img=sample_img, mask=sample_mask)
-            try:
-                marker_report = pcv.report_size_marker_area(img=marker_img, roi_contour=size_contour, roi_hierarchy=size_hierarchy, \
-                                                            marker='detect', objcolor='dark', thresh_channel='v', thresh=120, label="default")
-            except:
-                img_divisions -= 1 ## reduce divisions -- try again
-                continue
-            pcv.outputs.add_observation(sample='default', variable='num_markers', trait='number of size markers which contribute to the reported area -- used in determining the mean area', \
-                                        method='count of markers', scale='amount', datatype=int, \
-                                        value=len(marker_id_objects), label='markers')
-
-        ## error img
-        if (len(marker_id_objects) <= 0 and img_divisions < 7):
-            cv2.imwrite(os.path.join(error_parent_dir, str(qr.replace(":", "+")) + '.jpg'), raw_img)
-            return
-
-        pcv.params.debug = 'none'
-
-        ## calculate mean marker area and store for filename assembly
-        mean_marker_area = math.floor(pcv.outputs.observations['default']['marker_area']['value'] /\
-                                      pcv.outputs.observations['default']['num_markers']['value'])
-
-        ## for each object -- o will be a unique id passed into sample_id for the filename metadata
-        ## create subdirectories
-        s_d = str(qr.replace(":", "+"))
-        s_d = str(s_d.replace("|", "+") + "/")
-        sample_dir = os.path.join(sample_parent_dir, s_d)
-
-        bcv.create_sub(sample_dir)
-
-        for o in range(len(sample_id_objects)):
-
-
-            ## crop the mask around the ROI of the current object
-            crop_mask = pcv.auto_crop(img=mask, obj=sample_id_objects[o], padding_x=10, padding_y=10, color='image')
-
-            ## crop the image around the ROI of the current object
-            crop_img = pcv.auto_crop(img=masked, obj=sample_id_objects[o], padding_x=10, padding_y=10, color='image')
-
-            ## apply mask to cropped image and write image with filename metadata
-
-            final_img = pcv.apply_mask(img=crop_img, mask=crop_mask, mask_color='white')
-            #blur_img = pcv.gaussian_blur(img=crop_img, ksize=(17, 17), sigma_x=0, sigma_y=None)
-
-            ## create filename
-            filename_str = assemble_filename_str(dt_og, qr, o, "VIS", mean_marker_area)
-
-            ## save file
-            cv2.imwrite(sample_dir + filename_str + '.jpg', final_img)
-
-
-def main():
-
-    pcv.params.debug = "none"
-    raw_img = bcv.read_image(args['image'])
-
-    ## if not bad image, analyze
-    if not raw_img is None:
-        ## build samples
-        build_samples(raw_img, args['image'])
-        pcv.params.debug = 'none'
-        pcv.outputs.clear()
 
+def main(argv=None):
+
+    ## get args as namespaces dictionary
+    args = vars(options(argv))
+
+    ## OpenCV threads within the budget of a sampling job (berrycv.threads)
+    bcv.limit_threads()
+
+    ## create subfolders for image data
+    sample_parent_dir = os.path.join(str(args['outdir']))
+    error_parent_dir = sample_parent_dir.replace('samples', 'error')
+
+    ## decoded raw images are kept for reruns when there is a cache directory
+    if args['image_cache'] is not None:
+        bcv.set_image_cache(bcv.ImageCache(args['image_cache'],
+                                           bcv.scheduler.parse_memory(args['image_cache_size']) or bcv.imcache.CACHE_SIZE))
+
+    ## size markers measured once per camera and session
+    calibration = bcv.MarkerCalibration(args['marker_cache']) if args['marker_cache_on'] else None
+
+    ## dust, specks and fragments are dropped before cropping when any limit is given
+    object_filter = bcv.ObjectFilter.from_config(dict((k, args[k]) for k in ('min_area', 'max_area', 'max_aspect',
+                                                                              'min_solidity', 'reject_border')
+                                                      if args[k] not in (None, False)))
+
+    ## conveyor videos -- each berry is tracked across the frames and sampled once
+    if args['video'] or bcv.video.is_video(args['image']):
+        ingest = bcv.VideoIngest(sample_parent_dir, object_filter=object_filter, qr_every=args['qr_every'],
+                                 min_iou=args['track_iou'], max_missed=args['track_missed'],
+                                 still_diff=args['still_diff'])
+        with bcv.MetricsReporter(ingest.metrics, path=args['metrics']):
+            ingest.run(args['image'], prefetch=args['prefetch'], write_queue=args['write_queue'],
+                       manifest=args['manifest'], heartbeat=args['heartbeat'])
+        if args['metrics_json'] is not None:
+            ingest.metrics.save(args['metrics_json'])
+        return
+
+    ## raw photos corrected to the target card's colors per session when there is a target
+    color_correction = None
+    if args['color_target'] is not None:
+        color_correction = bcv.ColorCorrection(args['color_target'], args['color_cards'], lut_dir=args['lut_dir'],
+                                               bits=args['lut_bits'])
+
+    ## repeated and near-duplicate photos are sampled once when there is a policy
+    dedup = None
+    if args['dedup'] is not None:
+        dedup = bcv.DuplicateFinder(max_distance=args['dedup_distance'], method=args['dedup_hash'],
+                                    policy=args['dedup'], threads=args['io_threads'])
+
+    engine = bcv.SegmentationEngine.for_mode(args['mode'], sample_parent_dir, error_parent_dir, qc=args['qc'],
+                                             calibration=calibration, object_filter=object_filter,
+                                             color_correction=color_correction, dedup=dedup)
+
+    ## progress line on the terminal, metrics textfile when asked for
+    with bcv.MetricsReporter(engine.metrics, path=args['metrics']):
+        engine.run(args['image'], imgformat=args['imgformat'], prefetch=args['prefetch'],
+                   io_threads=args['io_threads'], write_queue=args['write_queue'], shard=args['shard'],
+                   manifest=args['manifest'], heartbeat=args['heartbeat'])
+    if args['metrics_json'] is not None:
+        engine.metrics.save(args['metrics_json'])
 
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+"""
+Name: season_stats.py
+Description: merges the population statistics of workflow runs into one file
+-- python season_stats.py -o season_stats.json results/day1/day1_stats.json results/day2/day2_stats.json
+-- a run's <name>_output.json is read directly; an existing output file is updated with the new runs
+"""
+
+import os.path
+import argparse
+
+import berrycv as bcv
+
+
+def options(argv=None):
+    parser = argparse.ArgumentParser(description="Merges the population statistics of workflow runs.")
+    parser.add_argument("inputs", nargs='+', help="Statistics files (*_stats.json) or result files (*_output.json)")
+    parser.add_argument("-o", "--output", help="Merged statistics file, updated when it exists", required=True)
+    parser.add_argument("-c", "--csv", help="Also write count, mean and std per plantbarcode and trait to this csv",
+                        default=None)
+    args = parser.parse_args(argv)
+    return args
+
+
+## statistics of an input -- a sidecar, or built from a result JSON
+def load(path):
+    if path.endswith(bcv.popstats.STATS_SUFFIX):
+        return bcv.PopulationStats.load(path)
+    return bcv.PopulationStats.from_results(path)
+
+
+def main(argv=None):
+    args = options(argv)
+    merged = bcv.PopulationStats.load(args.output) if os.path.exists(args.output) else bcv.PopulationStats()
+    for path in args.inputs:
+        try:
+            merged.merge(load(path))
+        except ValueError as e:
+            print('Skipping \'%s\': %s' % (path, e))
+    merged.save(args.output)
+    if args.csv is not None:
+        merged.write_csv(args.csv)
+    print('%d plantbarcodes from %d runs in \'%s\'' % (len(merged.groups), len(merged.sources), args.output))
+
+
+if __name__ == "__main__":
+    main()